@@ -0,0 +1,546 @@
+"""A local stand-in for Discord's REST API and gateway, for load tests.
+
+It serves just enough of both for a py-cord bot to log in, receive guilds,
+interactions and messages, and answer them. Requests to message routes are
+rate limited per channel the way Discord does, answering 429s with the same
+headers, and every interaction acknowledgement is timed from the moment its
+event was sent.
+"""
+
+import asyncio
+import itertools
+import json
+import re
+import time
+from collections import Counter
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
+from typing import Any
+
+from aiohttp import WSMsgType, web
+
+API_PREFIX = "/api/v10"
+BOT_ID = 900_000_000_000_000_001
+APPLICATION_ID = BOT_ID
+OWNER_ID = 900_000_000_000_000_002
+TIMESTAMP = "2024-01-01T00:00:00+00:00"
+
+Handler = Callable[[web.Request, re.Match], Awaitable[web.Response]]
+
+
+def patch_pycord(base_url: str):
+    """Points py-cord's REST routes at `base_url` instead of discord.com."""
+    from discord import http
+
+    http.Route.base = property(lambda self: base_url + API_PREFIX)
+
+
+def user_payload(user_id: int, bot: bool = False) -> dict[str, Any]:
+    return {
+        "id": str(user_id),
+        "username": f"user{user_id}",
+        "global_name": f"user{user_id}",
+        "discriminator": "0",
+        "avatar": None,
+        "bot": bot,
+    }
+
+
+def member_payload(user_id: int) -> dict[str, Any]:
+    return {
+        "user": user_payload(user_id),
+        "roles": [],
+        "joined_at": TIMESTAMP,
+        "deaf": False,
+        "mute": False,
+        "permissions": str((1 << 41) - 1),
+    }
+
+
+@dataclass
+class Ack:
+    """An interaction acknowledgement, `latency` seconds after its event was sent."""
+
+    latency: float
+    content: str | None
+
+
+@dataclass
+class _Window:
+    started: float
+    used: int = 0
+
+
+@dataclass
+class Stats:
+    requests: Counter[str] = field(default_factory=Counter)
+    rate_limited: Counter[str] = field(default_factory=Counter)
+    unhandled: Counter[str] = field(default_factory=Counter)
+
+
+class FakeDiscord:
+    """Serves the REST API and gateway on one local port.
+
+    Message routes allow `route_limit` requests per `route_period` seconds
+    per channel. Every response is delayed by `latency` seconds, to stand in
+    for the round trip to Discord.
+    """
+
+    def __init__(
+        self,
+        *,
+        route_limit: int = 5,
+        route_period: float = 5.0,
+        latency: float = 0.0,
+    ):
+        self.route_limit = route_limit
+        self.route_period = route_period
+        self.latency = latency
+        self.url = ""
+        self.guilds: dict[int, dict[str, Any]] = {}
+        # message_id -> message payload, as last sent or edited.
+        self.messages: dict[int, dict[str, Any]] = {}
+        # interaction id -> loop time its event was sent.
+        self.pending: dict[int, float] = {}
+        self.acks: dict[int, Ack] = {}
+        self.stats = Stats()
+        self.identified = asyncio.Event()
+        self._ids = itertools.count(1_000_000_000_000_000_000)
+        self._windows: dict[str, _Window] = {}
+        self._sockets: list[web.WebSocketResponse] = []
+        self._sequence = itertools.count(1)
+        self._runner: web.AppRunner | None = None
+        self._routes: list[tuple[str, re.Pattern, str, Handler, bool]] = []
+        self._route("GET", r"/users/@me", "users/@me", self._me)
+        self._route("GET", r"/gateway(/bot)?", "gateway", self._gateway)
+        self._route("GET", r"/oauth2/applications/@me", "application", self._app)
+        self._route(
+            "GET", r"/applications/\d+(/guilds/\d+)?/commands", "commands", self._list
+        )
+        self._route(
+            "PUT", r"/applications/\d+(/guilds/\d+)?/commands", "commands", self._put
+        )
+        self._route(
+            "POST",
+            r"/applications/\d+(/guilds/\d+)?/commands",
+            "commands",
+            self._command,
+        )
+        self._route(
+            "POST", r"/interactions/(\d+)/[^/]+/callback", "callback", self._callback
+        )
+        self._route("POST", r"/webhooks/\d+/[^/]+", "followup", self._followup)
+        self._route(
+            "*", r"/webhooks/\d+/[^/]+/messages/\S+", "original", self._original
+        )
+        self._route(
+            "PATCH",
+            r"/channels/(\d+)/messages/(\d+)",
+            "edit_message",
+            self._edit,
+            limited=True,
+        )
+        self._route(
+            "POST",
+            r"/channels/(\d+)/messages",
+            "send_message",
+            self._send,
+            limited=True,
+        )
+        self._route(
+            "GET", r"/channels/(\d+)/messages/(\d+)", "get_message", self._get_message
+        )
+
+    def _route(
+        self,
+        method: str,
+        pattern: str,
+        name: str,
+        handler: Handler,
+        *,
+        limited: bool = False,
+    ):
+        self._routes.append((method, re.compile(pattern + "$"), name, handler, limited))
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Starts serving and returns the base URL."""
+        app = web.Application()
+        app.router.add_get("/gateway-ws", self._websocket)
+        app.router.add_route("*", API_PREFIX + "/{tail:.*}", self._rest)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self):
+        for ws in self._sockets:
+            await ws.close()
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    # State set up before and during a run.
+
+    def next_id(self) -> int:
+        return next(self._ids)
+
+    def add_guild(self, guild_id: int, channel_ids: list[int]):
+        self.guilds[guild_id] = {
+            "id": str(guild_id),
+            "name": f"guild{guild_id}",
+            "owner_id": str(OWNER_ID),
+            "unavailable": False,
+            "member_count": 2,
+            "large": False,
+            "features": [],
+            "emojis": [],
+            "stickers": [],
+            "afk_timeout": 300,
+            "verification_level": 0,
+            "default_message_notifications": 0,
+            "explicit_content_filter": 0,
+            "mfa_level": 0,
+            "premium_tier": 0,
+            "preferred_locale": "en-US",
+            "nsfw_level": 0,
+            "system_channel_flags": 0,
+            "joined_at": TIMESTAMP,
+            "roles": [
+                {
+                    "id": str(guild_id),
+                    "name": "@everyone",
+                    "permissions": str((1 << 41) - 1),
+                    "position": 0,
+                    "color": 0,
+                    "hoist": False,
+                    "managed": False,
+                    "mentionable": False,
+                }
+            ],
+            "channels": [
+                {
+                    "id": str(channel_id),
+                    "type": 0,
+                    "guild_id": str(guild_id),
+                    "name": f"channel{channel_id}",
+                    "position": position,
+                    "permission_overwrites": [],
+                    "nsfw": False,
+                    "parent_id": None,
+                }
+                for position, channel_id in enumerate(channel_ids)
+            ],
+            "members": [member_payload(BOT_ID) | {"user": user_payload(BOT_ID, True)}],
+            "threads": [],
+            "voice_states": [],
+            "presences": [],
+        }
+
+    def message_payload(
+        self,
+        message_id: int,
+        channel_id: int,
+        guild_id: int | None,
+        author_id: int = BOT_ID,
+        content: str = "",
+        embeds: list[dict] | None = None,
+    ) -> dict[str, Any]:
+        payload = {
+            "id": str(message_id),
+            "channel_id": str(channel_id),
+            "author": user_payload(author_id, author_id == BOT_ID),
+            "content": content,
+            "timestamp": TIMESTAMP,
+            "edited_timestamp": None,
+            "tts": False,
+            "mention_everyone": False,
+            "mentions": [],
+            "mention_roles": [],
+            "attachments": [],
+            "embeds": embeds or [],
+            "components": [],
+            "pinned": False,
+            "type": 0,
+            "flags": 0,
+        }
+        if guild_id is not None:
+            payload["guild_id"] = str(guild_id)
+        return payload
+
+    def add_message(self, message_id: int, channel_id: int, guild_id: int):
+        self.messages[message_id] = self.message_payload(
+            message_id, channel_id, guild_id
+        )
+
+    # Gateway.
+
+    async def dispatch(self, event: str, data: dict[str, Any]):
+        payload = json.dumps(
+            {"op": 0, "t": event, "s": next(self._sequence), "d": data}
+        )
+        for ws in self._sockets:
+            await ws.send_str(payload)
+
+    async def click(
+        self,
+        guild_id: int,
+        channel_id: int,
+        message_id: int,
+        user_id: int,
+        custom_id: str,
+    ) -> int:
+        """Sends a button click, returning the interaction's id."""
+        interaction_id = self.next_id()
+        message = self.messages.get(message_id) or self.message_payload(
+            message_id, channel_id, guild_id
+        )
+        data = {
+            "id": str(interaction_id),
+            "application_id": str(APPLICATION_ID),
+            "type": 3,
+            "token": f"token{interaction_id}",
+            "version": 1,
+            "guild_id": str(guild_id),
+            "channel_id": str(channel_id),
+            "member": member_payload(user_id),
+            "message": message,
+            "data": {"custom_id": custom_id, "component_type": 2},
+            "locale": "en-US",
+            "guild_locale": "en-US",
+            "app_permissions": str((1 << 41) - 1),
+            "entitlements": [],
+        }
+        self.pending[interaction_id] = asyncio.get_running_loop().time()
+        await self.dispatch("INTERACTION_CREATE", data)
+        return interaction_id
+
+    async def message(self, guild_id: int, channel_id: int, user_id: int, content: str):
+        """Sends a message created by a user."""
+        data = self.message_payload(
+            self.next_id(), channel_id, guild_id, user_id, content
+        )
+        data["member"] = {
+            k: v for k, v in member_payload(user_id).items() if k != "user"
+        }
+        await self.dispatch("MESSAGE_CREATE", data)
+
+    async def _websocket(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse(max_msg_size=0)
+        await ws.prepare(request)
+        await ws.send_json({"op": 10, "d": {"heartbeat_interval": 41250}})
+        async for msg in ws:
+            if msg.type != WSMsgType.TEXT:
+                continue
+            payload = json.loads(msg.data)
+            match payload.get("op"):
+                case 1:
+                    await ws.send_json({"op": 11})
+                case 2:
+                    await self._identify(ws)
+        if ws in self._sockets:
+            self._sockets.remove(ws)
+        return ws
+
+    async def _identify(self, ws: web.WebSocketResponse):
+        ready = {
+            "v": 10,
+            "user": user_payload(BOT_ID, True),
+            "guilds": [{"id": str(g), "unavailable": True} for g in self.guilds],
+            "session_id": "session",
+            "resume_gateway_url": self.url.replace("http", "ws") + "/gateway-ws",
+            "application": {"id": str(APPLICATION_ID), "flags": 0},
+            "private_channels": [],
+            "relationships": [],
+        }
+        await ws.send_json(
+            {"op": 0, "t": "READY", "s": next(self._sequence), "d": ready}
+        )
+        for guild in self.guilds.values():
+            await ws.send_json(
+                {"op": 0, "t": "GUILD_CREATE", "s": next(self._sequence), "d": guild}
+            )
+        self._sockets.append(ws)
+        self.identified.set()
+
+    # REST.
+
+    async def _rest(self, request: web.Request) -> web.StreamResponse:
+        path = "/" + request.match_info["tail"]
+        for method, pattern, name, handler, limited in self._routes:
+            if method not in ("*", request.method):
+                continue
+            match = pattern.match(path)
+            if match is None:
+                continue
+            self.stats.requests[f"{request.method} {name}"] += 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if not limited:
+                return await handler(request, match)
+            headers, allowed = self._rate_limit(f"{name}:{match.group(1)}")
+            if not allowed:
+                self.stats.rate_limited[f"{request.method} {name}"] += 1
+                response = self._json(
+                    {
+                        "message": "You are being rate limited.",
+                        "retry_after": float(headers["Retry-After"]),
+                        "global": False,
+                    },
+                    status=429,
+                )
+                response.headers.update(headers)
+                return response
+            response = await handler(request, match)
+            response.headers.update(headers)
+            return response
+        self.stats.unhandled[f"{request.method} {path}"] += 1
+        return self._json({"message": "404: Not Found", "code": 0}, status=404)
+
+    def _rate_limit(self, bucket: str) -> tuple[dict[str, str], bool]:
+        """Counts a request against its bucket.
+
+        Returns the rate limit headers to answer with, and whether the request
+        is allowed.
+        """
+        now = time.monotonic()
+        window = self._windows.get(bucket)
+        if window is None or now - window.started >= self.route_period:
+            window = self._windows[bucket] = _Window(now)
+        reset_after = self.route_period - (now - window.started)
+        headers = {
+            "X-RateLimit-Limit": str(self.route_limit),
+            "X-RateLimit-Reset-After": f"{reset_after:.3f}",
+            "X-RateLimit-Reset": f"{time.time() + reset_after:.3f}",
+            "X-RateLimit-Bucket": bucket,
+        }
+        if window.used >= self.route_limit:
+            headers["X-RateLimit-Remaining"] = "0"
+            headers["Retry-After"] = f"{reset_after:.3f}"
+            # py-cord takes 429s without this header for Cloudflare bans.
+            headers["Via"] = "1.1 google"
+            return headers, False
+        window.used += 1
+        headers["X-RateLimit-Remaining"] = str(self.route_limit - window.used)
+        return headers, True
+
+    @staticmethod
+    def _json(data: Any, status: int = 200) -> web.Response:
+        # py-cord only decodes bodies whose content type is exactly this.
+        return web.Response(
+            body=json.dumps(data).encode(),
+            status=status,
+            headers={"Content-Type": "application/json"},
+        )
+
+    @staticmethod
+    async def _body(request: web.Request) -> dict[str, Any]:
+        """Reads a JSON body, or the `payload_json` of a form with attachments."""
+        if request.content_type == "application/json":
+            return await request.json()
+        form = await request.post()
+        return json.loads(str(form.get("payload_json", "{}")))
+
+    async def _me(self, request: web.Request, match: re.Match) -> web.Response:
+        return self._json(user_payload(BOT_ID, True))
+
+    async def _gateway(self, request: web.Request, match: re.Match) -> web.Response:
+        return self._json(
+            {
+                "url": self.url.replace("http", "ws") + "/gateway-ws",
+                "shards": 1,
+                "session_start_limit": {
+                    "total": 1000,
+                    "remaining": 1000,
+                    "reset_after": 0,
+                    "max_concurrency": 1,
+                },
+            }
+        )
+
+    async def _app(self, request: web.Request, match: re.Match) -> web.Response:
+        return self._json(
+            {
+                "id": str(APPLICATION_ID),
+                "name": "bot",
+                "icon": None,
+                "description": "",
+                "bot_public": True,
+                "bot_require_code_grant": False,
+                "owner": user_payload(OWNER_ID),
+                "verify_key": "",
+                "team": None,
+                "flags": 0,
+            }
+        )
+
+    async def _list(self, request: web.Request, match: re.Match) -> web.Response:
+        return self._json([])
+
+    def _registered(self, command: dict[str, Any]) -> dict[str, Any]:
+        return {
+            "id": str(self.next_id()),
+            "application_id": str(APPLICATION_ID),
+            "version": "1",
+            "default_member_permissions": None,
+            "type": 1,
+            **command,
+        }
+
+    async def _put(self, request: web.Request, match: re.Match) -> web.Response:
+        commands = await request.json()
+        return self._json([self._registered(command) for command in commands])
+
+    async def _command(self, request: web.Request, match: re.Match) -> web.Response:
+        return self._json(self._registered(await request.json()))
+
+    async def _callback(self, request: web.Request, match: re.Match) -> web.Response:
+        interaction_id = int(match.group(1))
+        started = self.pending.pop(interaction_id, None)
+        if started is None:
+            return self._json(
+                {"message": "Unknown interaction", "code": 10062}, status=404
+            )
+        latency = asyncio.get_running_loop().time() - started
+        payload = await self._body(request)
+        content = (payload.get("data") or {}).get("content")
+        self.acks[interaction_id] = Ack(latency, content)
+        return web.Response(status=204)
+
+    async def _followup(self, request: web.Request, match: re.Match) -> web.Response:
+        return self._json(self.message_payload(self.next_id(), 0, None))
+
+    async def _original(self, request: web.Request, match: re.Match) -> web.Response:
+        if request.method == "DELETE":
+            return web.Response(status=204)
+        return self._json(self.message_payload(self.next_id(), 0, None))
+
+    async def _edit(self, request: web.Request, match: re.Match) -> web.Response:
+        message_id = int(match.group(2))
+        message = self.messages.get(message_id)
+        if message is None:
+            return self._json({"message": "Unknown Message", "code": 10008}, 404)
+        body = await request.json()
+        if "embeds" in body:
+            message["embeds"] = body["embeds"] or []
+        if "content" in body:
+            message["content"] = body["content"] or ""
+        message["edited_timestamp"] = TIMESTAMP
+        return self._json(message)
+
+    async def _send(self, request: web.Request, match: re.Match) -> web.Response:
+        channel_id = int(match.group(1))
+        body = await self._body(request)
+        message_id = self.next_id()
+        message = self.message_payload(
+            message_id, channel_id, None, content=body.get("content") or ""
+        )
+        self.messages[message_id] = message
+        return self._json(message)
+
+    async def _get_message(self, request: web.Request, match: re.Match) -> web.Response:
+        message = self.messages.get(int(match.group(2)))
+        if message is None:
+            return self._json({"message": "Unknown Message", "code": 10008}, 404)
+        return self._json(message)
@@ -0,0 +1,329 @@
+"""A local stand-in for a Redis server, for the redis counter backend.
+
+Usage: python -m benchmarks.fake_redis [--host 127.0.0.1] [--port 6379]
+
+It speaks RESP2 over TCP and implements the commands `RedisCounters` uses:
+hashes, sets and sorted sets, pipelining, and MULTI/EXEC transactions guarded
+by WATCH. Everything is kept in memory and lost when it stops.
+
+For the bot, run it in a process of its own: the bot's final write at
+shutdown blocks its event loop until the server answers.
+"""
+
+import argparse
+import asyncio
+import sys
+from collections import defaultdict
+from typing import Any
+
+
+class SortedSet(dict[bytes, float]):
+    """Scores by member."""
+
+
+Value = dict[bytes, bytes] | set[bytes] | SortedSet
+
+
+class WrongType(Exception):
+    pass
+
+
+def format_score(score: float) -> bytes:
+    return b"%d" % score if score.is_integer() else repr(score).encode()
+
+
+def encode(reply: Any) -> bytes:
+    if isinstance(reply, Exception):
+        return b"-%s\r\n" % str(reply).encode()
+    if reply is True:
+        return b"+OK\r\n"
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, int):
+        return b":%d\r\n" % reply
+    if isinstance(reply, bytes):
+        return b"$%d\r\n%s\r\n" % (len(reply), reply)
+    return b"*%d\r\n%s" % (len(reply), b"".join(encode(item) for item in reply))
+
+
+class FakeRedis:
+    """An in-memory Redis, serving every connection from the event loop."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.databases: dict[int, dict[bytes, Value]] = defaultdict(dict)
+        # Bumped whenever a key changes, for WATCH.
+        self.versions: dict[tuple[int, bytes], int] = defaultdict(int)
+        self.commands = 0
+        self._server: asyncio.Server | None = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        """Starts listening and returns the port."""
+        self._server = await asyncio.start_server(self._serve, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        session = {"db": 0, "watched": {}, "queue": None}
+        try:
+            while True:
+                args = await self._read_command(reader)
+                if args is None:
+                    break
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                writer.write(encode(self._dispatch(session, args)))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _read_command(reader: asyncio.StreamReader) -> list[bytes] | None:
+        line = await reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            # An inline command, as typed into telnet.
+            return line.split()
+        args = []
+        for _ in range(int(line[1:])):
+            length = int((await reader.readline())[1:])
+            args.append((await reader.readexactly(length + 2))[:-2])
+        return args
+
+    def _dispatch(self, session: dict, args: list[bytes]) -> Any:
+        self.commands += 1
+        name = args[0].upper().decode()
+        queue = session["queue"]
+        if queue is not None and name not in ("EXEC", "DISCARD", "MULTI", "WATCH"):
+            queue.append(args)
+            return b"QUEUED"
+        match name:
+            case "MULTI":
+                if queue is not None:
+                    return Exception("ERR MULTI calls can not be nested")
+                session["queue"] = []
+                return True
+            case "EXEC":
+                if queue is None:
+                    return Exception("ERR EXEC without MULTI")
+                session["queue"] = None
+                watched, session["watched"] = session["watched"], {}
+                if any(self.versions[key] != v for key, v in watched.items()):
+                    # Aborted, which real servers answer with a null array.
+                    return None
+                return [self._execute(session, queued) for queued in queue]
+            case "DISCARD":
+                if queue is None:
+                    return Exception("ERR DISCARD without MULTI")
+                session["queue"] = None
+                session["watched"] = {}
+                return True
+            case "WATCH":
+                if queue is not None:
+                    return Exception("ERR WATCH inside MULTI is not allowed")
+                for key in args[1:]:
+                    full = (session["db"], key)
+                    session["watched"][full] = self.versions[full]
+                return True
+            case "UNWATCH":
+                session["watched"] = {}
+                return True
+        return self._execute(session, args)
+
+    def _execute(self, session: dict, args: list[bytes]) -> Any:
+        name = args[0].upper().decode()
+        handler = getattr(self, f"cmd_{name.lower()}", None)
+        if handler is None:
+            return Exception(f"ERR unknown command '{name}'")
+        try:
+            return handler(session, *args[1:])
+        except WrongType:
+            return Exception(
+                "WRONGTYPE Operation against a key holding the wrong kind of value"
+            )
+        except (TypeError, ValueError):
+            return Exception(f"ERR wrong arguments for '{name}' command")
+
+    def _get(self, session: dict, key: bytes, kind: type) -> Any:
+        value = self.databases[session["db"]].get(key)
+        if value is not None and type(value) is not kind:
+            raise WrongType
+        return value
+
+    def _create(self, session: dict, key: bytes, kind: type) -> Any:
+        value = self._get(session, key, kind)
+        if value is None:
+            value = self.databases[session["db"]][key] = kind()
+        return value
+
+    def _touch(self, session: dict, key: bytes):
+        self.versions[session["db"], key] += 1
+        db = self.databases[session["db"]]
+        if key in db and not db[key]:
+            del db[key]
+
+    def cmd_ping(self, session: dict, message: bytes = b"PONG") -> bytes:
+        return message
+
+    def cmd_select(self, session: dict, db: bytes) -> bool:
+        session["db"] = int(db)
+        return True
+
+    def cmd_flushall(self, session: dict) -> bool:
+        for db, keys in self.databases.items():
+            for key in keys:
+                self.versions[db, key] += 1
+        self.databases.clear()
+        return True
+
+    def cmd_del(self, session: dict, *keys: bytes) -> int:
+        deleted = 0
+        for key in keys:
+            if self.databases[session["db"]].pop(key, None) is not None:
+                self.versions[session["db"], key] += 1
+                deleted += 1
+        return deleted
+
+    def cmd_sadd(self, session: dict, key: bytes, *members: bytes) -> int:
+        if not members:
+            raise TypeError
+        values = self._create(session, key, set)
+        added = len(set(members) - values)
+        values.update(members)
+        self._touch(session, key)
+        return added
+
+    def cmd_smembers(self, session: dict, key: bytes) -> list[bytes]:
+        return sorted(self._get(session, key, set) or ())
+
+    def cmd_hset(self, session: dict, key: bytes, *pairs: bytes) -> int:
+        if not pairs or len(pairs) % 2:
+            raise TypeError
+        values = self._create(session, key, dict)
+        added = 0
+        for field, value in zip(pairs[::2], pairs[1::2], strict=True):
+            added += field not in values
+            values[field] = value
+        self._touch(session, key)
+        return added
+
+    def cmd_hsetnx(self, session: dict, key: bytes, field: bytes, value: bytes) -> int:
+        values = self._create(session, key, dict)
+        if field in values:
+            return 0
+        values[field] = value
+        self._touch(session, key)
+        return 1
+
+    def cmd_hdel(self, session: dict, key: bytes, *fields: bytes) -> int:
+        values = self._get(session, key, dict) or {}
+        deleted = sum(values.pop(field, None) is not None for field in fields)
+        if deleted:
+            self._touch(session, key)
+        return deleted
+
+    def cmd_hget(self, session: dict, key: bytes, field: bytes) -> bytes | None:
+        return (self._get(session, key, dict) or {}).get(field)
+
+    def cmd_hmget(self, session: dict, key: bytes, *fields: bytes) -> list:
+        values = self._get(session, key, dict) or {}
+        return [values.get(field) for field in fields]
+
+    def cmd_hgetall(self, session: dict, key: bytes) -> list[bytes]:
+        values = self._get(session, key, dict) or {}
+        return [item for pair in values.items() for item in pair]
+
+    def cmd_hincrby(self, session: dict, key: bytes, field: bytes, delta: bytes) -> int:
+        values = self._create(session, key, dict)
+        try:
+            count = int(values.get(field, b"0")) + int(delta)
+        except ValueError:
+            return Exception("ERR hash value is not an integer")
+        values[field] = b"%d" % count
+        self._touch(session, key)
+        return count
+
+    def cmd_zadd(self, session: dict, key: bytes, *args: bytes) -> Any:
+        flags = set()
+        while args and args[0].upper() in (b"XX", b"NX", b"INCR"):
+            flags.add(args[0].upper())
+            args = args[1:]
+        if not args or len(args) % 2 or (b"INCR" in flags and len(args) != 2):
+            raise TypeError
+        values = self._get(session, key, SortedSet)
+        if values is None and b"XX" in flags:
+            return None if b"INCR" in flags else 0
+        values = self._create(session, key, SortedSet)
+        added = 0
+        score = None
+        for raw, member in zip(args[::2], args[1::2], strict=True):
+            exists = member in values
+            if exists if b"NX" in flags else not exists and b"XX" in flags:
+                continue
+            score = float(raw) + (values.get(member, 0.0) if b"INCR" in flags else 0)
+            added += not exists
+            values[member] = score
+        self._touch(session, key)
+        if b"INCR" in flags:
+            return format_score(score) if score is not None else None
+        return added
+
+    def cmd_zrem(self, session: dict, key: bytes, *members: bytes) -> int:
+        values = self._get(session, key, SortedSet) or {}
+        removed = sum(values.pop(member, None) is not None for member in members)
+        if removed:
+            self._touch(session, key)
+        return removed
+
+    def cmd_zrevrange(
+        self, session: dict, key: bytes, start: bytes, stop: bytes, *options: bytes
+    ) -> list[bytes]:
+        if options and [option.upper() for option in options] != [b"WITHSCORES"]:
+            raise TypeError
+        values = self._get(session, key, SortedSet) or {}
+        ranked = sorted(
+            values.items(), key=lambda item: (item[1], item[0]), reverse=True
+        )
+        first, last = int(start), int(stop)
+        if first < 0:
+            first += len(ranked)
+        last = last + len(ranked) if last < 0 else min(last, len(ranked) - 1)
+        reply = []
+        for member, score in ranked[max(first, 0) : last + 1]:
+            reply.append(member)
+            if options:
+                reply.append(format_score(score))
+        return reply
+
+
+async def serve(host: str, port: int, latency: float):
+    server = FakeRedis(latency)
+    port = await server.start(host, port)
+    print(f"Serving a fake Redis on {host}:{port}, Ctrl+C to stop.")
+    await asyncio.Event().wait()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds added to each command"
+    )
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port, args.latency))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
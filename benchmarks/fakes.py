@@ -0,0 +1,106 @@
+"""Network-free stand-ins for the discord objects the cogs touch."""
+
+import itertools
+
+import discord
+
+_ids = itertools.count(1_000_000)
+
+
+class FakeMessage:
+    def __init__(self, id: int | None = None, content: str | None = None, **kwargs):
+        self.id = next(_ids) if id is None else id
+        self.content = content
+        self.embed = kwargs.get("embed")
+        self.guild = kwargs.get("guild")
+        self.author = kwargs.get("author")
+        self.channel = kwargs.get("channel")
+        self.edits = 0
+
+    async def edit(self, **kwargs):
+        self.edits += 1
+        self.embed = kwargs.get("embed", self.embed)
+        return self
+
+    async def fetch(self):
+        return self
+
+    async def delete(self, **kwargs):
+        pass
+
+
+class FakeChannel(discord.TextChannel):
+    """A text channel whose messages live in memory."""
+
+    def __init__(self, id: int = 1):
+        self.id = id
+        self.messages: dict[int, FakeMessage] = {}
+
+    def get_partial_message(self, message_id: int) -> FakeMessage:
+        return self.messages.setdefault(message_id, FakeMessage(message_id))
+
+    async def fetch_message(self, id: int) -> FakeMessage:
+        return self.get_partial_message(id)
+
+
+class FakeUser:
+    def __init__(self, id: int = 42):
+        self.id = id
+        self.global_name = f"user{id}"
+        self.bot = False
+        self.mention = f"<@{id}>"
+
+
+class FakeGuild:
+    def __init__(self, id: int):
+        self.id = id
+
+
+class FakeResponse:
+    def __init__(self):
+        self.sent = 0
+        self._done = False
+
+    def is_done(self) -> bool:
+        return self._done
+
+    async def send_message(self, *args, **kwargs):
+        self.sent += 1
+        self._done = True
+
+    async def defer(self, *args, **kwargs):
+        self._done = True
+
+    async def edit_message(self, *args, **kwargs):
+        self._done = True
+
+
+class FakeInteraction:
+    """A component interaction, as sent when a counter button is clicked."""
+
+    type = discord.InteractionType.component
+
+    def __init__(self, custom_id: str, guild_id: int, channel: FakeChannel, user):
+        self.custom_id = custom_id
+        self.guild_id = guild_id
+        self.channel = channel
+        self.user = user
+        self.response = FakeResponse()
+
+
+class FakeContext:
+    """An application command context that records replies instead of sending them."""
+
+    def __init__(self, guild_id: int, channel: FakeChannel, user):
+        self.guild = FakeGuild(guild_id)
+        self.channel = channel
+        self.author = user
+        self.replies = 0
+
+    async def reply(self, content: str | None = None, **kwargs) -> FakeMessage:
+        self.replies += 1
+        message = FakeMessage(content=content, **kwargs)
+        self.channel.messages[message.id] = message
+        return message
+
+    respond = reply
@@ -0,0 +1,280 @@
+"""Micro-benchmarks for the count and fun hot paths.
+
+Usage: python -m benchmarks.hot_paths [--iterations N] [--save] [--tolerance T]
+
+Every case runs against fake interactions and contexts, so nothing touches the
+network. Results are compared against benchmarks/baseline.json when it exists:
+a case fails if its p50 latency grows by more than `tolerance` or it runs more
+sqlite statements per operation. `--save` writes the current results as the
+new baseline.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from collections.abc import Awaitable, Callable
+from dataclasses import asdict, dataclass
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+
+@dataclass
+class Result:
+    name: str
+    ops: int
+    seconds: float
+    p50_us: float
+    p99_us: float
+    statements_per_op: float
+
+    @property
+    def throughput(self) -> float:
+        return self.ops / self.seconds if self.seconds else float("inf")
+
+
+class StatementCounter:
+    """Counts the sqlite statements run on a traced connection."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, statement: str):
+        self.count += 1
+
+
+def percentile(samples: list[int], fraction: float) -> float:
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+async def measure(
+    name: str,
+    op: Callable[[int], Awaitable[object] | object],
+    iterations: int,
+    statements: StatementCounter,
+    settle: Callable[[], Awaitable[object]] | None = None,
+) -> Result:
+    """Runs `op(i)` `iterations` times, then `settle` to finish deferred work.
+
+    Latencies are per call; throughput and statement counts include `settle`, so
+    batched writes are amortised over the operations that caused them.
+    """
+    samples = []
+    before = statements.count
+    started = time.perf_counter()
+    for i in range(iterations):
+        t0 = time.perf_counter_ns()
+        result = op(i)
+        if isinstance(result, Awaitable):
+            await result
+        samples.append(time.perf_counter_ns() - t0)
+    if settle is not None:
+        await settle()
+    seconds = time.perf_counter() - started
+    samples.sort()
+    return Result(
+        name,
+        iterations,
+        seconds,
+        percentile(samples, 0.50) / 1000,
+        percentile(samples, 0.99) / 1000,
+        (statements.count - before) / iterations,
+    )
+
+
+async def run_count(iterations: int) -> list[Result]:
+    from benchmarks.fakes import (
+        FakeChannel,
+        FakeContext,
+        FakeGuild,
+        FakeInteraction,
+        FakeMessage,
+        FakeUser,
+    )
+    from cogs.count import ButtonType, Counting, IncrementButton, create_count_embed
+    from utils.matcher import Pattern
+
+    cog = Counting(None)
+    statements = StatementCounter()
+    await cog.store.load()
+    await cog.store.storage.set_trace_callback(statements)
+    channel = FakeChannel()
+    user = FakeUser()
+
+    guild_id = 1
+    await cog.create_count(FakeContext(guild_id, channel, user), 0)
+    custom_id = IncrementButton(guild_id, ButtonType.INCREMENT).custom_id
+    await cog.patterns.load()
+    await cog.patterns.add(guild_id, Pattern("default", "slay"))
+    message = FakeMessage(
+        content="that outfit was a total slay, everyone knows it. slay!",
+        guild=FakeGuild(guild_id),
+        author=user,
+        channel=channel,
+    )
+    # Patterns that would backtrack catastrophically as regular expressions,
+    # and wildcards matching at every character, against a message as long as
+    # Discord allows. Matching stays linear in the message, in milliseconds.
+    adversarial_id = 2
+    await cog.create_count(FakeContext(adversarial_id, channel, user), 0)
+    for pattern in ("(a+)+$", "(a|a)+b", "*a", "a*", "*aa*"):
+        await cog.patterns.add(adversarial_id, Pattern("default", pattern))
+    adversarial = FakeMessage(
+        content="a" * 1999 + "!",
+        guild=FakeGuild(adversarial_id),
+        author=user,
+        channel=channel,
+    )
+
+    # Clicks are measured unthrottled, then turned away by the throttle.
+    throttle, cog.throttle = cog.throttle, None
+    results = [
+        await measure(
+            "count.click",
+            lambda i: cog.on_interaction(
+                FakeInteraction(custom_id, guild_id, channel, user)
+            ),
+            iterations,
+            statements,
+            settle=cog.store.flush,
+        ),
+    ]
+    cog.throttle = throttle
+    results += [
+        await measure(
+            "count.click_throttled",
+            lambda i: cog.on_interaction(
+                FakeInteraction(custom_id, guild_id, channel, user)
+            ),
+            iterations,
+            statements,
+            settle=cog.store.flush,
+        ),
+        await measure(
+            "count.on_message",
+            lambda i: cog.on_message(message),
+            iterations,
+            statements,
+            settle=cog.store.flush,
+        ),
+        await measure(
+            "count.on_message_adversarial",
+            lambda i: cog.on_message(adversarial),
+            iterations,
+            statements,
+            settle=cog.store.flush,
+        ),
+        await measure(
+            "count.init_counter",
+            lambda i: cog.init_counter.callback(
+                cog, FakeContext(10_000 + i, channel, user), 0
+            ),
+            iterations,
+            statements,
+        ),
+        await measure(
+            "count.create_count",
+            lambda i: cog.create_count(
+                FakeContext(10_000 + iterations + i, channel, user), 0
+            ),
+            iterations,
+            statements,
+        ),
+        await measure(
+            "count.create_count_embed",
+            lambda i: create_count_embed(i),
+            iterations,
+            statements,
+        ),
+    ]
+    cog.cog_unload()
+    return results
+
+
+async def run_fun(iterations: int) -> list[Result]:
+    from benchmarks.fakes import FakeChannel, FakeContext, FakeUser
+    from cogs.fun import Fun
+
+    cog = Fun(None)
+    statements = StatementCounter()
+    ctx = FakeContext(1, FakeChannel(), FakeUser())
+    cases = {
+        "fun.roll": lambda i: cog.roll.callback(cog, ctx, "20d6"),
+        "fun.box": lambda i: cog.box.callback(cog, ctx, sentence="benchmark"),
+        "fun.mock": lambda i: cog.mock.callback(
+            cog, ctx, sentence="people say stupid things"
+        ),
+        "fun.how": lambda i: cog.how.callback(
+            cog, ctx, input_string="fast is this benchmark"
+        ),
+    }
+    return [
+        await measure(name, op, iterations, statements) for name, op in cases.items()
+    ]
+
+
+def compare(results: list[Result], baseline: dict[str, dict], tolerance: float):
+    """Returns a description of every result that regressed against `baseline`."""
+    regressions = []
+    for result in results:
+        base = baseline.get(result.name)
+        if base is None:
+            continue
+        if result.p50_us > base["p50_us"] * (1 + tolerance):
+            regressions.append(
+                f"{result.name}: p50 {result.p50_us:.1f}us > baseline {base['p50_us']:.1f}us"
+            )
+        if result.statements_per_op > base["statements_per_op"] + 1e-9:
+            regressions.append(
+                f"{result.name}: {result.statements_per_op:.3f} statements/op > baseline {base['statements_per_op']:.3f}"
+            )
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.3)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.getcwd())
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        # The cogs create cache.db and cache.json in the working directory.
+        os.chdir(tmp)
+        try:
+            results = asyncio.run(run_count(args.iterations))
+            results += asyncio.run(run_fun(args.iterations))
+        finally:
+            os.chdir(cwd)
+
+    print(f"{'case':<26}{'ops/s':>12}{'p50 us':>10}{'p99 us':>10}{'stmts/op':>10}")
+    for result in results:
+        print(
+            f"{result.name:<26}{result.throughput:>12.0f}{result.p50_us:>10.1f}"
+            f"{result.p99_us:>10.1f}{result.statements_per_op:>10.3f}"
+        )
+
+    if args.save:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({r.name: asdict(r) for r in results}, f, indent=2, sort_keys=True)
+        print(f"Saved baseline to {args.baseline}.")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline to compare against, run with --save to create one.")
+        return 0
+    with open(args.baseline, encoding="utf-8") as f:
+        regressions = compare(results, json.load(f), args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,69 @@
+"""Measures what a log call costs the caller, such as the event loop.
+
+Usage: python -m benchmarks.logging_overhead [--records N]
+
+Logs the per-click info line of the Counting cog to a file, once through a
+plain file handler, once through the queue of `setup_logging` and once with
+that logger rate limited as well.
+"""
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from utils.logging import LOGGING_FORMAT, setup_logging
+
+
+def measure(records: int) -> tuple[float, float]:
+    logger = logging.getLogger("cogs.count")
+    samples = []
+    for i in range(records):
+        started = time.perf_counter_ns()
+        logger.info(
+            "Server %d: %s %s the count of %s", i, "user42", "incremented", "default"
+        )
+        samples.append(time.perf_counter_ns() - started)
+    samples.sort()
+    return samples[len(samples) // 2] / 1000, samples[len(samples) * 99 // 100] / 1000
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, default=50_000)
+    args = parser.parse_args()
+
+    root = logging.getLogger()
+    print(f"{'mode':<16}{'p50 us':>10}{'p99 us':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bot.log")
+        for mode in ("file", "queue", "rate limited"):
+            for handler in root.handlers[:]:
+                root.removeHandler(handler)
+                handler.close()
+            listener = None
+            if mode == "file":
+                handler = logging.FileHandler(path, encoding="utf-8")
+                handler.setFormatter(logging.Formatter(LOGGING_FORMAT))
+                root.addHandler(handler)
+                root.setLevel(logging.DEBUG)
+            else:
+                listener = setup_logging(
+                    logging.DEBUG,
+                    path=path,
+                    rates={"cogs.count": 20} if mode == "rate limited" else None,
+                )
+            p50, p99 = measure(args.records)
+            if listener is not None:
+                listener.stop()
+            print(f"{mode:<16}{p50:>10.2f}{p99:>10.2f}")
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+            handler.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
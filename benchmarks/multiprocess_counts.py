@@ -0,0 +1,96 @@
+"""Checks that counters shared between worker processes never lose increments.
+
+Usage: python -m benchmarks.multiprocess_counts [--workers N] [--clicks N]
+
+Each worker runs its own CounterStore against one database file, the way
+sharded bot processes do, and clicks the same counters concurrently. The run
+fails if the stored counts or event log do not add up.
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+from utils.counters import CounterStore
+from utils.storage import CountingStorage
+
+COUNTERS = ((1, "default"), (1, "other"), (2, "default"), (3, "default"))
+
+
+async def click(path: str, clicks: int, seed: int):
+    rng = random.Random(seed)
+    store = CounterStore(CountingStorage(path), flush_interval=0.01, flush_threshold=2)
+    await store.load()
+    for _ in range(clicks):
+        store.increment(rng.choice(COUNTERS), 1, user_id=seed)
+        if rng.random() < 0.05:
+            # Yield so the flusher interleaves with other processes' writes.
+            await asyncio.sleep(0)
+    store.close()
+
+
+def run_worker(path: str, clicks: int, seed: int, start: multiprocessing.Event):
+    start.wait()
+    asyncio.run(click(path, clicks, seed))
+
+
+async def create_counters(path: str):
+    store = CounterStore(CountingStorage(path))
+    await store.load()
+    for message_id, key in enumerate(COUNTERS):
+        await store.set_counter(key, message_id, 0)
+    store.close()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--clicks", type=int, default=5000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "cache.db")
+        asyncio.run(create_counters(path))
+
+        ctx = multiprocessing.get_context("spawn")
+        start = ctx.Event()
+        workers = [
+            ctx.Process(target=run_worker, args=(path, args.clicks, seed, start))
+            for seed in range(args.workers)
+        ]
+        for worker in workers:
+            worker.start()
+        began = time.perf_counter()
+        start.set()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - began
+
+        con = sqlite3.connect(path)
+        (total,) = con.execute("SELECT SUM(count) FROM counting").fetchone()
+        (events,) = con.execute(
+            "SELECT COUNT(*) FROM counting_events WHERE source = 'button'"
+        ).fetchone()
+        con.close()
+
+    expected = args.workers * args.clicks
+    print(
+        f"{args.workers} workers, {expected} clicks in {elapsed:.2f}s: "
+        f"count {total}, events {events}"
+    )
+    failed = [worker.exitcode for worker in workers if worker.exitcode != 0]
+    if failed or total != expected or events != expected:
+        print("FAIL: increments were lost.", file=sys.stderr)
+        return 1
+    print("OK: no lost increments.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
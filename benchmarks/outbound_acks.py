@@ -0,0 +1,93 @@
+"""Measures interaction acknowledgement latency while edits pile up.
+
+Usage: python -m benchmarks.outbound_acks [--clicks N] [--connections N]
+
+Clicks arrive in bursts, each acknowledging its interaction and editing a
+counter message, over a simulated HTTP client with a fixed number of
+connections and a fixed round trip. Acknowledgements are measured once with
+edits sent straight away and once with edits queued by `OutboundScheduler`.
+The run fails if the scheduler does not keep the p99 acknowledgement latency
+below the direct run's.
+"""
+
+import argparse
+import asyncio
+import random
+import sys
+import time
+
+from utils.outbound import OutboundScheduler
+
+
+class FakeHTTP:
+    """A connection pool where every request takes one round trip."""
+
+    def __init__(self, connections: int, round_trip: float):
+        self.connections = asyncio.Semaphore(connections)
+        self.round_trip = round_trip
+
+    async def request(self):
+        async with self.connections:
+            await asyncio.sleep(self.round_trip)
+
+
+def percentile(samples: list[float], fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def run(
+    clicks: int, connections: int, round_trip: float, scheduled: bool
+) -> list[float]:
+    http = FakeHTTP(connections, round_trip)
+    outbound = OutboundScheduler(route_burst=5, route_period=1.0)
+    rng = random.Random(0)
+    latencies: list[float] = []
+    edits: list[asyncio.Future] = []
+
+    async def click():
+        channel = rng.randrange(20)
+        # Each click edits a counter message; here every one of them does.
+        if scheduled:
+            edits.append(outbound.submit(channel, http.request))
+        else:
+            edits.append(asyncio.ensure_future(http.request()))
+        started = time.perf_counter()
+        await outbound.acknowledge(http.request)
+        latencies.append(time.perf_counter() - started)
+
+    for _ in range(clicks // 50):
+        await asyncio.gather(*(click() for _ in range(50)))
+        await asyncio.sleep(round_trip)
+    for edit in edits:
+        edit.cancel()
+    outbound.close()
+    return latencies
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clicks", type=int, default=1000)
+    parser.add_argument("--connections", type=int, default=10)
+    parser.add_argument("--round-trip", type=float, default=0.01)
+    args = parser.parse_args()
+
+    print(f"{'mode':<12}{'p50 ms':>10}{'p99 ms':>10}")
+    p99s = {}
+    for mode, scheduled in (("direct", False), ("scheduled", True)):
+        latencies = asyncio.run(
+            run(args.clicks, args.connections, args.round_trip, scheduled)
+        )
+        p99s[mode] = percentile(latencies, 0.99)
+        print(
+            f"{mode:<12}{percentile(latencies, 0.5) * 1000:>10.1f}"
+            f"{p99s[mode] * 1000:>10.1f}"
+        )
+    if p99s["scheduled"] >= p99s["direct"]:
+        print("Scheduling edits did not lower acknowledgement latency.")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
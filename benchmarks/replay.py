@@ -0,0 +1,300 @@
+"""Replays button clicks and messages against the real bot and a fake Discord.
+
+Usage: python -m benchmarks.replay [--stream traffic.ndjson] [--speed X] [--guilds N --rate R --duration S]
+
+The bot from bot.py, with the Counting cog, logs in to `FakeDiscord` over
+HTTP and a websocket, in a scratch directory with its own settings.ini and
+cache.db. Events from a stream recorded with `benchmarks.traffic`, or a
+synthetic one, are sent over the gateway at their recorded times divided by
+`speed`, after which the run waits for the counter messages to catch up and
+shuts the bot down so it writes everything out. It reports:
+
+- how long interactions took to be acknowledged, and how many were not
+  acknowledged within Discord's three seconds;
+- lost increments: the stored counts against the clicks that were
+  acknowledged as counted plus the pattern matches in the messages;
+- stale messages: pinned counter messages left showing another count;
+- the requests the bot made, and how many were answered with a 429.
+
+The run fails if any increment was lost, any interaction went unanswered or
+any counter message was left stale.
+"""
+
+import argparse
+import asyncio
+import configparser
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import Counter
+
+from benchmarks import traffic
+from benchmarks.fake_discord import FakeDiscord, patch_pycord
+
+CounterKey = tuple[int, str]
+
+TOKEN = "replay.token"
+DEFAULT_NAME = "default"
+PATTERN = "slay"
+ACK_DEADLINE = 3.0
+COUNTED = "Count updated."
+BUTTONS = {"increment": "ButtonType.INCREMENT", "decrement": "ButtonType.DECREMENT"}
+
+
+def percentile(samples: list[float], fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def write_settings(args: argparse.Namespace):
+    config = configparser.ConfigParser()
+    config.read_dict(
+        {
+            "BASE": {"prefix": "!"},
+            "EXTENSIONS": {"cogs.count": "0"},
+            "COUNTING": {
+                "flush_interval": "5",
+                "flush_threshold": "100",
+                "edit_window": str(args.edit_window),
+            },
+            "THROTTLE": {"enabled": "1" if args.throttle else "0"},
+            "METRICS": {"port": "0"},
+            "SECRET": {"token": TOKEN},
+            "ADMIN_COMMANDS_GUILDS": {},
+        }
+    )
+    with open("settings.ini", "w", encoding="utf-8") as f:
+        config.write(f)
+
+
+async def seed(events: list[traffic.Event], fake: FakeDiscord) -> dict[CounterKey, int]:
+    """Sets up the guilds, a pinned message per counter, and "slay" per guild.
+
+    Returns the message id of every counter, which all start at 0.
+    """
+    from utils.storage import CountingStorage
+
+    channels: dict[int, set[int]] = {}
+    counters: dict[CounterKey, int] = {}
+    for event in events:
+        channels.setdefault(event.guild, set()).add(event.channel)
+        name = event.name if event.kind == "click" else DEFAULT_NAME
+        counters.setdefault((event.guild, name), event.channel)
+    for guild_id, channel_ids in channels.items():
+        fake.add_guild(guild_id, sorted(channel_ids))
+
+    message_ids = {}
+    storage = CountingStorage("cache.db")
+    try:
+        await storage.migrate()
+        for key, channel_id in counters.items():
+            message_id = message_ids[key] = fake.next_id()
+            fake.add_message(message_id, channel_id, key[0])
+            await storage.upsert_counter(key, message_id, 0, channel_id)
+        for guild_id in channels:
+            await storage.add_pattern(guild_id, DEFAULT_NAME, PATTERN, time.time())
+    finally:
+        storage.close()
+    return message_ids
+
+
+def stored_counts() -> dict[CounterKey, int]:
+    with sqlite3.connect("cache.db") as con:
+        rows = con.execute("SELECT server_id, name, count FROM counting").fetchall()
+    con.close()
+    return {(server_id, name): count for server_id, name, count in rows}
+
+
+def displayed_count(fake: FakeDiscord, message_id: int) -> int | None:
+    """The count a counter message shows, or None before its first edit."""
+    embeds = fake.messages[message_id]["embeds"]
+    if not embeds:
+        return None
+    return int(embeds[0]["fields"][0]["value"])
+
+
+def ignore_closed_session(loop: asyncio.AbstractEventLoop, context: dict):
+    # Messages sent with delete_after are deleted by tasks that outlive the
+    # run, and fail once the bot's HTTP session is closed.
+    exception = context.get("exception")
+    if isinstance(exception, RuntimeError) and str(exception) == "Session is closed":
+        return
+    loop.default_exception_handler(context)
+
+
+async def replay(args: argparse.Namespace, events: list[traffic.Event]) -> int:
+    fake = FakeDiscord(
+        route_limit=args.route_limit,
+        route_period=args.route_period,
+        latency=args.latency,
+    )
+    url = await fake.start()
+    patch_pycord(url)
+    message_ids = await seed(events, fake)
+    keys = list(message_ids)
+
+    # bot.py reads settings.ini from the working directory when imported.
+    import bot as bot_module
+    from utils.matcher import Matcher, Pattern
+
+    bot = bot_module.bot
+    bot.load_extension("cogs.count")
+    cog = bot.get_cog("Counting")
+    runner = asyncio.create_task(bot.start(TOKEN))
+    await asyncio.wait_for(bot.wait_until_ready(), timeout=30)
+    # Let on_ready load the counters before the first click.
+    await cog.store.load()
+
+    loop = asyncio.get_running_loop()
+    loop.set_exception_handler(ignore_closed_session)
+    matcher = Matcher([Pattern(DEFAULT_NAME, PATTERN)])
+    expected: Counter[CounterKey] = Counter()
+    clicks: dict[int, tuple[CounterKey, int]] = {}
+    lateness = 0.0
+    started = loop.time()
+    for event in events:
+        due = started + event.t / args.speed
+        now = loop.time()
+        if due > now:
+            await asyncio.sleep(due - now)
+        else:
+            lateness = max(lateness, now - due)
+        if event.kind == "click":
+            interaction_id = await fake.click(
+                event.guild,
+                event.channel,
+                message_ids[event.guild, event.name],
+                event.user,
+                f"{event.guild}::{event.name}::{BUTTONS[event.button]}",
+            )
+            delta = 1 if event.button == "increment" else -1
+            clicks[interaction_id] = ((event.guild, event.name), delta)
+        else:
+            await fake.message(event.guild, event.channel, event.user, event.content)
+            for name, matches in matcher.count(event.content).items():
+                expected[event.guild, name] += matches
+    replayed = loop.time() - started
+
+    # Wait for the last acknowledgements, and for the counter messages to
+    # catch up with the counts.
+    converged = None
+    deadline = loop.time() + args.settle
+    while loop.time() < deadline:
+        if not fake.pending and all(
+            displayed_count(fake, message_ids[key]) == cog.store.get(key).count
+            for key in keys
+        ):
+            converged = loop.time() - started - replayed
+            break
+        await asyncio.sleep(0.05)
+    displayed = {key: displayed_count(fake, message_ids[key]) for key in keys}
+
+    await bot.close()
+    await runner
+    # Unloading the cog writes out the counts it is still holding.
+    bot.unload_extension("cogs.count")
+    await fake.stop()
+
+    for interaction_id, (key, delta) in clicks.items():
+        ack = fake.acks.get(interaction_id)
+        if ack is not None and ack.content == COUNTED:
+            expected[key] += delta
+    stored = stored_counts()
+    lost = sum(abs(expected[key] - stored.get(key, 0)) for key in keys)
+    stale = sum(displayed[key] != stored.get(key) for key in keys)
+    latencies = [ack.latency for ack in fake.acks.values()]
+    unanswered = len(clicks) - len(fake.acks)
+    late = sum(latency > ACK_DEADLINE for latency in latencies)
+    contents = Counter(ack.content for ack in fake.acks.values())
+
+    print(
+        f"Replayed {len(events)} events ({len(clicks)} clicks) across "
+        f"{len({key[0] for key in keys})} guilds in {replayed:.2f}s, "
+        f"{len(events) / replayed:.0f}/s, at most {lateness * 1000:.1f}ms behind."
+    )
+    if latencies:
+        print(
+            f"Acks: p50 {percentile(latencies, 0.5) * 1000:.1f}ms, "
+            f"p99 {percentile(latencies, 0.99) * 1000:.1f}ms, "
+            f"max {max(latencies) * 1000:.1f}ms; "
+            f"{unanswered} unanswered, {late} later than {ACK_DEADLINE:.0f}s."
+        )
+    for content, count in contents.most_common():
+        print(f"  {count:>8}  {content}")
+    print(
+        f"Counts: {lost} lost increments over {len(keys)} counters, "
+        f"{stale} messages stale, "
+        + (
+            f"caught up {converged:.2f}s after the last event."
+            if converged is not None
+            else f"not caught up {args.settle:.0f}s after the last event."
+        )
+    )
+    print(f"{'request':<28}{'sent':>8}{'429s':>8}")
+    for route, count in sorted(fake.stats.requests.items()):
+        print(f"{route:<28}{count:>8}{fake.stats.rate_limited[route]:>8}")
+    for route, count in sorted(fake.stats.unhandled.items()):
+        print(f"{route:<28}{count:>8}  unhandled")
+    return 1 if lost or stale or unanswered or late else 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--stream", help="an NDJSON stream, else one is synthesized")
+    parser.add_argument("--speed", type=float, default=1.0)
+    parser.add_argument("--guilds", type=int, default=50)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--rate", type=float, default=200.0, help="events per second")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds")
+    parser.add_argument("--click-share", type=float, default=0.7)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--throttle", action=argparse.BooleanOptionalAction, default=True
+    )
+    parser.add_argument("--edit-window", type=float, default=1.0)
+    parser.add_argument(
+        "--route-limit", type=int, default=5, help="requests per channel and period"
+    )
+    parser.add_argument("--route-period", type=float, default=5.0)
+    parser.add_argument(
+        "--latency", type=float, default=0.02, help="seconds per fake request"
+    )
+    parser.add_argument(
+        "--settle", type=float, default=30.0, help="seconds to wait for catching up"
+    )
+    args = parser.parse_args()
+
+    if args.stream:
+        events = traffic.load(args.stream)
+    else:
+        events = list(
+            traffic.synthesize(
+                args.guilds,
+                args.users,
+                args.rate,
+                args.duration,
+                click_share=args.click_share,
+                seed=args.seed,
+            )
+        )
+    if not events:
+        print("No events to replay.", file=sys.stderr)
+        return 1
+
+    logging.basicConfig(level=logging.WARNING)
+    root = os.getcwd()
+    sys.path.insert(0, root)
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            write_settings(args)
+            return asyncio.run(replay(args, events))
+        finally:
+            os.chdir(root)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,195 @@
+"""Compares the counter storage backends on the click workload.
+
+Usage: python -m benchmarks.storage_backends [--counters N] [--clicks N] [--redis HOST:PORT]
+
+Each backend from `utils.backends` stores the same counters behind a
+`CounterStore`, with their history in a scratch sqlite file:
+
+- setup: creating every counter with a compare-and-set, as /init_counter does;
+- clicks: increments on random counters, flushed every `--batch` clicks, the
+  way the write-behind flusher does, reported as clicks per second including
+  the flushes, and the flush latency;
+- writes: one counter's delta written through at a time, without events,
+  which is the backend's own round trip;
+- load: reading every counter back, as on startup;
+- top: the top ten counters of every server and of all servers, as
+  /leaderboard reads them.
+
+The redis backend runs against `benchmarks.fake_redis` in this process unless
+`--redis` points at a real server, where it uses a scratch key prefix. The
+run fails if a backend's stored counts do not add up to the clicks, or its
+leaderboards do not rank them.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+
+from benchmarks.fake_redis import FakeRedis
+from utils.backends import (
+    BACKENDS,
+    CounterBackend,
+    MemoryCounters,
+    RedisCounters,
+    SqliteCounters,
+)
+from utils.counters import CounterStore
+from utils.storage import CounterKey, CountingStorage
+
+
+def percentile(samples: list[float], fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def make_backend(
+    name: str, storage: CountingStorage, redis: tuple[str, int]
+) -> CounterBackend:
+    match name:
+        case "sqlite":
+            return SqliteCounters(storage)
+        case "memory":
+            return MemoryCounters(storage)
+    return RedisCounters(storage, *redis, prefix=f"benchmark{os.getpid()}")
+
+
+async def run(
+    name: str, args: argparse.Namespace, redis: tuple[str, int], path: str
+) -> dict[str, float]:
+    rng = random.Random(0)
+    keys: list[CounterKey] = [
+        (guild_id, f"counter{i}")
+        for guild_id in range(1, args.guilds + 1)
+        for i in range(args.counters // args.guilds)
+    ]
+    storage = CountingStorage(path)
+    backend = make_backend(name, storage, redis)
+    store = CounterStore(
+        storage, backend=backend, flush_interval=3600, flush_threshold=len(keys) + 1
+    )
+    await store.load()
+    results = {}
+
+    setups = []
+    for message_id, key in enumerate(keys, start=1):
+        started = time.perf_counter()
+        if not await store.set_counter(
+            key, message_id, 0, channel_id=key[0], expected_version=0
+        ):
+            raise RuntimeError(f"{name}: counter {key} already existed.")
+        setups.append(time.perf_counter() - started)
+    results["setup p50"] = percentile(setups, 0.5)
+    results["setup p99"] = percentile(setups, 0.99)
+    await store.flush()
+
+    expected: Counter[CounterKey] = Counter()
+    flushes = []
+    started = time.perf_counter()
+    for click in range(1, args.clicks + 1):
+        key = rng.choice(keys)
+        store.increment(key, 1, user_id=click)
+        expected[key] += 1
+        if click % args.batch == 0:
+            flush_started = time.perf_counter()
+            await store.flush()
+            flushes.append(time.perf_counter() - flush_started)
+    await store.flush()
+    results["clicks/s"] = args.clicks / (time.perf_counter() - started)
+    results["flush p50"] = percentile(flushes, 0.5)
+    results["flush p99"] = percentile(flushes, 0.99)
+
+    writes = []
+    for _ in range(args.writes):
+        key = rng.choice(keys)
+        started = time.perf_counter()
+        await backend.apply_deltas([(1, *key)])
+        writes.append(time.perf_counter() - started)
+        expected[key] += 1
+    results["write p50"] = percentile(writes, 0.5)
+    results["write p99"] = percentile(writes, 0.99)
+
+    started = time.perf_counter()
+    rows = await backend.load()
+    results["load"] = time.perf_counter() - started
+    stored = {(server_id, name): count for server_id, name, _, count, *_ in rows}
+    results["lost"] = sum(abs(expected[key] - stored.get(key, 0)) for key in keys)
+
+    tops = []
+    results["misranked"] = 0
+    for server_id in (None, *range(1, args.guilds + 1)):
+        started = time.perf_counter()
+        top = await store.leaderboard(server_id, 10)
+        tops.append(time.perf_counter() - started)
+        counts = sorted(
+            (
+                count
+                for key, count in stored.items()
+                if server_id is None or key[0] == server_id
+            ),
+            reverse=True,
+        )
+        results["misranked"] += [count for *_, count in top] != counts[:10]
+    results["top p50"] = percentile(tops, 0.5)
+    store.close()
+    return results
+
+
+async def run_redis(args: argparse.Namespace, path: str) -> dict[str, float]:
+    if args.redis:
+        host, _, port = args.redis.rpartition(":")
+        return await run("redis", args, (host or "127.0.0.1", int(port)), path)
+    server = FakeRedis()
+    port = await server.start()
+    try:
+        return await run("redis", args, ("127.0.0.1", port), path)
+    finally:
+        await server.stop()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--counters", type=int, default=1000)
+    parser.add_argument("--guilds", type=int, default=50)
+    parser.add_argument("--clicks", type=int, default=50_000)
+    parser.add_argument("--batch", type=int, default=500, help="clicks per flush")
+    parser.add_argument("--writes", type=int, default=2000)
+    parser.add_argument("--redis", help="HOST:PORT of a real server")
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=BACKENDS)
+    args = parser.parse_args()
+
+    print(
+        f"{'backend':<10}{'setup p50':>11}{'p99':>8}{'clicks/s':>11}"
+        f"{'flush p50':>11}{'p99':>8}{'write p50':>11}{'p99':>8}{'load':>8}"
+        f"{'top p50':>9}"
+    )
+    failed = 0
+    for name in args.backends:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "cache.db")
+            if name == "redis":
+                results = asyncio.run(run_redis(args, path))
+            else:
+                results = asyncio.run(run(name, args, ("", 0), path))
+        failed += results["lost"] + results["misranked"]
+        ms = {key: value * 1000 for key, value in results.items() if key != "clicks/s"}
+        print(
+            f"{name:<10}{ms['setup p50']:>11.3f}{ms['setup p99']:>8.3f}"
+            f"{results['clicks/s']:>11.0f}{ms['flush p50']:>11.2f}"
+            f"{ms['flush p99']:>8.2f}{ms['write p50']:>11.3f}"
+            f"{ms['write p99']:>8.3f}{ms['load']:>8.1f}{ms['top p50']:>9.3f}"
+        )
+        if results["lost"]:
+            print(f"  {results['lost']:.0f} increments lost.")
+        if results["misranked"]:
+            print(f"  {results['misranked']:.0f} leaderboards misranked.")
+    print("Latencies in milliseconds.")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,213 @@
+"""Interaction and message streams for `benchmarks.replay`.
+
+Usage: python -m benchmarks.traffic traffic.ndjson [--guilds N] [--rate R] [--duration S]
+
+Streams are NDJSON files with one event per line, in the order they happened:
+
+    {"t": 0.012, "kind": "click", "guild": 1, "channel": 2, "user": 3, "name": "default", "button": "increment"}
+    {"t": 0.020, "kind": "message", "guild": 1, "channel": 2, "user": 4, "content": "slay"}
+
+`t` is seconds since the start of the stream. Run as a script, this writes a
+synthetic stream; loaded as a bot extension, it records the clicks and
+messages the bot receives to `traffic.ndjson` in the working directory.
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+from collections.abc import Iterable, Iterator
+from dataclasses import asdict, dataclass
+from typing import TYPE_CHECKING, Literal
+
+if TYPE_CHECKING:
+    import discord
+
+RECORDING_PATH = "traffic.ndjson"
+WORDS = ("slay", "squid", "hello", "queen", "lol", "the", "absolutely", "ate")
+
+
+@dataclass
+class Event:
+    t: float
+    kind: Literal["click", "message"]
+    guild: int
+    channel: int
+    user: int
+    name: str = "default"
+    button: str = "increment"
+    content: str = ""
+
+    def to_json(self) -> str:
+        fields = asdict(self)
+        if self.kind == "click":
+            del fields["content"]
+        else:
+            del fields["name"], fields["button"]
+        return json.dumps(fields, separators=(",", ":"))
+
+
+def load(path: str) -> list[Event]:
+    with open(path, encoding="utf-8") as f:
+        return [Event(**json.loads(line)) for line in f if line.strip()]
+
+
+def save(path: str, events: Iterable[Event]) -> int:
+    written = 0
+    with open(path, "w", encoding="utf-8") as f:
+        for event in events:
+            f.write(event.to_json() + "\n")
+            written += 1
+    return written
+
+
+def guild_ids(count: int) -> list[int]:
+    """Snowflake-like ids for `count` synthetic guilds."""
+    return [100_000_000_000_000_000 + i for i in range(count)]
+
+
+def channel_id(guild_id: int) -> int:
+    """The id of the one channel of a synthetic guild."""
+    return guild_id + 100_000_000_000_000_000
+
+
+def synthesize(
+    guilds: int,
+    users: int,
+    rate: float,
+    duration: float,
+    *,
+    click_share: float = 0.7,
+    hot_share: float = 0.5,
+    seed: int = 0,
+) -> Iterator[Event]:
+    """Yields `rate` events per second on average, arriving at random.
+
+    Half the traffic, by default, goes to the first guild, as it would when a
+    single large server is busy; the rest is spread across the other guilds.
+    Clicks mostly increment, and messages say "slay" now and then.
+    """
+    rng = random.Random(seed)
+    ids = guild_ids(guilds)
+    t = 0.0
+    while True:
+        t += rng.expovariate(rate)
+        if t >= duration:
+            return
+        guild = ids[0] if rng.random() < hot_share else rng.choice(ids)
+        user = rng.randrange(users) + 1
+        if rng.random() < click_share:
+            yield Event(
+                round(t, 6),
+                "click",
+                guild,
+                channel_id(guild),
+                user,
+                button="increment" if rng.random() < 0.9 else "decrement",
+            )
+        else:
+            content = " ".join(rng.choices(WORDS, k=rng.randrange(1, 12)))
+            yield Event(
+                round(t, 6), "message", guild, channel_id(guild), user, content=content
+            )
+
+
+class Recorder:
+    """Appends the clicks and messages a bot receives to a stream file."""
+
+    def __init__(self, path: str = RECORDING_PATH):
+        self.f = open(path, "a", encoding="utf-8")
+        self.started = time.monotonic()
+
+    def record(self, event: Event):
+        self.f.write(event.to_json() + "\n")
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+    def elapsed(self) -> float:
+        return round(time.monotonic() - self.started, 6)
+
+    async def on_interaction(self, interaction: "discord.Interaction"):
+        from cogs.count import ButtonType, parse_custom_id
+
+        if (
+            interaction.custom_id is None
+            or interaction.channel_id is None
+            or interaction.user is None
+        ):
+            return
+        parsed = parse_custom_id(interaction.custom_id)
+        if parsed is None:
+            return
+        (guild_id, name), button_type = parsed
+        button = "increment" if button_type == ButtonType.INCREMENT else "decrement"
+        self.record(
+            Event(
+                self.elapsed(),
+                "click",
+                guild_id,
+                interaction.channel_id,
+                interaction.user.id,
+                name=name,
+                button=button,
+            )
+        )
+
+    async def on_message(self, message: "discord.Message"):
+        if message.guild is None or message.author.bot or not message.content:
+            return
+        self.record(
+            Event(
+                self.elapsed(),
+                "message",
+                message.guild.id,
+                message.channel.id,
+                message.author.id,
+                content=message.content,
+            )
+        )
+
+
+def setup(bot):
+    bot.recorder = Recorder()
+    bot.add_listener(bot.recorder.on_interaction, "on_interaction")
+    bot.add_listener(bot.recorder.on_message, "on_message")
+
+
+def teardown(bot):
+    bot.remove_listener(bot.recorder.on_interaction, "on_interaction")
+    bot.remove_listener(bot.recorder.on_message, "on_message")
+    bot.recorder.close()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Writes a synthetic traffic stream.")
+    parser.add_argument("path")
+    parser.add_argument("--guilds", type=int, default=50)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--rate", type=float, default=200.0, help="events per second")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds")
+    parser.add_argument("--click-share", type=float, default=0.7)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    written = save(
+        args.path,
+        synthesize(
+            args.guilds,
+            args.users,
+            args.rate,
+            args.duration,
+            click_share=args.click_share,
+            seed=args.seed,
+        ),
+    )
+    print(f"Wrote {written} events to {args.path}.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,26 +3,72 @@ import logging
 import os
 
 import discord
-from discord.ext import bridge, commands
+from discord.ext import bridge
 
-from utils.logging import LOGGING_FORMAT
+from cogs import checks
+from utils import handoff, metrics
+from utils.logging import parse_levels, setup_logging
+from utils.startup import StartupProfiler
 
 DESCRIPTION = "A discord bot to count the unironic use of 'slay'."
 logger = logging.getLogger(__name__)
+profiler = StartupProfiler()
+profiler.mark("imports")
+startup_reported = False
 
 if not os.path.exists("settings.ini"):
     with open("settings.ini", "xt", encoding="utf-8") as f:
-        f.writelines(
-            [
-                "[BASE]",
-                "prefix = !",
-                "[EXTENSIONS]",
-                "cogs.fun = 0",
-                "cogs.count = 0",
-                "[SECRET]",
-                "token = ",
-                "[ADMIN_COMMANDS_GUILDS]",
-            ]
+        f.write(
+            "\n".join(
+                [
+                    "[BASE]",
+                    "prefix = !",
+                    "[EXTENSIONS]",
+                    "cogs.fun = 0",
+                    "cogs.count = 0",
+                    "[COUNTING]",
+                    "flush_interval = 5",
+                    "flush_threshold = 100",
+                    "edit_window = 1",
+                    "history_retention_days = 30",
+                    "backfill_workers = 3",
+                    "sweep_interval_hours = 6",
+                    "sweep_batch_size = 50",
+                    "sweep_workers = 3",
+                    "[THROTTLE]",
+                    "enabled = 1",
+                    "user_rate = 2",
+                    "user_burst = 5",
+                    "guild_rate = 20",
+                    "guild_burst = 40",
+                    "max_tracked = 10000",
+                    "[STORAGE]",
+                    "backend = sqlite",
+                    "redis_host = 127.0.0.1",
+                    "redis_port = 6379",
+                    "redis_db = 0",
+                    "redis_prefix = counter",
+                    "[SHARDING]",
+                    "enabled = 0",
+                    "shard_count = 0",
+                    "workers = 1",
+                    "[METRICS]",
+                    "host = 127.0.0.1",
+                    "port = 9100",
+                    "[LOGGING]",
+                    "level = DEBUG",
+                    "json = 0",
+                    "path = ",
+                    "max_bytes = 10485760",
+                    "backup_count = 5",
+                    "sample = ",
+                    "rate_limits = cogs.count=20",
+                    "[SECRET]",
+                    "token = ",
+                    "[ADMIN_COMMANDS_GUILDS]",
+                ]
+            )
+            + "\n"
         )
 
     raise RuntimeError(
@@ -38,15 +84,38 @@ intents.message_content = True
 intents.guilds = True
 intents.reactions = True
 
-bot = bridge.Bot(
-    command_prefix=config["BASE"]["prefix"],
-    description=DESCRIPTION,
-    help_command=None,
-    intents=intents,
+# Workers started by supervisor.py are told which shards to run through these.
+shard_ids = os.environ.get("SHARD_IDS")
+shard_count = int(
+    os.environ.get("SHARD_COUNT") or config.get("SHARDING", "shard_count", fallback=0)
+)
+
+if shard_ids or config.getboolean("SHARDING", "enabled", fallback=False):
+    bot = bridge.AutoShardedBot(
+        command_prefix=config["BASE"]["prefix"],
+        description=DESCRIPTION,
+        help_command=None,
+        intents=intents,
+        shard_count=shard_count or None,
+        shard_ids=[int(i) for i in shard_ids.split(",")] if shard_ids else None,
+    )
+else:
+    bot = bridge.Bot(
+        command_prefix=config["BASE"]["prefix"],
+        description=DESCRIPTION,
+        help_command=None,
+        intents=intents,
+    )
+metrics.instrument_bot(bot)
+checks.cache.install(bot)
+metrics_server = metrics.MetricsServer(
+    config.get("METRICS", "host", fallback="127.0.0.1"),
+    int(os.environ.get("METRICS_PORT") or config.getint("METRICS", "port", fallback=0)),
 )
 startup_extensions = list(config["EXTENSIONS"])
 admin_commands_guilds = list(config["ADMIN_COMMANDS_GUILDS"])
 TOKEN = config["SECRET"]["TOKEN"]
+profiler.mark("setup")
 
 
 @bot.event
@@ -55,61 +124,60 @@ async def on_ready():
     logger.info("logged in as %s", bot.user.name)
     logger.info("user id: %d", bot.user.id)
     await bot.change_presence(activity=discord.Game(name="with 🦑"))
+    await metrics_server.start()
+    global startup_reported
+    if not startup_reported:
+        startup_reported = True
+        profiler.mark("login and connect")
+        logger.info("Startup took:\n%s", profiler.report())
 
 
 @bot.slash_command(hidden=True, guild_ids=admin_commands_guilds)
-@commands.is_owner()
+@checks.is_owner()
 async def load(ctx, extension_name: str):
     "Loads an extension."
-    member = ctx.author
-    bot_info = await bot.application_info()
-    if member == bot_info.owner:
-        try:
-            bot.load_extension(extension_name)
-        except Exception as e:
-            await ctx.respond("```py\n{}: {}\n```".format(type(e).__name__, str(e)))
-            return
-        await ctx.respond("{} loaded.".format(extension_name))
-    else:
-        await ctx.respond("{} is not bot owner!".format(member.mention))
+    try:
+        bot.load_extension(extension_name)
+    except Exception as e:
+        await ctx.respond("```py\n{}: {}\n```".format(type(e).__name__, str(e)))
+        return
+    await ctx.respond("{} loaded.".format(extension_name))
 
 
 @bot.slash_command(hidden=True, guild_ids=admin_commands_guilds)
-@commands.is_owner()
+@checks.is_owner()
 async def unload(ctx, extension_name: str):
     "Unloads an extension."
-    member = ctx.author
-    bot_info = await bot.application_info()
-    if member == bot_info.owner:
-        bot.unload_extension(extension_name)
-        await ctx.respond("{} unloaded.".format(extension_name))
-    else:
-        await ctx.respond("{} is not bot owner!".format(member.mention))
+    bot.unload_extension(extension_name)
+    await ctx.respond("{} unloaded.".format(extension_name))
 
 
 @bot.slash_command(hidden=True, guild_ids=admin_commands_guilds)
-@commands.is_owner()
+@checks.is_owner()
 async def reload(ctx, extension_name: str):
     "Reloads an extension."
-    member = ctx.author
-    bot_info = await bot.application_info()
-    if member == bot_info.owner:
-        try:
-            bot.unload_extension(extension_name)
-            bot.load_extension(extension_name)
-        except (AttributeError, ImportError) as e:
-            await ctx.respond("```py\n{}: {}\n```".format(type(e).__name__, str(e)))
-            return
-        await ctx.respond("{} reloaded.".format(extension_name))
-    else:
-        await ctx.respond("{} is not bot owner!".format(member.mention))
+    try:
+        # The old cog hands its live state to the new one, and py-cord puts
+        # the old cog back if the new one fails to load.
+        with handoff.reloading(extension_name):
+            bot.reload_extension(extension_name)
+    except (AttributeError, ImportError, discord.ExtensionError) as e:
+        await ctx.respond("```py\n{}: {}\n```".format(type(e).__name__, str(e)))
+        return
+    await ctx.respond("{} reloaded.".format(extension_name))
+
+
+@bot.slash_command(hidden=True, guild_ids=admin_commands_guilds)
+@checks.is_owner()
+async def stats(ctx):
+    "Shows latency, database and rate-limit metrics."
+    await ctx.respond("```\n{}\n```".format(metrics.format_summary()))
 
 
 @bot.slash_command(hidden=True, guild_ids=admin_commands_guilds)
 async def owner(ctx):
     member = ctx.author
-    bot_info = await bot.application_info()
-    if member == bot_info.owner:
+    if await checks.cache.is_owner(bot, member):
         await ctx.respond("{} is bot owner".format(member.mention))
     else:
         await ctx.respond("{} is not bot owner".format(member.mention))
@@ -117,13 +185,30 @@ async def owner(ctx):
 
 if __name__ == "__main__":
 
-    logging.basicConfig(level=logging.DEBUG, format=LOGGING_FORMAT)
+    # Records are written by a background thread, so logging on the event loop
+    # costs little even at debug level.
+    log_listener = setup_logging(
+        config.get("LOGGING", "level", fallback="DEBUG").upper(),
+        json_output=config.getboolean("LOGGING", "json", fallback=False),
+        path=config.get("LOGGING", "path", fallback="") or None,
+        max_bytes=config.getint("LOGGING", "max_bytes", fallback=10 * 1024 * 1024),
+        backup_count=config.getint("LOGGING", "backup_count", fallback=5),
+        samples=parse_levels(config.get("LOGGING", "sample", fallback="")),
+        rates=parse_levels(config.get("LOGGING", "rate_limits", fallback="")),
+    )
     logger = logging.getLogger(__name__)
 
     for extension in startup_extensions:
         try:
-            bot.load_extension(extension)
+            with profiler.phase(f"load {extension}"):
+                bot.load_extension(extension)
         except Exception as e:
             exc = "{}: {}".format(type(e).__name__, e)
             logging.error("Failed to load extension %s\n%s", extension, exc)
-    bot.run(TOKEN)
+    try:
+        bot.run(TOKEN)
+    finally:
+        # Unloading lets cogs flush any state they are still holding.
+        for extension in list(bot.extensions):
+            bot.unload_extension(extension)
+        log_listener.stop()
@@ -1,3 +1,8 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+import discord
 from discord.ext import commands
 
 # The permission system of the bot is based on a "just works" basis
@@ -9,17 +14,175 @@ from discord.ext import commands
 # Of course, the owner will always be able to execute commands.
 
 
+# Application owners are refetched after this many seconds.
+OWNER_TTL = 600.0
+# Permissions are remembered for at most this many guilds at once, and this
+# many (channel, member) pairs per guild.
+MAX_CACHED_GUILDS = 1024
+MAX_CACHED_MEMBERS = 1024
+
+
+class PermissionCache:
+    """Remembers the bot's owners and members' resolved permissions.
+
+    Owners come from `application_info`, which is a REST call, so they are
+    cached for `OWNER_TTL` seconds. Permissions are memoised per guild and
+    member, and per channel and member. Each entry records the member's role
+    ids and is only used while they still match, so role changes are picked
+    up even without the members intent. Role, channel and guild updates
+    invalidate the guild's entries through the listeners added by `install`.
+    Both the guilds and each guild's entries are evicted least recently used
+    first.
+    """
+
+    def __init__(
+        self,
+        ttl: float = OWNER_TTL,
+        max_guilds: int = MAX_CACHED_GUILDS,
+        max_members: int = MAX_CACHED_MEMBERS,
+    ):
+        self.ttl = ttl
+        self.max_guilds = max_guilds
+        self.max_members = max_members
+        # Owners given to the bot when it was created, see `install`.
+        self._explicit_owner_ids: frozenset[int] = frozenset()
+        self._owner_ids: frozenset[int] = frozenset()
+        self._owners_expire = 0.0
+        self._owners_lock = asyncio.Lock()
+        # guild id -> (channel id or None, member id) -> (role ids, permissions)
+        self._guilds: OrderedDict[
+            int,
+            OrderedDict[
+                tuple[int | None, int], tuple[tuple[int, ...], discord.Permissions]
+            ],
+        ] = OrderedDict()
+
+    async def owner_ids(self, bot) -> frozenset[int]:
+        # Owners set explicitly on the bot always win, as in `Bot.is_owner`.
+        # Those it fetched later itself do not, or they would never expire.
+        if self._explicit_owner_ids:
+            return self._explicit_owner_ids
+        if time.monotonic() < self._owners_expire:
+            return self._owner_ids
+        async with self._owners_lock:
+            if time.monotonic() >= self._owners_expire:
+                app = await bot.application_info()
+                if app.team:
+                    self._owner_ids = frozenset(m.id for m in app.team.members)
+                else:
+                    self._owner_ids = frozenset((app.owner.id,))
+                self._owners_expire = time.monotonic() + self.ttl
+        return self._owner_ids
+
+    async def is_owner(self, bot, user: discord.abc.Snowflake) -> bool:
+        return user.id in await self.owner_ids(bot)
+
+    def _resolve(self, guild_id: int, channel, member: discord.Member, resolve):
+        key = (None if channel is None else channel.id, member.id)
+        roles = tuple(member._roles)
+        entries = self._guilds.get(guild_id)
+        if entries is None:
+            entries = self._guilds[guild_id] = OrderedDict()
+            if len(self._guilds) > self.max_guilds:
+                self._guilds.popitem(last=False)
+        else:
+            self._guilds.move_to_end(guild_id)
+            cached = entries.get(key)
+            if cached is not None and cached[0] == roles:
+                entries.move_to_end(key)
+                return cached[1]
+        permissions = resolve()
+        entries[key] = (roles, permissions)
+        entries.move_to_end(key)
+        if len(entries) > self.max_members:
+            entries.popitem(last=False)
+        return permissions
+
+    def guild_permissions(self, member: discord.Member) -> discord.Permissions:
+        return self._resolve(
+            member.guild.id, None, member, lambda: member.guild_permissions
+        )
+
+    def channel_permissions(self, channel, member) -> discord.Permissions:
+        guild = getattr(channel, "guild", None)
+        if guild is None or not isinstance(member, discord.Member):
+            return channel.permissions_for(member)
+        return self._resolve(
+            guild.id, channel, member, lambda: channel.permissions_for(member)
+        )
+
+    def invalidate_guild(self, guild_id: int):
+        self._guilds.pop(guild_id, None)
+
+    def invalidate_member(self, guild_id: int, member_id: int):
+        entries = self._guilds.get(guild_id)
+        if entries:
+            for key in [key for key in entries if key[1] == member_id]:
+                del entries[key]
+
+    def install(self, bot):
+        """Invalidates cached permissions from `bot`'s gateway events.
+
+        Call this right after creating the bot: the owners it was given then
+        are used instead of fetching them.
+        """
+        if bot.owner_id:
+            self._explicit_owner_ids = frozenset((bot.owner_id,))
+        elif bot.owner_ids:
+            self._explicit_owner_ids = frozenset(bot.owner_ids)
+
+        async def on_member_update(before, after):
+            self.invalidate_member(after.guild.id, after.id)
+
+        async def on_member_remove(member):
+            self.invalidate_member(member.guild.id, member.id)
+
+        async def on_guild_role_change(role, after=None):
+            self.invalidate_guild(role.guild.id)
+
+        async def on_guild_channel_change(channel, after=None):
+            self.invalidate_guild(channel.guild.id)
+
+        async def on_guild_update(before, after):
+            self.invalidate_guild(after.id)
+
+        async def on_guild_remove(guild):
+            self.invalidate_guild(guild.id)
+
+        bot.add_listener(on_member_update)
+        bot.add_listener(on_member_remove)
+        for event in ("create", "delete", "update"):
+            bot.add_listener(on_guild_role_change, f"on_guild_role_{event}")
+            bot.add_listener(on_guild_channel_change, f"on_guild_channel_{event}")
+        bot.add_listener(on_guild_update)
+        bot.add_listener(on_guild_remove)
+
+
+cache = PermissionCache()
+
+
 async def check_permissions(ctx, perms, *, check=all):
-    is_owner = await ctx.bot.is_owner(ctx.author)
+    is_owner = await cache.is_owner(ctx.bot, ctx.author)
     if is_owner:
         return True
 
-    resolved = ctx.channel.permissions_for(ctx.author)
+    resolved = cache.channel_permissions(ctx.channel, ctx.author)
     return check(
         getattr(resolved, name, None) == value for name, value in perms.items()
     )
 
 
+def is_owner():
+    """Like `commands.is_owner`, but with owners cached for `OWNER_TTL` seconds."""
+
+    async def pred(ctx):
+        if not await cache.is_owner(ctx.bot, ctx.author):
+            raise commands.NotOwner("You do not own this bot.")
+        return True
+
+    return commands.check(pred)
+
+
 def has_permissions(*, check=all, **perms):
     async def pred(ctx):
         return await check_permissions(ctx, perms, check=check)
@@ -28,14 +191,14 @@ def has_permissions(*, check=all, **perms):
 
 
 async def check_guild_permissions(ctx, perms, *, check=all):
-    is_owner = await ctx.bot.is_owner(ctx.author)
+    is_owner = await cache.is_owner(ctx.bot, ctx.author)
     if is_owner:
         return True
 
     if ctx.guild is None:
         return False
 
-    resolved = ctx.author.guild_permissions
+    resolved = cache.guild_permissions(ctx.author)
     return check(
         getattr(resolved, name, None) == value for name, value in perms.items()
     )
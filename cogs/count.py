@@ -1,16 +1,51 @@
+import asyncio
 import logging
-import sqlite3
+import math
+import os
+import tempfile
+import time
 import warnings
+from datetime import UTC, datetime
 from enum import Enum, auto
 
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord.ext.commands.context import Context
 from discord.message import Message
 from discord.ui import Item
 
+from cogs import checks
+from utils import handoff
+from utils.backends import open_backend
+from utils.backfill import Backfill
+from utils.config import load_settings
+from utils.counters import CounterStore
+from utils.edits import EditCoalescer
+from utils.matcher import Pattern, PatternError, PatternTable
+from utils.metrics import BUTTON_LATENCY
+from utils.outbound import OutboundScheduler, Priority
+from utils.storage import (
+    DEFAULT_NAME,
+    BackfillJob,
+    CounterKey,
+    CountingStorage,
+    EventRow,
+)
+from utils.sweeper import DeadMessageSweeper
+from utils.throttle import ClickThrottle
+from utils.transfer import FORMATS, POLICIES, TABLES, TransferError
+
 logger = logging.getLogger(__name__)
 
+# Names go into button custom ids, which Discord limits to 100 characters.
+MAX_NAME_LENGTH = 32
+CHANGED_MEANWHILE = (
+    "The counter was changed by someone else in the meantime, try again."
+)
+NOT_IN_SQLITE = (
+    "Counters are stored in the {} backend, only their history can be transferred."
+)
+
 
 class ConfirmDeny(Enum):
     CONFIRM = auto()
@@ -25,15 +60,24 @@ class ButtonType(Enum):
 def create_count_embed(
     count: int,
     description: str = "Counting the number of times squid uses 'slay' unironically.",
+    name: str = DEFAULT_NAME,
 ) -> discord.Embed:
     """Creates a counting embed."""
     field = discord.EmbedField(name="Value", value=str(count))
-    embed = discord.Embed(
-        title="Current count", description=description, fields=[field]
-    )
+    title = "Current count" if name == DEFAULT_NAME else f"Current count: {name}"
+    embed = discord.Embed(title=title, description=description, fields=[field])
     return embed
 
 
+def check_name(name: str) -> str | None:
+    """Returns why `name` cannot name a counter, or None if it can."""
+    if not 0 < len(name) <= MAX_NAME_LENGTH:
+        return f"Counter names must be 1 to {MAX_NAME_LENGTH} characters long."
+    if ":" in name:
+        return "Counter names cannot contain `:`."
+    return None
+
+
 class ConfirmationView(discord.ui.View):
     """A confirmation/denial view for certain overwriting operations."""
 
@@ -62,16 +106,75 @@ class ConfirmationView(discord.ui.View):
         )
 
 
-class IncrementButton(discord.ui.Button):
-    """A button that can increment/decrement a count for any view."""
+class HistoryView(discord.ui.View):
+    """Pages through a counter's events, newest first."""
 
     def __init__(
         self,
-        guild_id: int,
-        message_id: int | None,
-        type: ButtonType,
-        con: sqlite3.Connection,
+        storage: CountingStorage,
+        key: CounterKey,
+        *,
+        page_size: int = 10,
+        checkpoint: tuple[float, int, int] | None = None,
     ):
+        super().__init__(timeout=180, disable_on_timeout=True)
+        self.storage = storage
+        self.key = key
+        self.page_size = page_size
+        self.checkpoint = checkpoint
+        self.rows: list[EventRow] = []
+
+    async def load_page(self, older: bool = True):
+        """Loads the page before/after the current one, keyed on (ts, id)."""
+        cursor = None
+        if self.rows:
+            event_id, _, _, ts, _ = self.rows[-1] if older else self.rows[0]
+            cursor = (ts, event_id)
+        rows = await self.storage.history(
+            self.key, cursor, older=older, limit=self.page_size
+        )
+        # Stay on the current page when there is nothing further to show.
+        if rows or not self.rows:
+            self.rows = rows
+
+    def create_embed(self) -> discord.Embed:
+        lines = [
+            "<t:{}:f> {} {:+d} ({})".format(
+                int(ts), f"<@{user_id}>" if user_id is not None else "?", delta, source
+            )
+            for _, user_id, delta, ts, source in self.rows
+        ]
+        name = self.key[1]
+        embed = discord.Embed(
+            title="Count history" if name == DEFAULT_NAME else f"Count history: {name}",
+            description="\n".join(lines) if lines else "No changes recorded.",
+        )
+        if self.checkpoint is not None:
+            ts, delta, events = self.checkpoint
+            embed.set_footer(
+                text=f"{events} changes ({delta:+d}) before {time.strftime('%Y-%m-%d', time.gmtime(ts))} were compacted."
+            )
+        return embed
+
+    @discord.ui.button(label="Newer", style=discord.ButtonStyle.secondary, emoji="⬅️")
+    async def newer_callback(self, button, interaction: discord.Interaction):
+        await self.load_page(older=False)
+        await interaction.response.edit_message(embed=self.create_embed(), view=self)
+
+    @discord.ui.button(label="Older", style=discord.ButtonStyle.secondary, emoji="➡️")
+    async def older_callback(self, button, interaction: discord.Interaction):
+        await self.load_page(older=True)
+        await interaction.response.edit_message(embed=self.create_embed(), view=self)
+
+
+class IncrementButton(discord.ui.Button):
+    """A button that can increment/decrement a count for any view.
+
+    The button holds no state: clicks are routed by `Counting.on_interaction`
+    using the `{guild_id}::{name}::{type}` custom id.
+    """
+
+    def __init__(self, guild_id: int, type: ButtonType, name: str = DEFAULT_NAME):
         match type:
             case ButtonType.INCREMENT:
                 style = discord.ButtonStyle.primary
@@ -86,97 +189,28 @@ class IncrementButton(discord.ui.Button):
             label=label,
             style=style,
             emoji=emoji,
-            custom_id=f"{guild_id}::{type}",
+            custom_id=f"{guild_id}::{name}::{type}",
         )
-        self.guild_id = guild_id
-        self.message_id: int
-        if message_id:
-            self.message_id = message_id
-        self.button_type = type
-
-    def post_init_message_id(self, message_id: int):
-        self.message_id = message_id
-
-    async def callback(self, interaction: discord.Interaction):
-        assert interaction.guild_id is not None
-        # NOTE: This button should not even exist if the initial pinned message is not set.
-        con = sqlite3.connect("cache.db")
-        cur = con.cursor()
-        try:
-            assert interaction.channel is not None
-            assert isinstance(interaction.channel, discord.TextChannel)
-            assert interaction.user is not None
-            message = await interaction.channel.fetch_message(self.message_id)
-            update_query = "UPDATE counting SET count = count {} 1, active = TRUE WHERE server_id = ?"
-            match self.button_type:
-                case ButtonType.INCREMENT:
-                    update_query = update_query.format("+")
-                case ButtonType.DECREMENT:
-                    update_query = update_query.format("-")
-
-            cur.execute(update_query, (self.guild_id,))
-            con.commit()
-            select_query = "SELECT count FROM counting WHERE server_id = ?"
-            count, *_ = cur.execute(select_query, (self.guild_id,)).fetchone()
-            con.commit()
-            embed = create_count_embed(count)
-            await message.edit(embed=embed)
-            await interaction.response.send_message(
-                "Count updated.", ephemeral=True, delete_after=15
-            )
 
-            # Log the event.
-            logger.info(
-                "Server %d: %s %s the count",
-                interaction.guild_id,
-                (
-                    interaction.user.global_name
-                    if interaction.user.global_name is not None
-                    else interaction.user.id
-                ),
-                (
-                    "incremented"
-                    if self.button_type == ButtonType.INCREMENT
-                    else "decremented"
-                ),
-            )
 
-        except discord.NotFound as e:
-            logger.error("%s: message with id: %d not found.", e, self.message_id)
-            await interaction.response.send_message(
-                "Original pinned message not found. Resetting state.",
-                ephemeral=True,
-                delete_after=15,
-            )
-            cur.execute(
-                "UPDATE counting SET active = FALSE WHERE server_id = ?",
-                (self.guild_id,),
-            )
-            con.commit()
-        except discord.Forbidden as e:
-            logger.error("%s: message with id: %d forbidden.", e, self.message_id)
-            await interaction.response.send_message(
-                "Original pinned message is no longer accessible by the bot. Resetting state.",
-                ephemeral=True,
-                delete_after=15,
-            )
-            cur.execute(
-                "UPDATE counting SET active = FALSE WHERE server_id = ?",
-                (self.guild_id,),
-            )
-            con.commit()
-        except discord.HTTPException as e:
-            logger.error("%s: HTTP error %d.", e, e.status)
-            await interaction.response.send_message(
-                f"HTTP error with code: {e.status}. Try again later.",
-                ephemeral=True,
-                delete_after=15,
-            )
-        except Exception as e:
-            logger.error("%s", e)
-            raise e
-        finally:
-            con.close()
+_BUTTON_TYPES = {str(button_type): button_type for button_type in ButtonType}
+
+
+def parse_custom_id(custom_id: str) -> tuple[CounterKey, ButtonType] | None:
+    """Parses an `IncrementButton` custom id into its counter key and button type.
+
+    Buttons sent before named counters existed, `{guild_id}::{type}`, belong to
+    the guild's default counter.
+    """
+    guild_id, sep, rest = custom_id.partition("::")
+    if not sep or not guild_id.isdigit():
+        return None
+    name, sep, button_type = rest.rpartition("::")
+    if not sep:
+        name = DEFAULT_NAME
+    if button_type not in _BUTTON_TYPES:
+        return None
+    return (int(guild_id), name), _BUTTON_TYPES[button_type]
 
 
 class Counting(commands.Cog, name="Counting"):
@@ -184,39 +218,125 @@ class Counting(commands.Cog, name="Counting"):
 
     def __init__(self, bot):
         self.bot = bot
-        self.con = sqlite3.connect("cache.db")
-        self.cur = self.con.cursor()
-        self.cur.execute(
-            "CREATE TABLE IF NOT EXISTS counting(server_id INTEGER PRIMARY KEY, message_id INTEGER, count INTEGER, active BOOLEAN NOT NULL CHECK (active IN (0, 1)))"
+        config = load_settings()
+        flush_interval = config.getfloat("COUNTING", "flush_interval", fallback=5.0)
+        flush_threshold = config.getint("COUNTING", "flush_threshold", fallback=100)
+        edit_window = config.getfloat("COUNTING", "edit_window", fallback=1.0)
+        state = handoff.take(__name__)
+        if state is not None:
+            # Reloaded: adopt the live counters, pending writes, scheduled edits
+            # and patterns, only picking up new settings and code.
+            self.store, self.edits, self.patterns = state
+            self.store.flush_interval = flush_interval
+            self.store.flush_threshold = flush_threshold
+            self.edits.window = edit_window
+            if self.edits.outbound is None:
+                self.edits.outbound = OutboundScheduler()
+        else:
+            storage = CountingStorage("cache.db")
+            self.store = CounterStore(
+                storage,
+                backend=open_backend(config, storage),
+                flush_interval=flush_interval,
+                flush_threshold=flush_threshold,
+            )
+            self.edits = EditCoalescer(
+                create_count_embed,
+                window=edit_window,
+                on_gone=self.store.deactivate,
+                outbound=OutboundScheduler(),
+            )
+            self.patterns = PatternTable(self.store.storage)
+        self.edits.render = lambda key, count: create_count_embed(count, name=key[1])
+        # Button acknowledgements go out ahead of the counter edits and messages.
+        self.outbound = self.edits.outbound
+        self.history_retention = 86400 * config.getfloat(
+            "COUNTING", "history_retention_days", fallback=30
         )
-        self.con.commit()
+        self.backfill_workers = config.getint(
+            "COUNTING", "backfill_workers", fallback=3
+        )
+        self.backfills: dict[CounterKey, asyncio.Task] = {}
+        self.sweeper = DeadMessageSweeper(
+            bot,
+            self.store,
+            self.edits,
+            self.outbound,
+            batch_size=config.getint("COUNTING", "sweep_batch_size", fallback=50),
+            workers=config.getint("COUNTING", "sweep_workers", fallback=3),
+        )
+        # Hours between sweeps, 0 turning them off.
+        self.sweep_interval = config.getfloat(
+            "COUNTING", "sweep_interval_hours", fallback=6
+        )
+        if self.sweep_interval > 0:
+            self.sweep_dead_messages.change_interval(hours=self.sweep_interval)
+        self.throttle = None
+        if config.getboolean("THROTTLE", "enabled", fallback=True):
+            self.throttle = ClickThrottle(
+                config.getfloat("THROTTLE", "user_rate", fallback=2.0),
+                config.getfloat("THROTTLE", "user_burst", fallback=5),
+                config.getfloat("THROTTLE", "guild_rate", fallback=20.0),
+                config.getfloat("THROTTLE", "guild_burst", fallback=40),
+                max_keys=config.getint("THROTTLE", "max_tracked", fallback=10_000),
+            )
+        if state is not None and bot is not None and bot.is_ready():
+            # on_ready will not fire again, so restart the background work now.
+            asyncio.get_running_loop().create_task(self.on_ready())
+
+    def cog_unload(self):
+        self.compact_history.cancel()
+        self.sweep_dead_messages.cancel()
+        # Backfills save their progress as they go and resume on the next start.
+        for task in self.backfills.values():
+            task.cancel()
+        if handoff.is_reloading(__name__):
+            handoff.put(
+                __name__, (self.store, self.edits, self.patterns), self.close_state
+            )
+        else:
+            self.close_state()
 
-    async def cog_before_invoke(self, ctx):
-        self.con = sqlite3.connect("cache.db")
-        self.cur = self.con.cursor()
+    def close_state(self):
+        self.edits.close()
+        self.outbound.close()
+        self.store.close()
 
-    async def cog_after_invoke(self, ctx):
-        self.con.close()
-        del self.cur
+    async def cog_before_invoke(self, ctx):
+        await self.store.load()
+        await self.patterns.load()
 
-    @commands.slash_command(description="Initialises the count for the server.")
-    async def init_counter(self, ctx: "Context", initial_value: int):
+    @commands.slash_command(description="Initialises a count for the server.")
+    async def init_counter(
+        self, ctx: "Context", initial_value: int, name: str = DEFAULT_NAME
+    ):
         assert ctx.guild is not None
 
-        res: tuple[int, int, int, bool] | None = self.cur.execute(
-            "SELECT * FROM counting WHERE ? = server_id", (ctx.guild.id,)
-        ).fetchone()
-        if res is None:
-            await self.create_count(ctx, initial_value)
+        name = name.strip()
+        error = check_name(name)
+        if error is not None:
+            await ctx.respond(error, ephemeral=True)
+            return
+        key = (ctx.guild.id, name)
+        state = self.store.get(key)
+        # Commands in other guilds, and the confirmation below, can interleave
+        # with this one, so it only writes if the counter is still as read here.
+        version = state.version if state is not None else 0
+        if state is None or state.message_id is None:
+            await self.create_count(ctx, initial_value, name, version)
         else:
-            await self.handle_override(ctx, res[2], res[1], initial_value)
+            await self.handle_override(
+                ctx, key, state.count, state.message_id, initial_value, version
+            )
 
     async def handle_override(
         self,
         ctx: "Context",
+        key: CounterKey,
         count: int,
         message_id: int,
         initial_value: int,
+        version: int,
     ):
         """Handles the case where an original counting message exists and will be overwritten."""
         # GUARD: Check that the original count message can be retrieved.
@@ -240,14 +360,14 @@ class Counting(commands.Cog, name="Counting"):
                 view=None,
             )
 
-            await self.update_count(ctx, initial_value, count_msg)
+            await self.update_count(ctx, key, initial_value, count_msg, version)
 
             return
         except (discord.NotFound, discord.Forbidden) as e:
             await ctx.reply(
                 "The original counting message could not be found. Check the bot's permissions and whether the original message exists. Resetting state."
             )
-            await self.create_count(ctx, initial_value)
+            await self.create_count(ctx, initial_value, key[1], version)
             warnings.warn(
                 f"{e}: Message with id: {message_id} not found or not accessible.",
                 stacklevel=2,
@@ -256,66 +376,480 @@ class Counting(commands.Cog, name="Counting"):
             await ctx.reply(f"HTTP error with code: {e.status}. Try again later.")
             return
 
-    async def update_count(self, ctx: "Context", count: int, count_msg: Message):
-        """Handles the case where the count is simply updated."""
-        embed = create_count_embed(count)
+    async def update_count(
+        self,
+        ctx: "Context",
+        key: CounterKey,
+        count: int,
+        count_msg: Message,
+        version: int | None = None,
+    ):
+        """Handles the case where the count is simply updated.
+
+        With a `version`, the count is only updated if the counter is still at
+        that version.
+        """
+        if not await self.store.set_counter(
+            key,
+            count_msg.id,
+            count,
+            channel_id=ctx.channel.id,
+            user_id=ctx.author.id,
+            expected_version=version,
+        ):
+            await ctx.respond(CHANGED_MEANWHILE, ephemeral=True)
+            return
+        embed = create_count_embed(count, name=key[1])
+        self.edits.forget(key)
         await count_msg.edit(embed=embed)
-        self.cur.execute(
-            "UPDATE counting SET message_id = ?, count = ?, active = TRUE WHERE server_id = ?",
-            (count_msg.id, count, ctx.guild.id),
-        )
-        self.con.commit()
-
-    async def create_count(self, ctx: "Context", count: int):
-        """Handles the case where a new count needs to be created."""
-        embed = create_count_embed(count)
-        view = discord.ui.View(timeout=None)
-        decrement = IncrementButton(
-            ctx.guild.id, None, ButtonType.DECREMENT, sqlite3.connect("cache.db")
-        )
-        increment = IncrementButton(
-            ctx.guild.id, None, ButtonType.INCREMENT, sqlite3.connect("cache.db")
+
+    async def create_count(
+        self,
+        ctx: "Context",
+        count: int,
+        name: str = DEFAULT_NAME,
+        version: int | None = None,
+    ):
+        """Handles the case where a new count needs to be created.
+
+        With a `version`, the counter is only created if it is still at that
+        version, and the new message is deleted otherwise.
+        """
+        key = (ctx.guild.id, name)
+        embed = create_count_embed(count, name=name)
+        view = discord.ui.View(
+            IncrementButton(ctx.guild.id, ButtonType.DECREMENT, name),
+            IncrementButton(ctx.guild.id, ButtonType.INCREMENT, name),
+            timeout=None,
         )
-        view.add_item(decrement)
-        view.add_item(increment)
         count_msg = await ctx.reply(embed=embed, view=view)
-        decrement.post_init_message_id(count_msg.id)
-        increment.post_init_message_id(count_msg.id)
-        if (
-            self.cur.execute(
-                "SELECT * FROM counting WHERE server_id = ?", (ctx.guild.id,)
-            ).fetchone()
-            is None
+        # Clicks are routed by `on_interaction`, so the view need not be kept around.
+        view.stop()
+        if not await self.store.set_counter(
+            key,
+            count_msg.id,
+            count,
+            channel_id=ctx.channel.id,
+            user_id=ctx.author.id,
+            expected_version=version,
         ):
-            self.cur.execute(
-                "INSERT INTO counting (server_id, message_id, count, active) VALUES (?, ?, ?, TRUE)",
-                (ctx.guild.id, count_msg.id, count),
+            await count_msg.delete(reason="Counter changed meanwhile.")
+            await ctx.respond(CHANGED_MEANWHILE, ephemeral=True)
+            return
+        self.edits.forget(key)
+
+    @commands.slash_command(description="Shows who changed a count and when.")
+    async def count_history(
+        self, ctx: "Context", page_size: int = 10, name: str = DEFAULT_NAME
+    ):
+        assert ctx.guild is not None
+
+        key = (ctx.guild.id, name.strip())
+        # Make sure the latest clicks are visible.
+        await self.store.flush()
+        view = HistoryView(
+            self.store.storage,
+            key,
+            page_size=max(1, min(page_size, 25)),
+            checkpoint=await self.store.storage.checkpoint(key),
+        )
+        await view.load_page()
+        await ctx.respond(embed=view.create_embed(), view=view, ephemeral=True)
+
+    @commands.slash_command(description="Shows the highest counts.")
+    async def leaderboard(
+        self, ctx: "Context", all_servers: bool = False, limit: int = 10
+    ):
+        # Make sure the latest clicks are ranked.
+        await self.store.flush()
+        server_id = None if all_servers or ctx.guild is None else ctx.guild.id
+        rows = await self.store.leaderboard(server_id, max(1, min(limit, 25)))
+        lines = []
+        for rank, (guild_id, name, count) in enumerate(rows, start=1):
+            line = f"{rank}. **{name}**: {count}"
+            if server_id is None:
+                guild = self.bot.get_guild(guild_id) if self.bot is not None else None
+                line += f" ({guild.name if guild is not None else guild_id})"
+            lines.append(line)
+        embed = discord.Embed(
+            title="Leaderboard" if server_id is None else "Server leaderboard",
+            description="\n".join(lines) if lines else "No counters yet.",
+        )
+        await ctx.respond(embed=embed)
+
+    def _transferable(self, table: str) -> bool:
+        # Only the history is in cache.db when the counters are stored elsewhere.
+        return table != "counters" or self.store.backend.name == "sqlite"
+
+    @commands.slash_command(description="Exports the counters or their history.")
+    @checks.is_owner()
+    async def export_counts(
+        self, ctx: "Context", table: str = "counters", format: str = "csv"
+    ):
+        if table not in TABLES or format not in FORMATS:
+            await ctx.respond(
+                f"Tables: {', '.join(TABLES)}. Formats: {', '.join(FORMATS)}.",
+                ephemeral=True,
+            )
+            return
+        if not self._transferable(table):
+            await ctx.respond(
+                NOT_IN_SQLITE.format(self.store.backend.name), ephemeral=True
             )
+            return
+        await self.outbound.acknowledge(lambda: ctx.defer(ephemeral=True))
+        # Make sure the latest clicks are exported.
+        await self.store.flush()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, f"{table}.{format}")
+            rows = await self.store.storage.export(table, path)
+            try:
+                await ctx.respond(
+                    f"Exported {rows} rows of {table}.", file=discord.File(path)
+                )
+            except discord.HTTPException as e:
+                await ctx.respond(
+                    f"HTTP error with code: {e.status}. Large tables can be exported with `python -m utils.transfer`."
+                )
+
+    @commands.slash_command(description="Imports counters or their history.")
+    @checks.is_owner()
+    async def import_counts(
+        self,
+        ctx: "Context",
+        file: discord.Attachment,
+        table: str = "counters",
+        on_conflict: str = "skip",
+    ):
+        if table not in TABLES or on_conflict not in POLICIES:
+            await ctx.respond(
+                f"Tables: {', '.join(TABLES)}. Conflict policies: {', '.join(POLICIES)}.",
+                ephemeral=True,
+            )
+            return
+        if not self._transferable(table):
+            await ctx.respond(
+                NOT_IN_SQLITE.format(self.store.backend.name), ephemeral=True
+            )
+            return
+        await self.outbound.acknowledge(lambda: ctx.defer(ephemeral=True))
+        # Pending clicks are written first, so the import applies on top of them.
+        await self.store.flush()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, os.path.basename(file.filename))
+            await file.save(path)
+            try:
+                rows = await self.store.storage.import_file(table, path, on_conflict)
+            except TransferError as e:
+                await ctx.respond(str(e))
+                return
+        if table == "counters":
+            await self.store.reload()
+        await ctx.respond(f"Imported {rows} rows of {table}.")
+
+    @commands.slash_command(
+        description="Counts a word in every message, * at either end for partial words."
+    )
+    @checks.is_mod()
+    async def count_pattern(
+        self,
+        ctx: "Context",
+        pattern: str,
+        name: str = DEFAULT_NAME,
+    ):
+        assert ctx.guild is not None
+
+        name = name.strip()
+        state = self.store.get((ctx.guild.id, name))
+        if state is None or not state.active:
+            await ctx.respond(
+                f"There is no counter called {name}, create it with /init_counter first.",
+                ephemeral=True,
+            )
+            return
+        try:
+            await self.patterns.add(ctx.guild.id, Pattern(name, pattern))
+        except PatternError as e:
+            await ctx.respond(str(e), ephemeral=True)
+            return
+        await ctx.respond(f"Counting `{pattern}` towards {name}.", ephemeral=True)
+
+    @commands.slash_command(description="Stops counting a word.")
+    @checks.is_mod()
+    async def uncount_pattern(self, ctx: "Context", pattern: str):
+        assert ctx.guild is not None
+
+        if await self.patterns.remove(ctx.guild.id, pattern):
+            await ctx.respond(f"No longer counting `{pattern}`.", ephemeral=True)
         else:
-            self.cur.execute(
-                "UPDATE counting SET message_id = ?, count = ?, active = TRUE WHERE server_id = ?",
-                (count_msg.id, count, ctx.guild.id),
+            await ctx.respond(f"`{pattern}` was not being counted.", ephemeral=True)
+
+    @commands.slash_command(description="Lists the words being counted.")
+    async def counted_patterns(self, ctx: "Context"):
+        assert ctx.guild is not None
+
+        lines = [
+            f"`{p.pattern}`: {p.name}" for p in self.patterns.patterns(ctx.guild.id)
+        ]
+        await ctx.respond(
+            "\n".join(lines) if lines else "No patterns are being counted.",
+            ephemeral=True,
+        )
+
+    @commands.slash_command(
+        description="Counts a counter's patterns in the existing channel history."
+    )
+    @checks.is_mod()
+    async def backfill(self, ctx: "Context", name: str = DEFAULT_NAME):
+        assert ctx.guild is not None
+
+        name = name.strip()
+        key = (ctx.guild.id, name)
+        state = self.store.get(key)
+        if state is None or not state.active:
+            await ctx.respond(
+                f"There is no counter called {name}, create it with /init_counter first.",
+                ephemeral=True,
+            )
+            return
+        if not any(p.name == name for p in self.patterns.patterns(ctx.guild.id)):
+            await ctx.respond(
+                f"No patterns are counted towards {name}, add some with /count_pattern first.",
+                ephemeral=True,
+            )
+            return
+        if key in self.backfills:
+            await ctx.respond(f"{name} is already being backfilled.", ephemeral=True)
+            return
+        job = await self.store.storage.start_backfill(
+            key, ctx.channel.id, ctx.author.id
+        )
+        if job is None:
+            await ctx.respond(
+                f"Every pattern of {name} was already backfilled.",
+                ephemeral=True,
             )
-        self.con.commit()
+            return
+        self.start_backfill(ctx.guild, key, job)
+        await ctx.respond(
+            f"Backfilling {name} from the channel history, this can take a while."
+        )
+
+    def start_backfill(self, guild: discord.Guild, key: CounterKey, job: BackfillJob):
+        task = asyncio.create_task(self.run_backfill(guild, key, job))
+        self.backfills[key] = task
+        task.add_done_callback(lambda _: self.backfills.pop(key, None))
+
+    async def run_backfill(
+        self, guild: discord.Guild, key: CounterKey, job: BackfillJob
+    ):
+        """Scans the server's readable channels, then adds the matches to the counter."""
+        channel_id, user_id, patterns = job
+        # Messages since a pattern went live were already counted, so each
+        # pattern is only backfilled in the messages before then.
+        untils = {
+            pattern: discord.utils.time_snowflake(datetime.fromtimestamp(since, UTC))
+            for pattern, since in patterns.items()
+        }
+        backfill = Backfill(
+            self.store.storage, key, untils, workers=self.backfill_workers
+        )
+        try:
+            await backfill.run(
+                channel
+                for channel in guild.text_channels
+                if channel.permissions_for(guild.me).read_message_history
+            )
+        except discord.HTTPException as e:
+            # The progress so far is saved, so the next start resumes from it.
+            logger.error("%s: backfill of server %d failed.", e, key[0])
+            return
+        total = await self.store.finish_backfill(key, user_id=user_id)
+        logger.info(
+            "Server %d: backfilled %d matches of %s from %d messages.",
+            key[0],
+            total,
+            key[1],
+            backfill.scanned,
+        )
+        state = self.store.get(key)
+        if state is not None and state.message_id is not None and state.channel_id:
+            self.edits.publish(
+                key,
+                self.bot.get_partial_messageable(state.channel_id),
+                state.message_id,
+                state.count,
+            )
+        channel = guild.get_channel(channel_id) if channel_id is not None else None
+        if isinstance(channel, discord.TextChannel):
+            try:
+                await self.outbound.send(
+                    channel.id,
+                    lambda: channel.send(
+                        f"Backfill of {key[1]} done, {total} matches were added."
+                    ),
+                    Priority.MESSAGE,
+                )
+            except discord.HTTPException as e:
+                logger.error("%s: HTTP error %d.", e, e.status)
+
+    @tasks.loop(hours=1)
+    async def compact_history(self):
+        """Folds events past the retention period into per-counter checkpoints."""
+        folded = await self.store.storage.compact(time.time() - self.history_retention)
+        if folded:
+            logger.info("Compacted %d counter events.", folded)
+
+    @tasks.loop(hours=6)
+    async def sweep_dead_messages(self):
+        """Deactivates the counters whose message is gone, ahead of any click."""
+        await self.sweeper.sweep()
 
     @commands.Cog.listener()
     async def on_ready(self):
-        """Attach the views to the persistent buttons."""
-        res: list[tuple[int, int]] = self.cur.execute(
-            "SELECT server_id, message_id FROM counting WHERE active = TRUE"
-        ).fetchall()
-        for server_id, message_id in res:
-            view = discord.ui.View(timeout=None)
-            decrement = IncrementButton(
-                server_id, message_id, ButtonType.DECREMENT, sqlite3.connect("cache.db")
+        """Load the counters and patterns so clicks and messages can be served."""
+        await self.store.load()
+        await self.patterns.load()
+        self.store.start()
+        if not self.compact_history.is_running():
+            self.compact_history.start()
+        if self.sweep_interval > 0 and not self.sweep_dead_messages.is_running():
+            self.sweep_dead_messages.start()
+        for key in await self.store.storage.backfills():
+            guild = self.bot.get_guild(key[0])
+            if guild is not None and key not in self.backfills:
+                # The backfill exists, so this returns it rather than a new one.
+                job = await self.store.storage.start_backfill(key)
+                if job is not None:
+                    self.start_backfill(guild, key, job)
+
+    @commands.Cog.listener()
+    async def on_message(self, message: discord.Message):
+        """Count the server's patterns in every message."""
+        if message.guild is None or message.author.bot or not message.content:
+            return
+        await self.store.load()
+        await self.patterns.load()
+        matcher = self.patterns.matcher(message.guild.id)
+        if matcher is None:
+            return
+        for name, matches in matcher.count(message.content).items():
+            key = (message.guild.id, name)
+            # Writes are batched by the store and edits coalesced per counter, so
+            # a busy server costs one write and one edit per window.
+            count = self.store.increment(
+                key, matches, user_id=message.author.id, source="message"
+            )
+            if count is None:
+                continue
+            state = self.store.get(key)
+            if state is None or state.message_id is None or state.channel_id is None:
+                continue
+            if state.channel_id == message.channel.id:
+                channel = message.channel
+            else:
+                channel = self.bot.get_partial_messageable(state.channel_id)
+            self.edits.publish(key, channel, state.message_id, count)
+
+    @commands.Cog.listener()
+    async def on_interaction(self, interaction: discord.Interaction):
+        """Route every counter button click, whichever message it came from."""
+        if (
+            interaction.type != discord.InteractionType.component
+            or interaction.custom_id is None
+        ):
+            return
+        parsed = parse_custom_id(interaction.custom_id)
+        if parsed is None:
+            return
+        key, button_type = parsed
+        await self.handle_click(interaction, key, button_type)
+
+    async def handle_click(
+        self,
+        interaction: discord.Interaction,
+        key: CounterKey,
+        button_type: ButtonType,
+    ):
+        """Increments/decrements a count from a button click."""
+        started = time.perf_counter()
+        await self.store.load()
+        try:
+            assert interaction.channel is not None
+            assert isinstance(interaction.channel, discord.TextChannel)
+            assert interaction.user is not None
+            match button_type:
+                case ButtonType.INCREMENT:
+                    delta = 1
+                case ButtonType.DECREMENT:
+                    delta = -1
+
+            # Turn away autoclickers before the click costs a write or an edit.
+            wait = (
+                self.throttle.acquire(interaction.user.id, key[0])
+                if self.throttle is not None
+                else 0.0
             )
-            view.add_item(decrement)
-            increment = IncrementButton(
-                server_id, message_id, ButtonType.INCREMENT, sqlite3.connect("cache.db")
+            if wait:
+                await self.outbound.acknowledge(
+                    lambda: interaction.response.send_message(
+                        # Rounded up, as a guild bucket often refills within 0.05s.
+                        f"Slow down, try again in {math.ceil(wait * 10) / 10:.1f}s.",
+                        ephemeral=True,
+                        delete_after=5,
+                    )
+                )
+                return
+
+            state = self.store.get(key)
+            count = self.store.increment(key, delta, user_id=interaction.user.id)
+            if state is None or state.message_id is None or count is None:
+                # The pinned message was found to be gone by an earlier edit.
+                logger.error("Server %d: pinned message of %s not found.", *key)
+                await self.outbound.acknowledge(
+                    lambda: interaction.response.send_message(
+                        "Original pinned message not found. Resetting state.",
+                        ephemeral=True,
+                        delete_after=15,
+                    )
+                )
+                return
+            self.store.learn_channel(key, interaction.channel.id)
+            # The edit is only queued here; the scheduler holds it back until
+            # the acknowledgement below has gone out.
+            self.edits.publish(key, interaction.channel, state.message_id, count)
+            await self.outbound.acknowledge(
+                lambda: interaction.response.send_message(
+                    "Count updated.", ephemeral=True, delete_after=15
+                )
+            )
+
+            # Log the event.
+            logger.info(
+                "Server %d: %s %s the count of %s",
+                key[0],
+                (
+                    interaction.user.global_name
+                    if interaction.user.global_name is not None
+                    else interaction.user.id
+                ),
+                (
+                    "incremented"
+                    if button_type == ButtonType.INCREMENT
+                    else "decremented"
+                ),
+                key[1],
+            )
+
+        except discord.HTTPException as e:
+            logger.error("%s: HTTP error %d.", e, e.status)
+        except Exception as e:
+            logger.error("%s", e)
+            raise e
+        finally:
+            BUTTON_LATENCY.observe(
+                time.perf_counter() - started, button=button_type.name.lower()
             )
-            view.add_item(increment)
-            self.bot.add_view(view)
-        self.con.close()
 
 
 def setup(bot):
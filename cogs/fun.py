@@ -1,49 +1,50 @@
-import json
+import asyncio
 import os
 import random
-from typing import Any
 
-import numpy as np
 from discord.ext import commands
 from discord.ext.commands.context import Context
 
+from utils import dice as dice_engine
+from utils import handoff
+from utils.box import min_box_length, render_box
+from utils.kvstore import KeyValueStore
+
+MAX_MESSAGE_LENGTH = 2000
+
 
 class Fun(commands.Cog, name="Fun"):
 
-    cache: dict[str, Any]
+    cache: KeyValueStore
 
     def __init__(self, bot):
         self.bot = bot
-        if not os.path.exists("cache.json"):
-            with open("cache.json", "w", encoding="utf-8") as f:
-                f.write("")
-
-        with open("cache.json", "r+", encoding="utf-8") as f:
-            try:
-                self.cache = json.load(f)
-            except json.JSONDecodeError:
-                self.cache = {}
-
-    async def save_cache(self):
-        with open("cache.json", "r+", encoding="utf-8") as f:
-            f.seek(0)
-            f.truncate(0)
-            json.dump(self.cache, f, sort_keys=True)
+        cache = handoff.take(__name__)
+        if cache is None:
+            cache = KeyValueStore("cache.db", "fun_cache")
+            if os.path.exists("cache.json"):
+                cache.migrate_json("cache.json")
+        self.cache = cache
+
+    def cog_unload(self):
+        if handoff.is_reloading(__name__):
+            handoff.put(__name__, self.cache, self.cache.close)
+        else:
+            self.cache.close()
 
     @commands.slash_command()
     async def roll(self, ctx, dice: str):
-        """Rolls dice in NdM format."""
+        """Rolls dice in NdM format, e.g. 4d6kh3+2."""
         try:
-            (rolls, limit) = map(int, dice.split("d"))
-        except Exception:
-            await ctx.reply("Format has to be in NdN!")
-            return
-        result = ", ".join((str(random.randint(1, limit)) for _ in range(rolls)))
-        try:
-            await ctx.reply(result)
-        except Exception:
-            await ctx.reply("Maximum length of bot text is 2000 characters")
+            terms = dice_engine.parse(dice)
+        except dice_engine.DiceError as e:
+            await ctx.reply(str(e))
             return
+        if dice_engine.dice_count(terms) > dice_engine.OFFLOAD_DICE:
+            results = await asyncio.to_thread(dice_engine.roll, terms)
+        else:
+            results = dice_engine.roll(terms)
+        await ctx.reply(dice_engine.format_results(results, MAX_MESSAGE_LENGTH))
 
     @commands.slash_command()
     async def choose(self, ctx, *choices: str):
@@ -119,32 +120,15 @@ class Fun(commands.Cog, name="Fun"):
     @commands.slash_command(aliases=["3dbox"])
     async def box(self, ctx: "Context", *, sentence: str):
         """🎲"""
-        if len(sentence) % 2 == 1:
-            diags = len(sentence) // 2 // 2
-        else:
-            diags = len(sentence[: len(sentence) // 2]) - 2
-        ret = np.full(
-            (len(sentence) + diags + 1, len(sentence) + diags + 1), " ", dtype=str
-        )
-        ret[0, : len(sentence)] = list(sentence)
-        ret[: len(sentence), 0] = list(sentence)
-        ret[len(sentence) - 1, : len(sentence)] = list(sentence)[::-1]
-        ret[: len(sentence), len(sentence) - 1] = list(sentence)[::-1]
-        ret = np.roll(ret, diags + 1, axis=0)
-        ret = np.roll(ret, diags + 1, axis=1)
-        ret[0, : len(sentence)] = list(sentence)
-        ret[: len(sentence), 0] = list(sentence)
-        ret[len(sentence) - 1, : len(sentence)] = list(sentence)[::-1]
-        ret[: len(sentence), len(sentence) - 1] = list(sentence)[::-1]
-        for i in range(diags):
-            char = "╲"
-            ret[i + 1, i + 1] = char
-            ret[i + 1, len(sentence) + i] = char
-            ret[len(sentence) + i, i + 1] = char
-            ret[len(sentence) + i, len(sentence) + i] = char
-        r = [" ".join(row).rstrip() for row in ret]
-        r = "\n".join(r)
-        r.replace("    ", "\t")
+        # Reject boxes that cannot fit in a message before drawing anything.
+        # The code block adds 8 characters.
+        if not sentence or min_box_length(len(sentence)) + 8 > MAX_MESSAGE_LENGTH:
+            await ctx.reply("Maximum length of bot text is 2000 characters")
+            return
+        r = render_box(sentence)
+        if len(r) + 8 > MAX_MESSAGE_LENGTH:
+            await ctx.reply("Maximum length of bot text is 2000 characters")
+            return
         await ctx.reply("```\n{}\n```".format(r))
 
     @box.error
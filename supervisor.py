@@ -0,0 +1,158 @@
+"""Runs the bot as several sharded worker processes and restarts them on exit.
+
+Usage: python supervisor.py [--workers N] [--shard-count N]
+Both default to the [SHARDING] section of settings.ini. A shard count of 0 asks
+Discord for its recommended count.
+"""
+
+import argparse
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+
+from utils.config import load_settings
+from utils.logging import LOGGING_FORMAT
+
+logger = logging.getLogger(__name__)
+
+# Restart delays double on each consecutive crash, up to this many seconds.
+MAX_BACKOFF = 60
+# A worker that ran this long is considered healthy again.
+HEALTHY_UPTIME = 60
+
+
+def recommended_shard_count(token: str) -> int:
+    """Asks Discord how many shards the bot should run."""
+    request = urllib.request.Request(
+        "https://discord.com/api/v10/gateway/bot",
+        headers={"Authorization": f"Bot {token}"},
+    )
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.load(response)["shards"]
+
+
+def split_shards(shard_count: int, workers: int) -> list[list[int]]:
+    """Splits shard ids into contiguous, evenly sized ranges."""
+    workers = max(1, min(workers, shard_count))
+    size, extra = divmod(shard_count, workers)
+    ranges = []
+    start = 0
+    for i in range(workers):
+        end = start + size + (1 if i < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+class Worker:
+    """A bot process running a fixed range of shards."""
+
+    def __init__(self, shard_ids: list[int], shard_count: int, metrics_port: int = 0):
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        # Workers share the host, so each serves its metrics on a port of its own.
+        self.metrics_port = metrics_port
+        self.process: subprocess.Popen | None = None
+        self.started = 0.0
+        self.backoff = 1.0
+        self.restart_at = 0.0
+
+    def start(self):
+        env = dict(
+            os.environ,
+            SHARD_IDS=",".join(map(str, self.shard_ids)),
+            SHARD_COUNT=str(self.shard_count),
+            METRICS_PORT=str(self.metrics_port),
+        )
+        self.process = subprocess.Popen([sys.executable, "bot.py"], env=env)
+        self.started = time.monotonic()
+        logger.info(
+            "Started worker %d for shards %s.", self.process.pid, self.shard_ids
+        )
+
+    def poll(self):
+        """Restarts the worker if it has exited, backing off on repeated crashes."""
+        now = time.monotonic()
+        if self.process is None:
+            if now >= self.restart_at:
+                self.start()
+            return
+        code = self.process.poll()
+        if code is None:
+            return
+        if now - self.started >= HEALTHY_UPTIME:
+            self.backoff = 1.0
+        logger.warning(
+            "Worker for shards %s exited with %d, restarting in %.0fs.",
+            self.shard_ids,
+            code,
+            self.backoff,
+        )
+        self.process = None
+        self.restart_at = now + self.backoff
+        self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+
+    def stop(self, timeout: float = 30):
+        if self.process is None or self.process.poll() is not None:
+            return
+        self.process.send_signal(signal.SIGINT)
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format=LOGGING_FORMAT)
+    if not os.path.exists("settings.ini"):
+        # Let a single bot process write the settings template.
+        subprocess.run([sys.executable, "bot.py"])
+        return
+    config = load_settings()
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--workers", type=int, default=config.getint("SHARDING", "workers", fallback=1)
+    )
+    parser.add_argument(
+        "--shard-count",
+        type=int,
+        default=config.getint("SHARDING", "shard_count", fallback=0),
+    )
+    args = parser.parse_args()
+
+    shard_count = args.shard_count or recommended_shard_count(config["SECRET"]["token"])
+    metrics_port = config.getint("METRICS", "port", fallback=0)
+    workers = [
+        Worker(shard_ids, shard_count, metrics_port + i if metrics_port else 0)
+        for i, shard_ids in enumerate(split_shards(shard_count, args.workers))
+    ]
+
+    stopping = False
+
+    def request_stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    for worker in workers:
+        worker.start()
+    while not stopping:
+        for worker in workers:
+            worker.poll()
+        time.sleep(1)
+
+    logger.info("Stopping %d workers.", len(workers))
+    for worker in workers:
+        worker.stop()
+
+
+if __name__ == "__main__":
+    main()
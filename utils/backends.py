@@ -0,0 +1,558 @@
+"""Where counters, their message ids and active flags are stored.
+
+The counter engine keeps every counter in memory and writes them through one
+of these backends, chosen with `[STORAGE] backend` in settings.ini:
+
+- `sqlite`: the cache.db file, the default;
+- `memory`: nothing outlives the process, for tests and throwaway bots;
+- `redis`: a Redis server, or anything speaking its protocol.
+
+Counter events, patterns and backfills always live in the sqlite storage.
+"""
+
+import asyncio
+import configparser
+import heapq
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+from utils.resp import RespClient, RespError
+from utils.storage import CounterKey, CounterRow, CountingStorage, Event, RankRow
+
+BACKENDS = ("sqlite", "memory", "redis")
+# Attempts at a compare-and-set whose watched counter only had its count moved.
+CAS_ATTEMPTS = 5
+
+
+class BackendError(Exception):
+    """Raised when a backend other than sqlite cannot be reached or fails."""
+
+
+class CountsError(BackendError):
+    """Raised when deltas' events were written to the history but their counts were not."""
+
+
+def _top(
+    rows: Iterable[CounterRow], server_id: int | None, limit: int
+) -> list[RankRow]:
+    return [
+        (row[0], row[1], row[3])
+        for row in heapq.nlargest(
+            limit,
+            (
+                row
+                for row in rows
+                if row[4] and (server_id is None or row[0] == server_id)
+            ),
+            key=lambda row: row[3],
+        )
+    ]
+
+
+class CounterBackend:
+    """Stores each counter's message id, count, active flag, channel and version.
+
+    Setting or deactivating a counter bumps its version, see
+    `CountingStorage.upsert_counter`. Events passed along with deltas are
+    appended to the sqlite `history`, before the counts unless both are
+    written in one transaction.
+    """
+
+    name = ""
+
+    def __init__(self, history: CountingStorage):
+        self.history = history
+
+    async def load(self) -> list[CounterRow]:
+        """Sets up the storage and returns every counter row."""
+        raise NotImplementedError
+
+    async def counter(self, key: CounterKey) -> CounterRow | None:
+        raise NotImplementedError
+
+    async def upsert_counter(
+        self,
+        key: CounterKey,
+        message_id: int,
+        count: int,
+        channel_id: int | None = None,
+        *,
+        expected_version: int | None = None,
+    ) -> int | None:
+        """Creates or overwrites a counter, see `CountingStorage.upsert_counter`."""
+        raise NotImplementedError
+
+    async def apply_deltas(
+        self, rows: Iterable[tuple[int, int, str]], events: Iterable[Event] = ()
+    ) -> dict[CounterKey, int]:
+        """Applies (delta, server_id, name) rows and returns the new counts.
+
+        Raises `CountsError` if only the events were written, so that only the
+        deltas are retried.
+        """
+        raise NotImplementedError
+
+    async def set_channels(self, rows: Iterable[tuple[int, int, str]]):
+        """Records the (channel_id, server_id, name) of counters without a channel."""
+        raise NotImplementedError
+
+    async def deactivate(self, key: CounterKey, delta: int = 0):
+        raise NotImplementedError
+
+    async def leaderboard(
+        self, server_id: int | None = None, limit: int = 10
+    ) -> list[RankRow]:
+        """Returns the highest active counters, of one server or of every server."""
+        raise NotImplementedError
+
+    def close(
+        self,
+        rows: Iterable[tuple[int, int, str]] = (),
+        events: Iterable[Event] = (),
+        channels: Iterable[tuple[int, int, str]] = (),
+    ):
+        """Applies any final deltas, events and channels, and closes the backend and history.
+
+        This blocks until everything is written, for use at shutdown.
+        """
+        raise NotImplementedError
+
+
+class SqliteCounters(CounterBackend):
+    """Counters in the `counting` table, next to their history.
+
+    Deltas and their events are written in one transaction.
+    """
+
+    name = "sqlite"
+
+    async def load(self) -> list[CounterRow]:
+        return await self.history.setup()
+
+    async def counter(self, key: CounterKey) -> CounterRow | None:
+        return await self.history.counter(key)
+
+    async def upsert_counter(
+        self,
+        key: CounterKey,
+        message_id: int,
+        count: int,
+        channel_id: int | None = None,
+        *,
+        expected_version: int | None = None,
+    ) -> int | None:
+        return await self.history.upsert_counter(
+            key, message_id, count, channel_id, expected_version=expected_version
+        )
+
+    async def apply_deltas(
+        self, rows: Iterable[tuple[int, int, str]], events: Iterable[Event] = ()
+    ) -> dict[CounterKey, int]:
+        return await self.history.apply_deltas(rows, events)
+
+    async def set_channels(self, rows: Iterable[tuple[int, int, str]]):
+        await self.history.set_channels(rows)
+
+    async def deactivate(self, key: CounterKey, delta: int = 0):
+        await self.history.deactivate(key, delta)
+
+    async def leaderboard(
+        self, server_id: int | None = None, limit: int = 10
+    ) -> list[RankRow]:
+        return await self.history.leaderboard(server_id, limit)
+
+    def close(
+        self,
+        rows: Iterable[tuple[int, int, str]] = (),
+        events: Iterable[Event] = (),
+        channels: Iterable[tuple[int, int, str]] = (),
+    ):
+        self.history.close(rows, events, channels)
+
+
+class MemoryCounters(CounterBackend):
+    """Counters in a dict, lost when the process exits.
+
+    Leaderboards go through every counter, which is fine for the few counters
+    of a test or throwaway bot but not for large numbers of servers.
+    """
+
+    name = "memory"
+
+    def __init__(self, history: CountingStorage):
+        super().__init__(history)
+        # key -> [message_id, count, active, channel_id, version]
+        self._counters: dict[CounterKey, list[Any]] = {}
+
+    def _rows(self) -> list[CounterRow]:
+        return [(*key, *fields) for key, fields in self._counters.items()]
+
+    async def load(self) -> list[CounterRow]:
+        # The history, patterns and backfills still need their tables.
+        await self.history.migrate()
+        return self._rows()
+
+    async def counter(self, key: CounterKey) -> CounterRow | None:
+        fields = self._counters.get(key)
+        return (*key, *fields) if fields is not None else None
+
+    async def upsert_counter(
+        self,
+        key: CounterKey,
+        message_id: int,
+        count: int,
+        channel_id: int | None = None,
+        *,
+        expected_version: int | None = None,
+    ) -> int | None:
+        fields = self._counters.get(key)
+        version = fields[4] if fields is not None else 0
+        if expected_version is not None and expected_version != version:
+            return None
+        self._counters[key] = [message_id, count, True, channel_id, version + 1]
+        return version + 1
+
+    def _apply(self, rows: Iterable[tuple[int, int, str]]) -> dict[CounterKey, int]:
+        counts = {}
+        for delta, server_id, name in rows:
+            fields = self._counters.get((server_id, name))
+            if fields is not None:
+                fields[1] += delta
+                counts[server_id, name] = fields[1]
+        return counts
+
+    async def apply_deltas(
+        self, rows: Iterable[tuple[int, int, str]], events: Iterable[Event] = ()
+    ) -> dict[CounterKey, int]:
+        events = list(events)
+        if events:
+            await self.history.apply_deltas((), events)
+        return self._apply(rows)
+
+    def _set_channels(self, rows: Iterable[tuple[int, int, str]]):
+        for channel_id, server_id, name in rows:
+            fields = self._counters.get((server_id, name))
+            if fields is not None and fields[3] is None:
+                fields[3] = channel_id
+
+    async def set_channels(self, rows: Iterable[tuple[int, int, str]]):
+        self._set_channels(rows)
+
+    async def deactivate(self, key: CounterKey, delta: int = 0):
+        fields = self._counters.get(key)
+        if fields is not None:
+            fields[1] += delta
+            fields[2] = False
+            fields[4] += 1
+
+    async def leaderboard(
+        self, server_id: int | None = None, limit: int = 10
+    ) -> list[RankRow]:
+        return _top(self._rows(), server_id, limit)
+
+    def close(
+        self,
+        rows: Iterable[tuple[int, int, str]] = (),
+        events: Iterable[Event] = (),
+        channels: Iterable[tuple[int, int, str]] = (),
+    ):
+        self._apply(rows)
+        self._set_channels(channels)
+        self.history.close((), events)
+
+
+class RedisCounters(CounterBackend):
+    """Counters as Redis hashes, `{prefix}:{server_id}:{name}`, listed in a set.
+
+    Active counters are also ranked by count in sorted sets, one over every
+    server and one per server, updated along with the hashes so leaderboards
+    read the top members instead of every counter. Deltas are pipelined as
+    HINCRBY, one round trip per flush. Compare-and-set watches the counter's
+    hash on a second connection, retrying when only its count moved in
+    between.
+    """
+
+    name = "redis"
+
+    def __init__(
+        self,
+        history: CountingStorage,
+        host: str = "127.0.0.1",
+        port: int = 6379,
+        *,
+        db: int = 0,
+        prefix: str = "counter",
+    ):
+        super().__init__(history)
+        self.host = host
+        self.port = port
+        self.db = db
+        self.prefix = prefix
+        self._members = f"{prefix}:counters"
+        self._rank = f"{prefix}:rank"
+        self._client = RespClient(host, port, db)
+        # WATCH covers a whole connection, so transactions get their own.
+        self._transactions = RespClient(host, port, db)
+        self._transaction_lock = asyncio.Lock()
+
+    def _hash(self, key: CounterKey) -> str:
+        return f"{self.prefix}:{key[0]}:{key[1]}"
+
+    def _server_rank(self, server_id: int) -> str:
+        return f"{self._rank}:{server_id}"
+
+    def _rank_commands(
+        self, key: CounterKey, count: int | None
+    ) -> list[tuple[Any, ...]]:
+        """Ranks a counter at `count`, or unranks it when `count` is None."""
+        member = f"{key[0]}:{key[1]}"
+        if count is None:
+            return [
+                ("ZREM", self._rank, member),
+                ("ZREM", self._server_rank(key[0]), key[1]),
+            ]
+        return [
+            ("ZADD", self._rank, count, member),
+            ("ZADD", self._server_rank(key[0]), count, key[1]),
+        ]
+
+    def _delta_commands(
+        self, rows: Iterable[tuple[int, int, str]]
+    ) -> list[tuple[Any, ...]]:
+        # XX leaves the ranks of inactive counters, which are not ranked, alone.
+        return [
+            command
+            for delta, server_id, name in rows
+            for command in (
+                ("HINCRBY", self._hash((server_id, name)), "count", delta),
+                ("ZADD", self._rank, "XX", "INCR", delta, f"{server_id}:{name}"),
+                ("ZADD", self._server_rank(server_id), "XX", "INCR", delta, name),
+            )
+        ]
+
+    @staticmethod
+    def _row(key: CounterKey, reply: list[bytes]) -> CounterRow:
+        fields = dict(zip(reply[::2], reply[1::2], strict=True))
+        message_id = fields.get(b"message_id")
+        channel_id = fields.get(b"channel_id")
+        return (
+            *key,
+            int(message_id) if message_id is not None else None,
+            int(fields.get(b"count", 0)),
+            fields.get(b"active") == b"1",
+            int(channel_id) if channel_id is not None else None,
+            int(fields.get(b"version", 0)),
+        )
+
+    async def _pipeline(
+        self, commands: list[tuple[Any, ...]], client: RespClient | None = None
+    ) -> list:
+        try:
+            replies = await (client or self._client).pipeline(commands)
+        except (OSError, asyncio.IncompleteReadError, ValueError, RespError) as e:
+            raise BackendError(f"Redis at {self.host}:{self.port}: {e}") from e
+        for reply in replies:
+            if isinstance(reply, RespError):
+                raise BackendError(f"Redis at {self.host}:{self.port}: {reply}")
+        return replies
+
+    async def _rows(self) -> list[CounterRow]:
+        (members,) = await self._pipeline([("SMEMBERS", self._members)])
+        keys = []
+        for member in members:
+            server_id, _, name = member.decode().partition(":")
+            keys.append((int(server_id), name))
+        if not keys:
+            return []
+        replies = await self._pipeline([("HGETALL", self._hash(key)) for key in keys])
+        return [
+            self._row(key, reply)
+            for key, reply in zip(keys, replies, strict=True)
+            if reply
+        ]
+
+    async def load(self) -> list[CounterRow]:
+        await self.history.migrate()
+        rows = await self._rows()
+        if rows:
+            # Brings the ranks in line with the hashes, which also ranks
+            # counters stored before there were ranks.
+            await self._pipeline(
+                [
+                    command
+                    for row in rows
+                    for command in self._rank_commands(
+                        (row[0], row[1]), row[3] if row[4] else None
+                    )
+                ]
+            )
+        return rows
+
+    async def counter(self, key: CounterKey) -> CounterRow | None:
+        (reply,) = await self._pipeline([("HGETALL", self._hash(key))])
+        return self._row(key, reply) if reply else None
+
+    def _set_commands(
+        self, key: CounterKey, message_id: int, count: int, channel_id: int | None
+    ) -> list[tuple[Any, ...]]:
+        name = self._hash(key)
+        channel = (
+            ("HSET", name, "channel_id", channel_id)
+            if channel_id is not None
+            else ("HDEL", name, "channel_id")
+        )
+        return [
+            ("MULTI",),
+            ("HSET", name, "message_id", message_id, "count", count, "active", 1),
+            channel,
+            ("SADD", self._members, f"{key[0]}:{key[1]}"),
+            *self._rank_commands(key, count),
+            ("HINCRBY", name, "version", 1),
+            ("EXEC",),
+        ]
+
+    async def upsert_counter(
+        self,
+        key: CounterKey,
+        message_id: int,
+        count: int,
+        channel_id: int | None = None,
+        *,
+        expected_version: int | None = None,
+    ) -> int | None:
+        commands = self._set_commands(key, message_id, count, channel_id)
+        if expected_version is None:
+            replies = await self._pipeline(commands)
+            return replies[-1][-1]
+        name = self._hash(key)
+        async with self._transaction_lock:
+            for _ in range(CAS_ATTEMPTS):
+                _, version = await self._pipeline(
+                    [("WATCH", name), ("HGET", name, "version")], self._transactions
+                )
+                if int(version or 0) != expected_version:
+                    await self._pipeline([("UNWATCH",)], self._transactions)
+                    return None
+                replies = await self._pipeline(commands, self._transactions)
+                if replies[-1] is not None:
+                    return replies[-1][-1]
+                # Something touched the counter, maybe only a flush; look again.
+        return None
+
+    async def apply_deltas(
+        self, rows: Iterable[tuple[int, int, str]], events: Iterable[Event] = ()
+    ) -> dict[CounterKey, int]:
+        rows = list(rows)
+        events = list(events)
+        if events:
+            await self.history.apply_deltas((), events)
+        if not rows:
+            return {}
+        try:
+            replies = await self._pipeline(self._delta_commands(rows))
+        except BackendError as e:
+            if events:
+                raise CountsError(str(e)) from e
+            raise
+        return {
+            (server_id, name): count
+            for (_, server_id, name), count in zip(rows, replies[::3], strict=True)
+        }
+
+    def _channel_commands(
+        self, rows: Iterable[tuple[int, int, str]]
+    ) -> list[tuple[Any, ...]]:
+        return [
+            ("HSETNX", self._hash((server_id, name)), "channel_id", channel_id)
+            for channel_id, server_id, name in rows
+        ]
+
+    async def set_channels(self, rows: Iterable[tuple[int, int, str]]):
+        commands = self._channel_commands(rows)
+        if commands:
+            await self._pipeline(commands)
+
+    async def deactivate(self, key: CounterKey, delta: int = 0):
+        name = self._hash(key)
+        await self._pipeline(
+            [
+                ("MULTI",),
+                ("HINCRBY", name, "count", delta),
+                ("HSET", name, "active", 0),
+                *self._rank_commands(key, None),
+                ("HINCRBY", name, "version", 1),
+                ("EXEC",),
+            ]
+        )
+
+    async def leaderboard(
+        self, server_id: int | None = None, limit: int = 10
+    ) -> list[RankRow]:
+        if limit <= 0:
+            return []
+        rank = self._rank if server_id is None else self._server_rank(server_id)
+        (reply,) = await self._pipeline(
+            [("ZREVRANGE", rank, 0, limit - 1, "WITHSCORES")]
+        )
+        rows = []
+        for member, score in zip(reply[::2], reply[1::2], strict=True):
+            if server_id is None:
+                guild_id, _, name = member.decode().partition(":")
+                rows.append((int(guild_id), name, int(float(score))))
+            else:
+                rows.append((server_id, member.decode(), int(float(score))))
+        return rows
+
+    async def _final_flush(self, commands: list[tuple[Any, ...]]):
+        client = RespClient(self.host, self.port, self.db)
+        try:
+            await self._pipeline(commands, client)
+        finally:
+            await client.close()
+
+    def close(
+        self,
+        rows: Iterable[tuple[int, int, str]] = (),
+        events: Iterable[Event] = (),
+        channels: Iterable[tuple[int, int, str]] = (),
+    ):
+        commands = self._delta_commands(rows) + self._channel_commands(channels)
+        try:
+            # The connections belong to the bot's event loop, which may already
+            # be closed, so they are dropped rather than closed gracefully.
+            self._client.disconnect()
+            self._transactions.disconnect()
+        finally:
+            try:
+                if commands:
+                    # The event loop may be running, so write from a loop of its own.
+                    with ThreadPoolExecutor(max_workers=1) as executor:
+                        executor.submit(
+                            asyncio.run, self._final_flush(commands)
+                        ).result()
+            finally:
+                self.history.close((), events)
+
+
+def open_backend(
+    config: configparser.ConfigParser, history: CountingStorage
+) -> CounterBackend:
+    """Creates the backend chosen in the `[STORAGE]` settings."""
+    name = config.get("STORAGE", "backend", fallback="sqlite").strip().lower()
+    match name:
+        case "sqlite":
+            return SqliteCounters(history)
+        case "memory":
+            return MemoryCounters(history)
+        case "redis":
+            return RedisCounters(
+                history,
+                config.get("STORAGE", "redis_host", fallback="127.0.0.1"),
+                config.getint("STORAGE", "redis_port", fallback=6379),
+                db=config.getint("STORAGE", "redis_db", fallback=0),
+                prefix=config.get("STORAGE", "redis_prefix", fallback="counter"),
+            )
+    raise ValueError(
+        f"Unknown storage backend {name!r}, expected one of {', '.join(BACKENDS)}."
+    )
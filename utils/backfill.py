@@ -0,0 +1,107 @@
+"""Resumable counting of patterns in channel history."""
+
+import asyncio
+import logging
+from collections.abc import Iterable
+
+import discord
+
+from utils.matcher import Matcher, Pattern
+from utils.storage import CounterKey, CountingStorage
+
+logger = logging.getLogger(__name__)
+
+
+class Backfill:
+    """Counts a counter's patterns in the history of a server's channels.
+
+    Channels are scanned oldest first by at most `workers` tasks at once, each
+    streaming one page of history at a time, so memory use does not grow with
+    the history. Progress is saved after every page and scans resume from it.
+    Each pattern in `untils` is only counted in messages older than its
+    snowflake, when it started counting live, so no message is counted by
+    both.
+    """
+
+    def __init__(
+        self,
+        storage: CountingStorage,
+        key: CounterKey,
+        untils: dict[str, int],
+        *,
+        workers: int = 3,
+        page_size: int = 100,
+    ):
+        self.storage = storage
+        self.key = key
+        self.untils = untils
+        # Matches are counted per pattern rather than per counter, so each is
+        # checked against its own start.
+        self.matcher = Matcher(Pattern(pattern, pattern) for pattern in untils)
+        self.workers = workers
+        self.page_size = page_size
+        self.scanned = 0
+
+    async def run(self, channels: Iterable[discord.TextChannel]):
+        """Scans every channel that is not finished yet."""
+        progress = await self.storage.backfill_progress(self.key)
+        queue: asyncio.Queue[discord.TextChannel] = asyncio.Queue()
+        for channel in channels:
+            if not progress.get(channel.id, (None, 0, False))[2]:
+                queue.put_nowait(channel)
+
+        async def work():
+            while not queue.empty():
+                channel = queue.get_nowait()
+                last_id, matches, _ = progress.get(channel.id, (None, 0, False))
+                await self._scan(channel, last_id, matches)
+
+        workers = [
+            asyncio.create_task(work()) for _ in range(min(self.workers, queue.qsize()))
+        ]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+    async def _scan(
+        self, channel: discord.TextChannel, last_id: int | None, matches: int
+    ):
+        # py-cord waits out 429s on the channel's rate-limit bucket before
+        # fetching the next page, so a worker simply streams as fast as allowed.
+        after = discord.Object(last_id) if last_id is not None else None
+        in_page = 0
+        try:
+            async for message in channel.history(
+                limit=None,
+                before=discord.Object(max(self.untils.values())),
+                after=after,
+                oldest_first=True,
+            ):
+                last_id = message.id
+                in_page += 1
+                if not message.author.bot and message.content:
+                    matches += sum(
+                        count
+                        for pattern, count in self.matcher.count(
+                            message.content
+                        ).items()
+                        if message.id < self.untils[pattern]
+                    )
+                if in_page == self.page_size:
+                    self.scanned += in_page
+                    in_page = 0
+                    await self.storage.save_backfill_progress(
+                        self.key, channel.id, last_id, matches
+                    )
+        except discord.Forbidden:
+            logger.warning(
+                "Server %d: cannot read the history of channel %d.",
+                self.key[0],
+                channel.id,
+            )
+        self.scanned += in_page
+        await self.storage.save_backfill_progress(
+            self.key, channel.id, last_id, matches, done=True
+        )
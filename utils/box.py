@@ -0,0 +1,77 @@
+"""Renders sentences as ASCII-art 3D boxes."""
+
+from functools import lru_cache
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import numpy as np
+
+DIAGONAL = "╲"
+
+
+def box_size(length: int) -> tuple[int, int]:
+    """Returns the number of diagonal steps and the grid size for a sentence."""
+    if length % 2 == 1:
+        diags = length // 2 // 2
+    else:
+        diags = length // 2 - 2
+    return diags, length + diags + 1
+
+
+def min_box_length(length: int) -> int:
+    """A lower bound on the rendered length, cheap enough to check up front.
+
+    Only the newlines and the diagonals are counted, since spaces in the
+    sentence may be stripped from the ends of lines. Both rows holding a
+    diagonal's far end reach at least that far.
+    """
+    diags, size = box_size(length)
+    if diags <= 0:
+        return max(0, size - 1)
+    return size - 1 + 2 * diags * (2 * length - 1) + 2 * diags * (diags + 1)
+
+
+def _square(offset: int, length: int) -> "tuple[np.ndarray, np.ndarray, np.ndarray]":
+    """Returns the rows, columns and sentence indices of a square's four edges.
+
+    Edges are ordered top, left, bottom, right: the bottom and right edges spell
+    the sentence backwards.
+    """
+    import numpy as np
+
+    i = np.arange(length)
+    edge = offset + i
+    first = np.full(length, offset)
+    last = np.full(length, offset + length - 1)
+    rows = np.concatenate((first, edge, last, edge))
+    cols = np.concatenate((edge, first, edge, last))
+    chars = np.concatenate((i, i, i[::-1], i[::-1]))
+    return rows, cols, chars
+
+
+@lru_cache(maxsize=256)
+def render_box(sentence: str) -> str:
+    """Renders `sentence` along the edges of a box seen in perspective."""
+    # numpy is slow to import, so it is only imported once a box is drawn.
+    import numpy as np
+
+    length = len(sentence)
+    diags, size = box_size(length)
+    letters = np.array(list(sentence), dtype=np.str_).view(np.uint32)
+
+    # Every character is two columns wide: the character, then a space.
+    grid = np.full((size, 2 * size), ord(" "), dtype=np.uint32)
+    # The back face goes first so the front face is drawn over it.
+    for offset in (diags + 1, 0):
+        rows, cols, chars = _square(offset, length)
+        grid[rows, 2 * cols] = letters[chars]
+    if diags > 0:
+        i = np.arange(1, diags + 1)
+        near, far = i, length - 1 + i
+        grid[
+            np.concatenate((near, near, far, far)),
+            2 * np.concatenate((near, far, near, far)),
+        ] = ord(DIAGONAL)
+
+    lines = grid.view(f"<U{2 * size}").ravel()
+    return "\n".join(line.rstrip() for line in lines)
@@ -0,0 +1,12 @@
+"""Settings utilities."""
+
+import configparser
+
+SETTINGS_PATH = "settings.ini"
+
+
+def load_settings(path: str = SETTINGS_PATH) -> configparser.ConfigParser:
+    """Reads the bot settings file. Missing files yield an empty parser."""
+    config = configparser.ConfigParser()
+    config.read(path)
+    return config
@@ -0,0 +1,327 @@
+"""Write-behind counter engine for the Counting cog."""
+
+import asyncio
+import logging
+import sqlite3
+import time
+from dataclasses import dataclass
+
+from utils.backends import BackendError, CounterBackend, CountsError, SqliteCounters
+from utils.storage import CounterKey, CountingStorage, Event, RankRow
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(slots=True)
+class CounterState:
+    """In-memory state of a named counter."""
+
+    message_id: int | None
+    count: int
+    active: bool
+    # Delta not yet written to the database.
+    pending: int = 0
+    # The channel of the counter's message, unknown for counters created before
+    # it was recorded until their buttons are clicked.
+    channel_id: int | None = None
+    # Bumped whenever the counter is set or deactivated, 0 if it is not stored.
+    version: int = 0
+
+
+class CounterStore:
+    """Authoritative in-memory counters, written back to storage in batches.
+
+    Clicks only touch the in-memory state. Dirty counters, along with the event
+    log of every change, are flushed in a single transaction every
+    `flush_interval` seconds, or sooner once `flush_threshold` counters are
+    dirty. Call `close` to guarantee a final flush.
+
+    Counters are written to `backend`, by default the sqlite `storage`, which
+    always holds their events, patterns and backfills.
+    """
+
+    def __init__(
+        self,
+        storage: CountingStorage,
+        *,
+        backend: CounterBackend | None = None,
+        flush_interval: float = 5.0,
+        flush_threshold: int = 100,
+    ):
+        self.storage = storage
+        self.backend = backend if backend is not None else SqliteCounters(storage)
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self._counters: dict[CounterKey, CounterState] = {}
+        self._dirty: set[CounterKey] = set()
+        self._events: list[Event] = []
+        # Channels learned for counters stored without one, not yet written.
+        self._channels: dict[CounterKey, int] = {}
+        self._loaded = False
+        self._load_lock = asyncio.Lock()
+        self._wakeup: asyncio.Event | None = None
+        self._flusher: asyncio.Task | None = None
+
+    async def load(self):
+        """Reads every counter into memory. Only the first call does any work."""
+        if self._loaded:
+            return
+        async with self._load_lock:
+            if self._loaded:
+                return
+            rows = await self.backend.load()
+            self._counters = {
+                (server_id, name): CounterState(
+                    message_id,
+                    count,
+                    bool(active),
+                    channel_id=channel_id,
+                    version=version,
+                )
+                for server_id, name, message_id, count, active, channel_id, version in rows
+            }
+            self._loaded = True
+
+    async def reload(self):
+        """Rereads every counter from storage, e.g. after an import.
+
+        Changes that were not flushed yet are kept on top of the stored counts.
+        """
+        rows = await self.backend.load()
+        counters = {}
+        for server_id, name, message_id, count, active, channel_id, version in rows:
+            previous = self._counters.get((server_id, name))
+            pending = previous.pending if previous is not None else 0
+            if channel_id is None:
+                channel_id = self._channels.get((server_id, name))
+            counters[server_id, name] = CounterState(
+                message_id, count + pending, bool(active), pending, channel_id, version
+            )
+        self._counters = counters
+        self._dirty &= counters.keys()
+        self._loaded = True
+
+    def get(self, key: CounterKey) -> CounterState | None:
+        return self._counters.get(key)
+
+    def active_counters(self) -> list[tuple[CounterKey, int]]:
+        """Returns the (key, message_id) pairs of every active counter."""
+        return [
+            (key, state.message_id)
+            for key, state in self._counters.items()
+            if state.active and state.message_id is not None
+        ]
+
+    def names(self, server_id: int) -> list[str]:
+        """Returns the names of a server's active counters."""
+        return sorted(
+            name
+            for (guild_id, name), state in self._counters.items()
+            if guild_id == server_id and state.active
+        )
+
+    def learn_channel(self, key: CounterKey, channel_id: int):
+        """Records the channel of a counter's message, if it was not known.
+
+        The channel is written with the next flush, once per counter.
+        """
+        state = self._counters.get(key)
+        if state is None or state.channel_id is not None:
+            return
+        state.channel_id = channel_id
+        self._channels[key] = channel_id
+        self._ensure_flusher()
+
+    def _take_channels(self) -> list[tuple[int, int, str]]:
+        channels, self._channels = self._channels, {}
+        return [(channel_id, *key) for key, channel_id in channels.items()]
+
+    def increment(
+        self,
+        key: CounterKey,
+        delta: int,
+        *,
+        user_id: int | None = None,
+        source: str = "button",
+    ) -> int | None:
+        """Adds `delta` to an active counter in memory and returns the new count."""
+        state = self._counters.get(key)
+        if state is None or not state.active:
+            return None
+        state.count += delta
+        state.pending += delta
+        self._dirty.add(key)
+        self._events.append((*key, user_id, delta, time.time(), source))
+        self._ensure_flusher()
+        if len(self._dirty) >= self.flush_threshold and self._wakeup is not None:
+            self._wakeup.set()
+        return state.count
+
+    async def set_counter(
+        self,
+        key: CounterKey,
+        message_id: int,
+        count: int,
+        *,
+        channel_id: int | None = None,
+        user_id: int | None = None,
+        source: str = "init",
+        expected_version: int | None = None,
+    ) -> bool:
+        """Overwrites a counter. This is written through immediately.
+
+        With `expected_version`, as read from the counter's state, the counter
+        is only overwritten if nobody else set it since, here or in another
+        process sharing the database. Returns whether it was overwritten.
+        """
+        previous = self._counters.get(key)
+        if expected_version is not None and expected_version != (
+            previous.version if previous is not None else 0
+        ):
+            return False
+        version = await self.backend.upsert_counter(
+            key, message_id, count, channel_id, expected_version=expected_version
+        )
+        if version is None:
+            # Someone set the counter first, maybe another process, so pick up
+            # what they wrote.
+            row = await self.backend.counter(key)
+            if row is not None:
+                _, _, message_id, count, active, channel_id, version = row
+                state = self._counters.get(key)
+                pending = state.pending if state is not None else 0
+                self._counters[key] = CounterState(
+                    message_id,
+                    count + pending,
+                    bool(active),
+                    pending,
+                    channel_id,
+                    version,
+                )
+            return False
+        previous = self._counters.get(key)
+        delta = count - (previous.count if previous is not None else 0)
+        self._events.append((*key, user_id, delta, time.time(), source))
+        self._counters[key] = CounterState(
+            message_id, count, True, channel_id=channel_id, version=version
+        )
+        self._dirty.discard(key)
+        return True
+
+    async def deactivate(self, key: CounterKey):
+        """Marks a counter as inactive, flushing any pending delta with it."""
+        state = self._counters.get(key)
+        if state is None:
+            return
+        state.active = False
+        state.version += 1
+        delta, state.pending = state.pending, 0
+        self._dirty.discard(key)
+        await self.backend.deactivate(key, delta)
+
+    async def finish_backfill(
+        self, key: CounterKey, *, user_id: int | None = None
+    ) -> int:
+        """Adds a finished backfill's matches to a counter. Returns how many."""
+        in_storage = isinstance(self.backend, SqliteCounters)
+        total = await self.storage.finish_backfill(
+            key, user_id, time.time(), increment=in_storage
+        )
+        state = self._counters.get(key)
+        if state is not None:
+            state.count += total
+            if not in_storage and total:
+                # sqlite already marked the backfill done and recorded its
+                # event, so the count goes out with the next flush, which
+                # retries it until it is written.
+                state.pending += total
+                self._dirty.add(key)
+                self._ensure_flusher()
+        return total
+
+    def _take_dirty(self) -> list[tuple[int, int, str]]:
+        rows = []
+        for key in self._dirty:
+            state = self._counters[key]
+            rows.append((state.pending, *key))
+            state.pending = 0
+        self._dirty.clear()
+        return rows
+
+    async def flush(self) -> int:
+        """Writes every dirty counter in one transaction. Returns the number written."""
+        channels = self._take_channels()
+        if channels:
+            try:
+                await self.backend.set_channels(channels)
+            except (sqlite3.Error, BackendError):
+                for channel_id, server_id, name in channels:
+                    self._channels.setdefault((server_id, name), channel_id)
+                raise
+        rows = self._take_dirty()
+        events, self._events = self._events, []
+        if not rows and not events:
+            return 0
+        flushed = {
+            (server_id, name): self._counters[server_id, name]
+            for _, server_id, name in rows
+        }
+        try:
+            counts = await self.backend.apply_deltas(rows, events)
+        except (sqlite3.Error, BackendError) as e:
+            # Put the deltas and events back so the next flush retries them,
+            # unless the events were written already.
+            for delta, server_id, name in rows:
+                self._counters[server_id, name].pending += delta
+                self._dirty.add((server_id, name))
+            if not isinstance(e, CountsError):
+                self._events[:0] = events
+            raise
+        for key, count in counts.items():
+            state = self._counters.get(key)
+            if state is flushed[key]:
+                # Resync with the stored value, keeping clicks made during the flush.
+                state.count = count + state.pending
+        logger.debug("Flushed %d counters.", len(rows))
+        return len(rows)
+
+    async def leaderboard(
+        self, server_id: int | None = None, limit: int = 10
+    ) -> list[RankRow]:
+        """Returns the highest stored active counters, see `CounterBackend.leaderboard`."""
+        return await self.backend.leaderboard(server_id, limit)
+
+    def start(self):
+        """Starts the background flusher. Requires a running event loop."""
+        self._ensure_flusher()
+
+    def _ensure_flusher(self):
+        if self._flusher is not None and not self._flusher.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._wakeup = asyncio.Event()
+        self._flusher = loop.create_task(self._run_flusher())
+
+    async def _run_flusher(self):
+        assert self._wakeup is not None
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except (sqlite3.Error, BackendError) as e:
+                logger.error("%s: failed to flush counters, retrying later.", e)
+
+    def close(self):
+        """Stops the flusher, flushes pending writes and closes the storage."""
+        if self._flusher is not None and not self._flusher.done():
+            self._flusher.cancel()
+        self._flusher = None
+        events, self._events = self._events, []
+        self.backend.close(self._take_dirty(), events, self._take_channels())
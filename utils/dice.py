@@ -0,0 +1,260 @@
+"""Dice notation parsing and rolling with hard work limits.
+
+Supports expressions such as `4d6`, `d20`, `4d6kh3+2` and `2d20kl1 - 1d4 + 3`.
+Keep/drop modifiers are `kh`/`k` (keep highest), `kl` (keep lowest), `dh` (drop
+highest) and `dl` (drop lowest). Every limit is checked while parsing, so the
+work a roll can cause is known before any dice are sampled.
+"""
+
+import re
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import numpy as np
+
+MAX_TERMS = 20
+MAX_DICE = 10_000_000
+MAX_SIDES = 1_000_000
+MAX_CONSTANT = 1_000_000_000
+# Keep/drop modifiers need every roll in memory to pick from.
+MAX_KEEP_DICE = 100_000
+# Rolls with more dice than this are summarised instead of listed.
+MAX_LISTED_DICE = 500
+# Histograms are only shown for dice with at most this many sides.
+MAX_HISTOGRAM_SIDES = 20
+# Dice are sampled in chunks of this size, which bounds memory use.
+CHUNK_SIZE = 1 << 20
+# Rolls with more dice than this are worth moving off the event loop.
+OFFLOAD_DICE = 100_000
+
+_TERM = re.compile(
+    r"\s*([+-])?\s*(?:(\d*)d(\d+)(?:(kh|kl|dh|dl|k)(\d+))?|(\d+))\s*", re.IGNORECASE
+)
+
+_MODIFIERS = {"k": "kh"}
+# numpy is imported on the first roll, it is slow to import and rarely needed.
+_rng: "np.random.Generator | None" = None
+
+
+class DiceError(ValueError):
+    """Raised for malformed expressions or ones that exceed the limits."""
+
+
+@dataclass(frozen=True, slots=True)
+class Term:
+    """A signed group of identical dice, or a constant when `sides` is 0."""
+
+    sign: int
+    count: int
+    sides: int = 0
+    modifier: str | None = None
+    modifier_count: int = 0
+
+    def __str__(self) -> str:
+        if not self.sides:
+            return str(self.count)
+        modifier = f"{self.modifier}{self.modifier_count}" if self.modifier else ""
+        return f"{self.count}d{self.sides}{modifier}"
+
+    @property
+    def kept(self) -> int:
+        """The number of dice that count towards the total."""
+        match self.modifier:
+            case "kh" | "kl":
+                return min(self.modifier_count, self.count)
+            case "dh" | "dl":
+                return max(self.count - self.modifier_count, 0)
+        return self.count
+
+
+@dataclass(slots=True)
+class TermResult:
+    term: Term
+    total: int
+    # Individual rolls, in roll order, when few enough to list.
+    rolls: "np.ndarray | None" = None
+    # Which of `rolls` count towards the total.
+    kept: "np.ndarray | None" = None
+    low: int = 0
+    high: int = 0
+    # Counts of each face, indexed from 1, for dice with few sides.
+    histogram: "np.ndarray | None" = None
+
+
+def parse(expression: str) -> list[Term]:
+    """Parses dice notation, raising `DiceError` if it is invalid or too large."""
+    terms = []
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = _TERM.match(expression, position)
+        if match is None or match.end() == position:
+            raise DiceError(f"Could not read `{expression[position:]}`.")
+        if terms and match.group(1) is None:
+            raise DiceError("Terms must be separated by `+` or `-`.")
+        position = match.end()
+        sign = -1 if match.group(1) == "-" else 1
+        count, sides, modifier, modifier_count, constant = match.group(2, 3, 4, 5, 6)
+        if constant is not None:
+            if int(constant) > MAX_CONSTANT:
+                raise DiceError(f"Constants can be at most {MAX_CONSTANT}.")
+            terms.append(Term(sign, int(constant)))
+            continue
+        term = Term(
+            sign,
+            int(count) if count else 1,
+            int(sides),
+            _MODIFIERS.get(modifier.lower(), modifier.lower()) if modifier else None,
+            int(modifier_count) if modifier_count else 0,
+        )
+        if not 1 <= term.sides <= MAX_SIDES:
+            raise DiceError(f"Dice must have between 1 and {MAX_SIDES} sides.")
+        if term.count == 0:
+            raise DiceError("At least one die has to be rolled.")
+        if term.modifier and term.count > MAX_KEEP_DICE:
+            raise DiceError(f"Keep/drop works on at most {MAX_KEEP_DICE} dice.")
+        terms.append(term)
+    if not terms:
+        raise DiceError("Format has to be in NdN!")
+    if len(terms) > MAX_TERMS:
+        raise DiceError(f"At most {MAX_TERMS} terms can be rolled at once.")
+    if sum(term.count for term in terms if term.sides) > MAX_DICE:
+        raise DiceError(f"At most {MAX_DICE} dice can be rolled at once.")
+    return terms
+
+
+def dice_count(terms: list[Term]) -> int:
+    """The number of dice rolled, which bounds the work a roll takes."""
+    return sum(term.count for term in terms if term.sides)
+
+
+def _roll_kept(term: Term, rng: "np.random.Generator") -> TermResult:
+    import numpy as np
+
+    rolls = rng.integers(1, term.sides + 1, size=term.count)
+    order = np.argsort(rolls, kind="stable")
+    keep = np.zeros(term.count, dtype=bool)
+    if term.modifier in ("kh", "dl"):
+        keep[order[term.count - term.kept :]] = True
+    else:
+        keep[order[: term.kept]] = True
+    kept = rolls[keep]
+    return TermResult(
+        term,
+        int(kept.sum()),
+        rolls,
+        keep,
+        int(kept.min()) if kept.size else 0,
+        int(kept.max()) if kept.size else 0,
+    )
+
+
+def _roll_summed(term: Term, rng: "np.random.Generator", listed: bool) -> TermResult:
+    import numpy as np
+
+    if listed:
+        rolls = rng.integers(1, term.sides + 1, size=term.count)
+        return TermResult(
+            term, int(rolls.sum()), rolls, None, int(rolls.min()), int(rolls.max())
+        )
+    total, low, high = 0, term.sides, 1
+    histogram = (
+        np.zeros(term.sides + 1, dtype=np.int64)
+        if term.sides <= MAX_HISTOGRAM_SIDES
+        else None
+    )
+    remaining = term.count
+    while remaining:
+        chunk = rng.integers(1, term.sides + 1, size=min(remaining, CHUNK_SIZE))
+        remaining -= chunk.size
+        total += int(chunk.sum(dtype=np.int64))
+        low = min(low, int(chunk.min()))
+        high = max(high, int(chunk.max()))
+        if histogram is not None:
+            histogram += np.bincount(chunk, minlength=term.sides + 1)
+    return TermResult(term, total, None, None, low, high, histogram)
+
+
+def _new_rng() -> "np.random.Generator":
+    import numpy as np
+
+    return np.random.default_rng()
+
+
+def _shared_rng() -> "np.random.Generator":
+    global _rng
+    if _rng is None:
+        _rng = _new_rng()
+    return _rng
+
+
+def roll(
+    terms: list[Term], rng: "np.random.Generator | None" = None
+) -> list[TermResult]:
+    """Rolls every term. Individual rolls are only kept for small rolls.
+
+    Rolls large enough to be offloaded to a thread get their own generator,
+    since generators are not thread-safe.
+    """
+    count = dice_count(terms)
+    if rng is None:
+        rng = _shared_rng() if count <= OFFLOAD_DICE else _new_rng()
+    listed = count <= MAX_LISTED_DICE
+    results = []
+    for term in terms:
+        if not term.sides:
+            results.append(TermResult(term, term.count))
+        elif term.modifier:
+            results.append(_roll_kept(term, rng))
+        else:
+            results.append(_roll_summed(term, rng, listed))
+    return results
+
+
+def _format_rolls(result: TermResult) -> str:
+    assert result.rolls is not None
+    if result.kept is None:
+        return ", ".join(map(str, result.rolls.tolist()))
+    return ", ".join(
+        str(value) if kept else f"~~{value}~~"
+        for value, kept in zip(result.rolls.tolist(), result.kept.tolist(), strict=True)
+    )
+
+
+def format_results(results: list[TermResult], limit: int = 2000) -> str:
+    """Formats a roll, listing the dice when that fits within `limit` characters."""
+    total = sum(result.term.sign * result.total for result in results)
+    plain = len(results) == 1 and results[0].term.sides and not results[0].term.modifier
+    if all(result.rolls is not None or not result.term.sides for result in results):
+        if plain:
+            # A single plain roll keeps the classic comma separated output.
+            text = _format_rolls(results[0])
+        else:
+            parts = []
+            for i, result in enumerate(results):
+                sign = "-" if result.term.sign < 0 else "+" if i else ""
+                body = (
+                    f"{result.term} ({_format_rolls(result)})"
+                    if result.term.sides
+                    else str(result.term)
+                )
+                parts.append(f"{sign} {body}" if sign else body)
+            text = f"{' '.join(parts)} = **{total}**"
+        if len(text) <= limit:
+            return text
+
+    lines = [f"**Total: {total}**"]
+    for result in results:
+        if not result.term.sides:
+            continue
+        sign = "-" if result.term.sign < 0 else ""
+        line = f"{sign}{result.term}: sum {result.total}, min {result.low}, max {result.high}"
+        if result.histogram is not None:
+            line += "\n" + ", ".join(
+                f"{face}: {count}"
+                for face, count in enumerate(result.histogram.tolist())
+                if face
+            )
+        lines.append(line)
+    return "\n".join(lines)[:limit]
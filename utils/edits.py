@@ -0,0 +1,134 @@
+"""Coalesced, rate-limit-aware message edits."""
+
+import asyncio
+import logging
+from collections.abc import Awaitable, Callable, Hashable
+from dataclasses import dataclass, field
+
+import discord
+
+from utils.outbound import OutboundScheduler, retry_after
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(slots=True)
+class _PendingEdit:
+    message: discord.PartialMessage
+    # The channel's id, which the message's edits are rate limited by.
+    route: int
+    latest: int
+    published: int | None = None
+    # Loop time before which no edit may be sent.
+    not_before: float = 0.0
+    task: asyncio.Task | None = field(default=None, repr=False)
+
+
+class EditCoalescer:
+    """Merges bursts of value changes into at most one message edit per window.
+
+    Each key (e.g. a counter's key) owns a cached `PartialMessage`. The first change
+    is published straight away, later ones within `window` seconds are folded
+    into a single trailing edit, which always carries the latest value.
+
+    With an `outbound` scheduler, edits queue behind interaction
+    acknowledgements and are rendered only when they are sent.
+    """
+
+    def __init__(
+        self,
+        render: Callable[[Hashable, int], discord.Embed],
+        *,
+        window: float = 1.0,
+        max_retries: int = 3,
+        on_gone: Callable[[Hashable], Awaitable[None]] | None = None,
+        outbound: OutboundScheduler | None = None,
+    ):
+        self.render = render
+        self.window = window
+        self.max_retries = max_retries
+        self.on_gone = on_gone
+        self.outbound = outbound
+        self._pending: dict[Hashable, _PendingEdit] = {}
+
+    def publish(
+        self,
+        key: Hashable,
+        channel: discord.TextChannel | discord.PartialMessageable,
+        message_id: int,
+        value: int,
+    ):
+        """Schedules an edit of `message_id` to show `value`."""
+        entry = self._pending.get(key)
+        if entry is None or entry.message.id != message_id:
+            self.forget(key)
+            entry = _PendingEdit(
+                channel.get_partial_message(message_id), channel.id, value
+            )
+            self._pending[key] = entry
+        entry.latest = value
+        if entry.task is None or entry.task.done():
+            entry.task = asyncio.get_running_loop().create_task(self._run(key, entry))
+
+    def forget(self, key: Hashable):
+        """Drops the cached message and any scheduled edit for `key`."""
+        entry = self._pending.pop(key, None)
+        if entry is not None and entry.task is not None and not entry.task.done():
+            entry.task.cancel()
+
+    async def _run(self, key: Hashable, entry: _PendingEdit):
+        loop = asyncio.get_running_loop()
+        failures = 0
+        while entry.latest != entry.published:
+            delay = entry.not_before - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                if self.outbound is None:
+                    value = await self._edit(key, entry)
+                else:
+                    value = await self.outbound.send(
+                        entry.route, lambda: self._edit(key, entry)
+                    )
+            except (discord.NotFound, discord.Forbidden) as e:
+                logger.error("%s: message with id: %d is gone.", e, entry.message.id)
+                if self._pending.get(key) is entry:
+                    del self._pending[key]
+                if self.on_gone is not None:
+                    await self.on_gone(key)
+                return
+            except discord.HTTPException as e:
+                if e.status == 429:
+                    backoff = retry_after(e, self.window)
+                    logger.warning(
+                        "Rate limited editing message %d, retrying in %.2fs.",
+                        entry.message.id,
+                        backoff,
+                    )
+                else:
+                    failures += 1
+                    if failures > self.max_retries:
+                        logger.error(
+                            "%s: giving up on editing message %d.",
+                            e,
+                            entry.message.id,
+                        )
+                        return
+                    backoff = self.window * 2**failures
+                    logger.error("%s: HTTP error %d.", e, e.status)
+                entry.not_before = loop.time() + backoff
+                continue
+            failures = 0
+            entry.published = value
+            entry.not_before = loop.time() + self.window
+
+    async def _edit(self, key: Hashable, entry: _PendingEdit) -> int:
+        """Edits the message to show the latest value, and returns that value."""
+        value = entry.latest
+        await entry.message.edit(embed=self.render(key, value))
+        return value
+
+    def close(self):
+        """Cancels every scheduled edit."""
+        for key in list(self._pending):
+            self.forget(key)
@@ -0,0 +1,58 @@
+"""Hands cog state over to the new cog instance when an extension is reloaded.
+
+While `reloading(name)` is active, the outgoing cog `put`s its live state
+instead of closing it, and the incoming cog `take`s it instead of building its
+own. This module is not part of any extension, so it outlives the reload.
+"""
+
+import logging
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+_reloading: set[str] = set()
+# name -> (state, discard, taken)
+_states: dict[str, tuple[Any, Callable[[], None], bool]] = {}
+
+
+@contextmanager
+def reloading(name: str) -> Iterator[None]:
+    """Marks the extension `name` as reloading for the duration of the block.
+
+    State that no cog took is discarded on exit, so nothing leaks when the
+    incoming cog fails to load and py-cord could not restore the old one.
+    """
+    _reloading.add(name)
+    try:
+        yield
+    finally:
+        _reloading.discard(name)
+        entry = _states.pop(name, None)
+        if entry is not None and not entry[2]:
+            logger.warning("%s: state was not taken over, discarding it.", name)
+            entry[1]()
+
+
+def is_reloading(name: str) -> bool:
+    return name in _reloading
+
+
+def put(name: str, state: Any, discard: Callable[[], None]):
+    """Offers `state` to the next cog of `name`. `discard` closes it if unclaimed."""
+    _states[name] = (state, discard, False)
+
+
+def take(name: str) -> Any | None:
+    """Returns the state offered by the previous cog of `name`, if any.
+
+    The state stays available until the reload ends, so if the new cog fails
+    to load, py-cord's rollback to the old cog can take it back.
+    """
+    entry = _states.get(name)
+    if entry is None:
+        return None
+    state, discard, _ = entry
+    _states[name] = (state, discard, True)
+    return state
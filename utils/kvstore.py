@@ -0,0 +1,129 @@
+"""A sqlite-backed key-value store with a bounded in-memory cache."""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from collections.abc import Iterator
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class KeyValueStore:
+    """JSON values keyed by string, persisted one row per key.
+
+    Values are loaded lazily on first access and the most recently used
+    `max_resident` of them stay in memory. Every write is its own small
+    transaction, so its cost depends on the value written rather than on the
+    size of the store, and a crash never loses more than the write in flight.
+    sqlite checkpoints the write-ahead log into the database on its own, so the
+    store needs no compaction.
+    """
+
+    def __init__(self, path: str, table: str = "kv", *, max_resident: int = 1024):
+        if not table.isidentifier():
+            raise ValueError(f"Invalid table name {table!r}")
+        self.path = path
+        self.max_resident = max_resident
+        self._select = f"SELECT value FROM {table} WHERE key = ?"
+        self._upsert = f"INSERT INTO {table} (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value"
+        self._delete = f"DELETE FROM {table} WHERE key = ?"
+        self._keys = f"SELECT key FROM {table} ORDER BY key"
+        self._create = f"CREATE TABLE IF NOT EXISTS {table}(key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+        self._resident: OrderedDict[str, Any] = OrderedDict()
+        self._lock = threading.Lock()
+        self._connection: sqlite3.Connection | None = None
+
+    @property
+    def _con(self) -> sqlite3.Connection:
+        # Connects on first use, so creating the store costs nothing at startup.
+        if self._connection is None:
+            con = sqlite3.connect(
+                self.path, timeout=30, check_same_thread=False, cached_statements=16
+            )
+            con.execute("PRAGMA journal_mode = WAL")
+            con.execute("PRAGMA synchronous = NORMAL")
+            with con:
+                con.execute(self._create)
+            self._connection = con
+        return self._connection
+
+    def _remember(self, key: str, value: Any):
+        self._resident[key] = value
+        self._resident.move_to_end(key)
+        while len(self._resident) > self.max_resident:
+            self._resident.popitem(last=False)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            value = self._resident.get(key, _MISSING)
+            if value is _MISSING:
+                row = self._con.execute(self._select, (key,)).fetchone()
+                # Misses are remembered too, so repeated lookups stay in memory.
+                value = _MISSING if row is None else json.loads(row[0])
+            self._remember(key, value)
+        return default if value is _MISSING else value
+
+    def __getitem__(self, key: str) -> Any:
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __setitem__(self, key: str, value: Any):
+        encoded = json.dumps(value, sort_keys=True)
+        with self._lock, self._con:
+            self._con.execute(self._upsert, (key, encoded))
+            self._remember(key, value)
+
+    def __delitem__(self, key: str):
+        with self._lock, self._con:
+            self._con.execute(self._delete, (key,))
+            self._remember(key, _MISSING)
+
+    def keys(self) -> Iterator[str]:
+        """Iterates over every stored key without loading the values."""
+        with self._lock:
+            rows = self._con.execute(self._keys).fetchall()
+        return (key for (key,) in rows)
+
+    def migrate_json(self, path: str) -> int:
+        """Imports a JSON object file in one transaction, then renames it.
+
+        The file is renamed only after the import has committed, so a crash
+        part way through leaves it in place to be imported again.
+        """
+        with open(path, encoding="utf-8") as f:
+            try:
+                data = json.load(f)
+            except json.JSONDecodeError:
+                data = {}
+        if not isinstance(data, dict):
+            raise ValueError(f"{path} does not hold a JSON object")
+        with self._lock, self._con:
+            self._con.executemany(
+                self._upsert,
+                (
+                    (key, json.dumps(value, sort_keys=True))
+                    for key, value in data.items()
+                ),
+            )
+            self._resident.clear()
+        os.replace(path, path + ".migrated")
+        logger.info("%s: migrated %d keys from %s", self.path, len(data), path)
+        return len(data)
+
+    def close(self):
+        with self._lock:
+            self._resident.clear()
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
@@ -1,3 +1,164 @@
 """Logging utilities."""
 
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import time
+from collections.abc import Mapping
+from typing import TypeVar
+
+from utils.throttle import TokenBucketLimiter
+
+T = TypeVar("T")
+
 LOGGING_FORMAT = "%(asctime)s [%(levelname)s] - %(filename)s:%(lineno)d: %(message)s"
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats each record as one JSON object per line."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "file": record.filename,
+            "line": record.lineno,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queues records without formatting them.
+
+    The stock handler fully formats every record before queueing it, on the
+    thread that logged it. Only the message is rendered here, so later changes to mutable
+    arguments do not show up in it; timestamps, formatting and writing happen
+    on the listener's thread.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class HotPathFilter(logging.Filter):
+    """Samples or rate limits the records of chatty loggers.
+
+    `samples` maps logger names to the fraction of their records to keep, and
+    `rates` to how many records per second to keep of each message. Both also
+    apply to the loggers' children, the most specific name winning. Warnings
+    and errors are always kept.
+    """
+
+    def __init__(
+        self,
+        samples: Mapping[str, float] | None = None,
+        rates: Mapping[str, float] | None = None,
+    ):
+        super().__init__()
+        self.samples = dict(samples or {})
+        # The buckets hold one second's worth of records.
+        self.limiters = {
+            name: TokenBucketLimiter(rate, max(rate, 1.0), max_keys=1024)
+            for name, rate in (rates or {}).items()
+        }
+        self.dropped = 0
+        # logger name -> (sample, limiter), resolved once per logger.
+        self._resolved: dict[str, tuple[float | None, TokenBucketLimiter | None]] = {}
+
+    @staticmethod
+    def _lookup(settings: Mapping[str, T], name: str) -> T | None:
+        while True:
+            if name in settings:
+                return settings[name]
+            if "." not in name:
+                return settings.get("")
+            name = name.rpartition(".")[0]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        resolved = self._resolved.get(record.name)
+        if resolved is None:
+            resolved = self._resolved[record.name] = (
+                self._lookup(self.samples, record.name),
+                self._lookup(self.limiters, record.name),
+            )
+        sample, limiter = resolved
+        if sample is not None and random.random() >= sample:
+            self.dropped += 1
+            return False
+        if limiter is not None:
+            key = (record.name, record.msg)
+            if limiter.delay(key, time.monotonic()):
+                self.dropped += 1
+                return False
+            limiter.take(key)
+        return True
+
+
+def parse_levels(value: str) -> dict[str, float]:
+    """Parses "logger=number, ..." settings, where "root" names the root logger."""
+    levels = {}
+    for item in value.split(","):
+        name, sep, number = item.partition("=")
+        if sep:
+            name = name.strip()
+            levels["" if name == "root" else name] = float(number)
+    return levels
+
+
+def setup_logging(
+    level: int | str = logging.INFO,
+    *,
+    json_output: bool = False,
+    path: str | None = None,
+    max_bytes: int = 10 * 1024 * 1024,
+    backup_count: int = 5,
+    samples: Mapping[str, float] | None = None,
+    rates: Mapping[str, float] | None = None,
+) -> logging.handlers.QueueListener:
+    """Sends every log record through a queue to a background writer thread.
+
+    Logging then only costs the caller building the record and queueing it,
+    and records dropped by `samples` or `rates` (see `HotPathFilter`) cost
+    less still. Records are written to `path`, rotated once it grows past
+    `max_bytes`, or to stderr. Stop the returned listener at shutdown to write
+    out the records still queued.
+    """
+    if path:
+        handler: logging.Handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8"
+        )
+    else:
+        handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(
+        JsonFormatter() if json_output else logging.Formatter(LOGGING_FORMAT)
+    )
+
+    records: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+    queue_handler = _DeferredQueueHandler(records)
+    if samples or rates:
+        queue_handler.addFilter(HotPathFilter(samples, rates))
+
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+    return listener
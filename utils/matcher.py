@@ -0,0 +1,201 @@
+"""Multi-pattern keyword matching for message counting."""
+
+import asyncio
+import time
+from collections import Counter, deque
+from collections.abc import Iterable
+from dataclasses import dataclass
+
+from utils.storage import CountingStorage
+
+# Bounds on user supplied patterns, which are matched against every message.
+MAX_PATTERNS = 50
+MAX_PATTERN_LENGTH = 100
+WILDCARD = "*"
+
+
+class PatternError(ValueError):
+    """Raised for patterns that are empty, too long or misplace a wildcard."""
+
+
+@dataclass(frozen=True, slots=True)
+class Pattern:
+    """Counts matches of `pattern` towards the counter called `name`.
+
+    Keywords match whole words, ignoring case. A `*` at the start or end of
+    the keyword lets the word go on before or after it, so `slay*` also
+    matches "slaying". Every pattern is matched by the same automaton, in time
+    linear in the message whatever the patterns are.
+    """
+
+    name: str
+    pattern: str
+
+    @property
+    def keyword(self) -> str:
+        return self.pattern.strip(WILDCARD)
+
+    @property
+    def prefix(self) -> bool:
+        """Whether the keyword may end mid-word."""
+        return self.pattern.endswith(WILDCARD)
+
+    @property
+    def suffix(self) -> bool:
+        """Whether the keyword may start mid-word."""
+        return self.pattern.startswith(WILDCARD)
+
+    def validate(self):
+        if not 0 < len(self.pattern) <= MAX_PATTERN_LENGTH:
+            raise PatternError(
+                f"Patterns must be 1 to {MAX_PATTERN_LENGTH} characters long."
+            )
+        if not self.keyword:
+            raise PatternError("Patterns must not be only wildcards.")
+        if WILDCARD in self.keyword:
+            raise PatternError(
+                f"Wildcards (`{WILDCARD}`) can only start or end a pattern."
+            )
+
+
+def _is_word(char: str) -> bool:
+    return char.isalnum() or char == "_"
+
+
+class Matcher:
+    """An Aho-Corasick automaton over a set of keywords.
+
+    The automaton's failure links are folded into its transition tables when
+    it is built, so scanning a message is a single dict lookup per character
+    no matter how many keywords there are. Build a new matcher whenever the
+    patterns change.
+    """
+
+    def __init__(self, patterns: Iterable[Pattern]):
+        # transitions[state][char] -> state,
+        # outputs[state] -> (length, name, prefix, suffix)
+        self._transitions: list[dict[str, int]] = [{}]
+        self._outputs: list[tuple[tuple[int, str, bool, bool], ...]] = [()]
+        for pattern in patterns:
+            self._add(
+                pattern.keyword.casefold(), pattern.name, pattern.prefix, pattern.suffix
+            )
+        self._link()
+
+    def _add(self, keyword: str, name: str, prefix: bool, suffix: bool):
+        state = 0
+        for char in keyword:
+            next_state = self._transitions[state].get(char)
+            if next_state is None:
+                next_state = len(self._transitions)
+                self._transitions.append({})
+                self._outputs.append(())
+                self._transitions[state][char] = next_state
+            state = next_state
+        self._outputs[state] += ((len(keyword), name, prefix, suffix),)
+
+    def _link(self):
+        # Breadth first, so every state's failure target is complete before
+        # its own transitions are filled in from it.
+        fail = [0] * len(self._transitions)
+        goto = [dict(transitions) for transitions in self._transitions]
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in goto[state].items():
+                if state:
+                    fail[child] = self._transitions[fail[state]].get(char, 0)
+                self._outputs[child] += self._outputs[fail[child]]
+                queue.append(child)
+            # Characters without a transition of their own go where the failure
+            # state would send them.
+            self._transitions[state] = {
+                **self._transitions[fail[state]],
+                **goto[state],
+            }
+
+    def count(self, text: str) -> Counter[str]:
+        """Counts the matches in `text` per counter name."""
+        counts: Counter[str] = Counter()
+        if len(self._transitions) > 1:
+            folded = text.casefold()
+            transitions = self._transitions
+            outputs = self._outputs
+            state = 0
+            for end, char in enumerate(folded):
+                state = transitions[state].get(char, 0)
+                if outputs[state]:
+                    for length, name, prefix, suffix in outputs[state]:
+                        start = end - length + 1
+                        if (
+                            suffix or start == 0 or not _is_word(folded[start - 1])
+                        ) and (
+                            prefix
+                            or end + 1 == len(folded)
+                            or not _is_word(folded[end + 1])
+                        ):
+                            counts[name] += 1
+        return counts
+
+
+class PatternTable:
+    """Every server's counted patterns, each server with its own `Matcher`.
+
+    A server's matcher is built on first use and rebuilt only after its
+    patterns change.
+    """
+
+    def __init__(self, storage: CountingStorage):
+        self.storage = storage
+        self._patterns: dict[int, list[Pattern]] = {}
+        self._matchers: dict[int, Matcher] = {}
+        self._loaded = False
+        self._load_lock = asyncio.Lock()
+
+    async def load(self):
+        """Reads every pattern into memory. Only the first call does any work."""
+        if self._loaded:
+            return
+        async with self._load_lock:
+            if self._loaded:
+                return
+            for server_id, name, pattern in await self.storage.patterns():
+                self._patterns.setdefault(server_id, []).append(Pattern(name, pattern))
+            self._loaded = True
+
+    def patterns(self, server_id: int) -> list[Pattern]:
+        return list(self._patterns.get(server_id, ()))
+
+    def matcher(self, server_id: int) -> Matcher | None:
+        """Returns the server's matcher, or None if it counts no patterns."""
+        matcher = self._matchers.get(server_id)
+        if matcher is None and server_id in self._patterns:
+            matcher = self._matchers[server_id] = Matcher(self._patterns[server_id])
+        return matcher
+
+    async def add(self, server_id: int, pattern: Pattern):
+        """Counts `pattern` in the server's messages, replacing its counter name."""
+        pattern.validate()
+        patterns = [
+            p for p in self._patterns.get(server_id, ()) if p.pattern != pattern.pattern
+        ]
+        if len(patterns) >= MAX_PATTERNS:
+            raise PatternError(f"A server can count at most {MAX_PATTERNS} patterns.")
+        await self.storage.add_pattern(
+            server_id, pattern.name, pattern.pattern, time.time()
+        )
+        self._patterns[server_id] = [*patterns, pattern]
+        self._matchers.pop(server_id, None)
+
+    async def remove(self, server_id: int, pattern: str) -> bool:
+        """Stops counting a pattern. Returns whether it was being counted."""
+        removed = await self.storage.remove_pattern(server_id, pattern)
+        patterns = [
+            p for p in self._patterns.get(server_id, ()) if p.pattern != pattern
+        ]
+        if patterns:
+            self._patterns[server_id] = patterns
+        else:
+            self._patterns.pop(server_id, None)
+        self._matchers.pop(server_id, None)
+        return removed
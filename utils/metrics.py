@@ -0,0 +1,346 @@
+"""Lightweight metrics with a Prometheus text-format endpoint."""
+
+import asyncio
+import bisect
+import logging
+import threading
+import time
+import weakref
+from collections.abc import Sequence
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, from 100us to 10s.
+LATENCY_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+LabelValues = tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: LabelValues, **extra: str) -> str:
+    pairs = list(zip(names, values, strict=True)) + list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+class Counter:
+    """A monotonically increasing count, optionally split by labels."""
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values: dict[LabelValues, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def total(self) -> float:
+        return sum(self._values.values())
+
+    def render(self) -> list[str]:
+        return [
+            f"{self.name}{_format_labels(self.label_names, key)} {value}"
+            for key, value in sorted(self._values.items())
+        ]
+
+
+class _HistogramValues:
+    __slots__ = ("buckets", "sum", "count")
+
+    def __init__(self, size: int):
+        # One extra bucket for +Inf.
+        self.buckets = [0] * (size + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram:
+    """Observations sorted into fixed buckets, optionally split by labels."""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.bounds = tuple(buckets)
+        self._values: dict[LabelValues, _HistogramValues] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = _HistogramValues(len(self.bounds))
+            values.buckets[index] += 1
+            values.sum += value
+            values.count += 1
+
+    def series(self) -> list[LabelValues]:
+        return sorted(self._values)
+
+    def count(self, key: LabelValues = ()) -> int:
+        values = self._values.get(key)
+        return 0 if values is None else values.count
+
+    def quantile(self, q: float, key: LabelValues = ()) -> float | None:
+        """Estimates a quantile by interpolating within its bucket."""
+        values = self._values.get(key)
+        if values is None or values.count == 0:
+            return None
+        rank = q * values.count
+        seen = 0
+        for i, n in enumerate(values.buckets):
+            if seen + n >= rank and n:
+                if i == len(self.bounds):
+                    return self.bounds[-1]
+                lower = self.bounds[i - 1] if i else 0.0
+                return lower + (self.bounds[i] - lower) * (rank - seen) / n
+            seen += n
+        return self.bounds[-1]
+
+    def render(self) -> list[str]:
+        lines = []
+        for key in self.series():
+            values = self._values[key]
+            cumulative = 0
+            for bound, n in zip((*self.bounds, "+Inf"), values.buckets, strict=True):
+                cumulative += n
+                labels = _format_labels(self.label_names, key, le=str(bound))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {values.sum}")
+            lines.append(f"{self.name}_count{labels} {values.count}")
+        return lines
+
+
+class Registry:
+    """A collection of metrics that can be rendered together."""
+
+    def __init__(self):
+        self.metrics: list[Counter | Histogram] = []
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, help, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        metric = Histogram(name, help, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Renders every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+COMMAND_LATENCY = REGISTRY.histogram(
+    "bot_command_latency_seconds", "Application command latency.", ["command"]
+)
+BUTTON_LATENCY = REGISTRY.histogram(
+    "bot_button_latency_seconds", "Counter button click latency.", ["button"]
+)
+DB_QUERY_DURATION = REGISTRY.histogram(
+    "bot_db_query_duration_seconds", "Time spent running sqlite queries.", ["query"]
+)
+REST_REQUESTS = REGISTRY.counter(
+    "bot_rest_requests_total", "Discord REST requests made.", ["method", "route"]
+)
+RATE_LIMITS = REGISTRY.counter(
+    "bot_rate_limits_total", "Discord 429 responses received.", ["scope"]
+)
+THROTTLED_CLICKS = REGISTRY.counter(
+    "bot_throttled_clicks_total", "Button clicks turned away by throttling.", ["scope"]
+)
+SWEPT_COUNTERS = REGISTRY.counter(
+    "bot_swept_counters_total",
+    "Counter messages checked by the sweeper, by whether they still exist.",
+    ["result"],
+)
+INTERACTION_ACK_LATENCY = REGISTRY.histogram(
+    "bot_interaction_ack_seconds", "Time taken to acknowledge an interaction."
+)
+OUTBOUND_QUEUE_DELAY = REGISTRY.histogram(
+    "bot_outbound_queue_seconds",
+    "Time queued requests waited before being sent.",
+    ["priority"],
+)
+LOOP_LAG = REGISTRY.histogram(
+    "bot_event_loop_lag_seconds", "How late the event loop runs scheduled callbacks."
+)
+
+
+class _RateLimitLogHandler(logging.Handler):
+    """Counts the rate limits that py-cord retries internally and only logs."""
+
+    def emit(self, record: logging.LogRecord):
+        message = str(record.msg)
+        if message.startswith("We are being rate limited"):
+            RATE_LIMITS.inc(scope="route")
+        elif message.startswith("Global rate limit has been hit"):
+            RATE_LIMITS.inc(scope="global")
+
+
+_command_started: "weakref.WeakKeyDictionary[object, float]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def instrument_bot(bot):
+    """Records command latencies, REST calls and rate limits made by `bot`."""
+
+    @bot.before_invoke
+    async def start_command_timer(ctx):
+        _command_started[ctx] = time.perf_counter()
+
+    @bot.after_invoke
+    async def stop_command_timer(ctx):
+        started = _command_started.pop(ctx, None)
+        if started is not None and ctx.command is not None:
+            COMMAND_LATENCY.observe(
+                time.perf_counter() - started, command=ctx.command.qualified_name
+            )
+
+    request = bot.http.request
+
+    async def counted_request(route, **kwargs):
+        REST_REQUESTS.inc(method=route.method, route=route.path)
+        return await request(route, **kwargs)
+
+    bot.http.request = counted_request
+    logging.getLogger("discord.http").addHandler(_RateLimitLogHandler())
+
+
+async def monitor_loop_lag(interval: float = 0.5):
+    """Samples how far behind schedule the event loop is, forever."""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, loop.time() - expected))
+
+
+class MetricsServer:
+    """Samples event-loop lag and serves `REGISTRY` at /metrics while running."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 9100):
+        self.host = host
+        self.port = port
+        self._runner: "web.AppRunner | None" = None
+        self._lag_task: asyncio.Task | None = None
+
+    async def _handle(self, request: "web.Request") -> "web.Response":
+        from aiohttp import web
+
+        return web.Response(
+            text=REGISTRY.render(), content_type="text/plain", charset="utf-8"
+        )
+
+    async def start(self):
+        """Starts serving. Calling this again while running does nothing.
+
+        A port of 0 only samples the event-loop lag, without serving anything.
+        """
+        if self._lag_task is not None:
+            return
+        self._lag_task = asyncio.create_task(monitor_loop_lag())
+        if not self.port:
+            return
+        # aiohttp.web is only needed, and only imported, when metrics are served.
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        try:
+            await web.TCPSite(self._runner, self.host, self.port).start()
+        except OSError as e:
+            # E.g. another bot process on this host already serves this port.
+            logger.error("%s: cannot serve metrics on %s:%d.", e, self.host, self.port)
+            await self._runner.cleanup()
+            self._runner = None
+            return
+        logger.info("Serving metrics on http://%s:%d/metrics", self.host, self.port)
+
+    async def stop(self):
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+            self._lag_task = None
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+def format_summary() -> str:
+    """Summarises the metrics for humans, e.g. for a stats command."""
+
+    def ms(value: float | None) -> str:
+        return "-" if value is None else f"{value * 1000:.1f}ms"
+
+    lines = []
+    for title, histogram in (
+        ("Commands", COMMAND_LATENCY),
+        ("Buttons", BUTTON_LATENCY),
+        ("Queries", DB_QUERY_DURATION),
+    ):
+        lines.append(f"{title}:")
+        for key in histogram.series():
+            lines.append(
+                f"  {'/'.join(key)}: n={histogram.count(key)} p50={ms(histogram.quantile(0.5, key))} p99={ms(histogram.quantile(0.99, key))}"
+            )
+    lines.append(
+        f"Event loop lag: p50={ms(LOOP_LAG.quantile(0.5))} p99={ms(LOOP_LAG.quantile(0.99))}"
+    )
+    lines.append(
+        f"REST requests: {REST_REQUESTS.total():.0f}, rate limits: {RATE_LIMITS.total():.0f}"
+    )
+    return "\n".join(lines)
@@ -0,0 +1,258 @@
+"""Acknowledge-first scheduling of outgoing Discord requests."""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections.abc import Awaitable, Callable, Hashable
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Any, TypeVar
+
+import discord
+
+from utils.metrics import INTERACTION_ACK_LATENCY, OUTBOUND_QUEUE_DELAY
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class Priority(IntEnum):
+    """Order in which queued requests are sent, lowest first."""
+
+    EDIT = 0
+    MESSAGE = 1
+    # Background checks, which can wait for everything else.
+    SWEEP = 2
+
+
+def retry_after(error: discord.HTTPException, default: float) -> float:
+    """Reads how long to back off for from a 429 response's headers."""
+    headers = getattr(error.response, "headers", None) or {}
+    for header in ("Retry-After", "X-RateLimit-Reset-After"):
+        try:
+            return float(headers[header])
+        except (KeyError, TypeError, ValueError):
+            continue
+    return default
+
+
+@dataclass(slots=True)
+class _Bucket:
+    tokens: float
+    updated: float
+    # Loop time until which a 429 blocks the route.
+    blocked_until: float = 0.0
+
+
+@dataclass(order=True, slots=True)
+class _Request:
+    priority: Priority
+    seq: int
+    route: Hashable = field(compare=False)
+    send: Callable[[], Awaitable[Any]] = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    queued: float = field(compare=False)
+
+
+class OutboundScheduler:
+    """Sends interaction acknowledgements ahead of every other request.
+
+    Discord drops interactions that are not acknowledged within three seconds,
+    so acknowledgements are sent straight away. Everything else is queued by
+    priority and sent at most `concurrency` at a time, each route (e.g. a
+    channel) limited to `route_burst` requests per `route_period` seconds, so
+    bursts wait in the queue instead of in py-cord's 429 handling. While
+    acknowledgements are in flight, queued requests hold back for up to
+    `ack_hold` seconds, which keeps them from starving under constant clicks.
+    """
+
+    def __init__(
+        self,
+        *,
+        concurrency: int = 4,
+        route_burst: int = 5,
+        route_period: float = 5.0,
+        ack_hold: float = 0.25,
+    ):
+        self.concurrency = concurrency
+        self.route_burst = route_burst
+        self.route_period = route_period
+        self.ack_hold = ack_hold
+        self._queue: list[_Request] = []
+        self._buckets: dict[Hashable, _Bucket] = {}
+        self._seq = itertools.count()
+        self._acks = 0
+        self._in_flight = 0
+        self._acks_done = asyncio.Event()
+        self._acks_done.set()
+        self._wakeup = asyncio.Event()
+        self._dispatcher: asyncio.Task | None = None
+        self._sending: set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    async def acknowledge(self, send: Callable[[], Awaitable[T]]) -> T:
+        """Sends an interaction acknowledgement (a reply or defer) right away."""
+        started = time.perf_counter()
+        self._acks += 1
+        self._acks_done.clear()
+        try:
+            return await send()
+        finally:
+            self._acks -= 1
+            if not self._acks:
+                self._acks_done.set()
+            INTERACTION_ACK_LATENCY.observe(time.perf_counter() - started)
+
+    def submit(
+        self,
+        route: Hashable,
+        send: Callable[[], Awaitable[T]],
+        priority: Priority = Priority.EDIT,
+    ) -> "asyncio.Future[T]":
+        """Queues `send` on `route`. The future resolves with its result.
+
+        `send` is called only when the request goes out, so it can read the
+        latest state. Cancelling the future drops the request if it is still
+        queued.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        request = _Request(priority, next(self._seq), route, send, future, loop.time())
+        heapq.heappush(self._queue, request)
+        self._wakeup.set()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = loop.create_task(self._dispatch())
+        return future
+
+    async def send(
+        self,
+        route: Hashable,
+        send: Callable[[], Awaitable[T]],
+        priority: Priority = Priority.EDIT,
+    ) -> T:
+        """Queues `send` on `route` and waits for its result."""
+        return await self.submit(route, send, priority)
+
+    def close(self):
+        """Stops sending and cancels every queued request."""
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+        for request in self._queue:
+            request.future.cancel()
+        self._queue.clear()
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        held_since = None
+        while self._queue:
+            if self._acks_done.is_set():
+                held_since = None
+            else:
+                # Hold back once per run of acknowledgements, not once per request.
+                if held_since is None:
+                    held_since = loop.time()
+                remaining = held_since + self.ack_hold - loop.time()
+                if remaining > 0:
+                    try:
+                        await asyncio.wait_for(self._acks_done.wait(), remaining)
+                    except TimeoutError:
+                        pass
+                    continue
+            if self._in_flight >= self.concurrency:
+                await self._wait(None)
+                continue
+            request, delay = self._next_ready(loop.time())
+            if request is None:
+                if delay is None:
+                    break
+                await self._wait(delay)
+                continue
+            self._in_flight += 1
+            task = loop.create_task(self._send(request))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+        self._prune(loop.time())
+
+    async def _wait(self, timeout: float | None):
+        # Woken early by new requests and finished sends.
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except TimeoutError:
+            pass
+
+    def _next_ready(self, now: float) -> tuple[_Request | None, float | None]:
+        """Pops the first request whose route may send, else the time until one may."""
+        blocked = []
+        found = None
+        wait = None
+        while self._queue:
+            request = heapq.heappop(self._queue)
+            if request.future.done():
+                continue
+            delay = self._take(request.route, now)
+            if delay <= 0:
+                found = request
+                break
+            blocked.append(request)
+            wait = delay if wait is None else min(wait, delay)
+        for request in blocked:
+            heapq.heappush(self._queue, request)
+        return found, wait
+
+    def _take(self, route: Hashable, now: float) -> float:
+        """Takes a token from the route's bucket, or returns how long until one refills."""
+        bucket = self._buckets.get(route)
+        if bucket is None:
+            bucket = self._buckets[route] = _Bucket(self.route_burst, now)
+        rate = self.route_burst / self.route_period
+        bucket.tokens = min(
+            self.route_burst, bucket.tokens + (now - bucket.updated) * rate
+        )
+        bucket.updated = now
+        if now < bucket.blocked_until:
+            return bucket.blocked_until - now
+        if bucket.tokens < 1:
+            return (1 - bucket.tokens) / rate
+        bucket.tokens -= 1
+        return 0.0
+
+    def _prune(self, now: float):
+        # Buckets that have refilled behave exactly like new ones.
+        rate = self.route_burst / self.route_period
+        for route, bucket in list(self._buckets.items()):
+            if (
+                now >= bucket.blocked_until
+                and bucket.tokens + (now - bucket.updated) * rate >= self.route_burst
+            ):
+                del self._buckets[route]
+
+    async def _send(self, request: _Request):
+        loop = asyncio.get_running_loop()
+        OUTBOUND_QUEUE_DELAY.observe(
+            loop.time() - request.queued, priority=request.priority.name.lower()
+        )
+        try:
+            result = await request.send()
+        except discord.HTTPException as e:
+            if e.status == 429:
+                bucket = self._buckets.get(request.route)
+                if bucket is not None:
+                    backoff = retry_after(e, self.route_period)
+                    bucket.blocked_until = loop.time() + backoff
+            if not request.future.done():
+                request.future.set_exception(e)
+        except Exception as e:
+            if not request.future.done():
+                request.future.set_exception(e)
+        else:
+            if not request.future.done():
+                request.future.set_result(result)
+        finally:
+            self._in_flight -= 1
+            self._wakeup.set()
@@ -0,0 +1,130 @@
+"""A minimal asyncio client for the Redis protocol (RESP2)."""
+
+import asyncio
+import socket
+from collections.abc import Sequence
+from typing import Any
+
+Reply = bytes | int | list | None
+
+
+class RespError(Exception):
+    """An error reply from the server, or a reply that could not be parsed."""
+
+
+def _encode(args: Sequence[Any]) -> bytes:
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+async def _read_reply(reader: asyncio.StreamReader) -> "Reply | RespError":
+    line = await reader.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("Connection closed by the server.")
+    kind, body = line[:1], line[1:-2]
+    match kind:
+        case b"+":
+            return body
+        case b"-":
+            return RespError(body.decode(errors="replace"))
+        case b":":
+            return int(body)
+        case b"$":
+            length = int(body)
+            if length < 0:
+                return None
+            return (await reader.readexactly(length + 2))[:-2]
+        case b"*":
+            length = int(body)
+            if length < 0:
+                return None
+            return [await _read_reply(reader) for _ in range(length)]
+    raise RespError(f"Unexpected reply type {kind!r}.")
+
+
+class RespClient:
+    """One connection, opened on first use, with pipelining.
+
+    Requests are written and their replies read under a lock, so concurrent
+    callers never see each other's replies. Commands that must not be
+    interleaved with other callers' commands, such as WATCH ... EXEC, should be
+    sent as one pipeline.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 6379, db: int = 0):
+        self.host = host
+        self.port = port
+        self.db = db
+        self._reader: asyncio.StreamReader | None = None
+        self._writer: asyncio.StreamWriter | None = None
+        self._lock = asyncio.Lock()
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        if self.db:
+            self._writer.write(_encode(("SELECT", self.db)))
+            reply = await _read_reply(self._reader)
+            if isinstance(reply, RespError):
+                raise reply
+
+    async def pipeline(self, commands: Sequence[Sequence[Any]]) -> list:
+        """Sends every command at once and returns their replies in order.
+
+        Error replies are returned as `RespError`s rather than raised, so the
+        replies of the other commands are not lost.
+        """
+        async with self._lock:
+            try:
+                if self._writer is None:
+                    await self._connect()
+                assert self._reader is not None and self._writer is not None
+                self._writer.write(b"".join(_encode(command) for command in commands))
+                await self._writer.drain()
+                return [await _read_reply(self._reader) for _ in commands]
+            except BaseException:
+                # The replies can no longer be matched up, also when the caller
+                # was cancelled while waiting for them, so start over.
+                self.disconnect()
+                raise
+
+    async def execute(self, *args: Any) -> Reply:
+        """Sends one command and returns its reply, raising error replies."""
+        (reply,) = await self.pipeline([args])
+        if isinstance(reply, RespError):
+            raise reply
+        return reply
+
+    def disconnect(self):
+        """Closes the connection without waiting, e.g. at shutdown.
+
+        This also works once the connection's event loop is closed.
+        """
+        writer = self._writer
+        self._reader = self._writer = None
+        if writer is None:
+            return
+        try:
+            writer.close()
+        except RuntimeError:
+            # Closing the transport schedules work on its loop, which is gone,
+            # so hang up on the socket itself.
+            sock = writer.transport.get_extra_info("socket")
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    async def close(self):
+        async with self._lock:
+            writer = self._writer
+            self.disconnect()
+            if writer is not None:
+                try:
+                    await writer.wait_closed()
+                except OSError:
+                    pass
@@ -0,0 +1,63 @@
+"""Startup phase timing."""
+
+import logging
+import os
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+def process_uptime() -> float | None:
+    """Seconds since the process started, read from /proc where available."""
+    try:
+        with open("/proc/self/stat", encoding="ascii") as f:
+            # The command name may contain spaces, so split after its parenthesis.
+            fields = f.read().rpartition(")")[2].split()
+        with open("/proc/uptime", encoding="ascii") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    started = int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    return max(0.0, uptime - started)
+
+
+class StartupProfiler:
+    """Records how long each phase of startup took.
+
+    The first phase runs from process start, so it covers the interpreter and
+    the module imports before the profiler was created.
+    """
+
+    def __init__(self):
+        now = time.perf_counter()
+        uptime = process_uptime()
+        self.started = now - uptime if uptime is not None else now
+        self.phases: list[tuple[str, float]] = []
+        self._last = self.started
+
+    def mark(self, name: str):
+        """Ends the phase called `name`, which began when the previous one ended."""
+        now = time.perf_counter()
+        self.phases.append((name, now - self._last))
+        self._last = now
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Times the block as the phase called `name`."""
+        self.mark("other")
+        try:
+            yield
+        finally:
+            self.mark(name)
+
+    def report(self) -> str:
+        total = self._last - self.started
+        lines = [
+            f"{name:<32}{seconds * 1000:>9.1f}ms"
+            for name, seconds in self.phases
+            if name != "other" or seconds >= 0.001
+        ]
+        lines.append(f"{'total':<32}{total * 1000:>9.1f}ms")
+        return "\n".join(lines)
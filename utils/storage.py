@@ -0,0 +1,533 @@
+"""Off-loop sqlite storage for the Counting cog."""
+
+import asyncio
+import sqlite3
+import time
+from collections.abc import Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, TypeVar
+
+from utils import transfer
+from utils.metrics import DB_QUERY_DURATION
+
+T = TypeVar("T")
+
+DEFAULT_NAME = "default"
+
+# Queries are kept as constants so the connection's statement cache reuses the
+# prepared statements instead of recompiling them on every call.
+CREATE_COUNTING = "CREATE TABLE IF NOT EXISTS counting(server_id INTEGER NOT NULL, name TEXT NOT NULL DEFAULT 'default', message_id INTEGER, count INTEGER, active BOOLEAN NOT NULL CHECK (active IN (0, 1)), channel_id INTEGER, version INTEGER NOT NULL DEFAULT 1, PRIMARY KEY (server_id, name))"
+# Partial indexes over the active counters, kept up to date by sqlite on every
+# write, so leaderboards read the top rows instead of sorting the table.
+CREATE_RANK_INDEX = (
+    "CREATE INDEX IF NOT EXISTS counting_rank ON counting(count DESC) WHERE active"
+)
+CREATE_SERVER_RANK_INDEX = "CREATE INDEX IF NOT EXISTS counting_server_rank ON counting(server_id, count DESC) WHERE active"
+SELECT_COUNTERS = "SELECT server_id, name, message_id, count, active, channel_id, version FROM counting"
+SELECT_COUNTER = "SELECT server_id, name, message_id, count, active, channel_id, version FROM counting WHERE server_id = ? AND name = ?"
+# Setting or deactivating a counter bumps its version, so a command that read
+# a counter can tell whether it was changed since. Counts moved by clicks and
+# messages leave it alone. Rows start at version 1, also when migrated or
+# imported, a missing row being 0.
+UPSERT_COUNTER = "INSERT INTO counting (server_id, name, message_id, count, active, channel_id, version) VALUES (?, ?, ?, ?, TRUE, ?, 1) ON CONFLICT(server_id, name) DO UPDATE SET message_id = excluded.message_id, count = excluded.count, active = TRUE, channel_id = excluded.channel_id, version = version + 1 RETURNING version"
+UPSERT_COUNTER_IF_VERSION = "INSERT INTO counting (server_id, name, message_id, count, active, channel_id, version) SELECT ?, ?, ?, ?, TRUE, ?, 1 WHERE ?6 = 0 OR EXISTS (SELECT 1 FROM counting WHERE server_id = ?1 AND name = ?2) ON CONFLICT(server_id, name) DO UPDATE SET message_id = excluded.message_id, count = excluded.count, active = TRUE, channel_id = excluded.channel_id, version = version + 1 WHERE version = ?6 RETURNING version"
+# Counters from before channels were recorded learn theirs from a click.
+SET_COUNTER_CHANNEL = "UPDATE counting SET channel_id = ? WHERE server_id = ? AND name = ? AND channel_id IS NULL"
+INCREMENT_COUNTER = "UPDATE counting SET count = count + ? WHERE server_id = ? AND name = ? RETURNING count"
+DEACTIVATE_COUNTER = "UPDATE counting SET count = count + ?, active = FALSE, version = version + 1 WHERE server_id = ? AND name = ?"
+SELECT_TOP = "SELECT server_id, name, count FROM counting WHERE active ORDER BY count DESC LIMIT ?"
+SELECT_SERVER_TOP = "SELECT server_id, name, count FROM counting WHERE active AND server_id = ? ORDER BY count DESC LIMIT ?"
+CREATE_EVENTS = "CREATE TABLE IF NOT EXISTS counting_events(id INTEGER PRIMARY KEY, server_id INTEGER NOT NULL, name TEXT NOT NULL DEFAULT 'default', user_id INTEGER, delta INTEGER NOT NULL, ts REAL NOT NULL, source TEXT NOT NULL)"
+CREATE_EVENTS_INDEX = "CREATE INDEX IF NOT EXISTS counting_events_counter_ts ON counting_events(server_id, name, ts)"
+CREATE_CHECKPOINTS = "CREATE TABLE IF NOT EXISTS counting_checkpoints(server_id INTEGER NOT NULL, name TEXT NOT NULL DEFAULT 'default', ts REAL NOT NULL, delta INTEGER NOT NULL, events INTEGER NOT NULL, PRIMARY KEY (server_id, name))"
+INSERT_EVENT = "INSERT INTO counting_events (server_id, name, user_id, delta, ts, source) VALUES (?, ?, ?, ?, ?, ?)"
+SELECT_EVENTS_BEFORE = "SELECT id, user_id, delta, ts, source FROM counting_events WHERE server_id = ? AND name = ? AND (ts, id) < (?, ?) ORDER BY ts DESC, id DESC LIMIT ?"
+SELECT_EVENTS_AFTER = "SELECT id, user_id, delta, ts, source FROM counting_events WHERE server_id = ? AND name = ? AND (ts, id) > (?, ?) ORDER BY ts ASC, id ASC LIMIT ?"
+SELECT_CHECKPOINT = "SELECT ts, delta, events FROM counting_checkpoints WHERE server_id = ? AND name = ?"
+# The WHERE clause is needed for sqlite to parse an upsert on a SELECT.
+FOLD_EVENTS = "INSERT INTO counting_checkpoints (server_id, name, ts, delta, events) SELECT server_id, name, ?, SUM(delta), COUNT(*) FROM counting_events WHERE ts < ? GROUP BY server_id, name ON CONFLICT(server_id, name) DO UPDATE SET ts = excluded.ts, delta = delta + excluded.delta, events = events + excluded.events"
+DELETE_EVENTS_BEFORE = "DELETE FROM counting_events WHERE ts < ?"
+CREATE_PATTERNS = "CREATE TABLE IF NOT EXISTS counting_patterns(server_id INTEGER NOT NULL, pattern TEXT NOT NULL, name TEXT NOT NULL, PRIMARY KEY (server_id, pattern))"
+SELECT_PATTERNS = "SELECT server_id, name, pattern FROM counting_patterns"
+UPSERT_PATTERN = "INSERT INTO counting_patterns (server_id, pattern, name) VALUES (?, ?, ?) ON CONFLICT(server_id, pattern) DO UPDATE SET name = excluded.name"
+DELETE_PATTERN = "DELETE FROM counting_patterns WHERE server_id = ? AND pattern = ?"
+# When each pattern first started counting towards a counter, and whether its
+# history from before then is backfilled (2), being backfilled (1) or not (0).
+# Rows outlive the pattern being uncounted, so counting it again neither moves
+# its start nor backfills it twice.
+CREATE_PATTERN_STARTS = "CREATE TABLE IF NOT EXISTS counting_pattern_starts(server_id INTEGER NOT NULL, name TEXT NOT NULL, pattern TEXT NOT NULL, live_since REAL NOT NULL, backfill INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (server_id, name, pattern))"
+INSERT_PATTERN_START = "INSERT INTO counting_pattern_starts (server_id, name, pattern, live_since) VALUES (?, ?, ?, ?) ON CONFLICT(server_id, name, pattern) DO NOTHING"
+QUEUE_PATTERN_BACKFILLS = "UPDATE counting_pattern_starts SET backfill = 1 WHERE server_id = ?1 AND name = ?2 AND backfill = 0 AND pattern IN (SELECT pattern FROM counting_patterns WHERE server_id = ?1 AND name = ?2)"
+SELECT_PATTERN_BACKFILLS = "SELECT pattern, live_since FROM counting_pattern_starts WHERE server_id = ? AND name = ? AND backfill = 1"
+FINISH_PATTERN_BACKFILLS = "UPDATE counting_pattern_starts SET backfill = 2 WHERE server_id = ? AND name = ? AND backfill = 1"
+# A backfill counts each of a counter's patterns in the channel history from
+# before the pattern went live, saving each channel's progress so an
+# interrupted backfill can resume.
+CREATE_BACKFILLS = "CREATE TABLE IF NOT EXISTS counting_backfills(server_id INTEGER NOT NULL, name TEXT NOT NULL, channel_id INTEGER, user_id INTEGER, PRIMARY KEY (server_id, name))"
+CREATE_BACKFILL_PROGRESS = "CREATE TABLE IF NOT EXISTS counting_backfill_progress(server_id INTEGER NOT NULL, name TEXT NOT NULL, channel_id INTEGER NOT NULL, last_id INTEGER, matches INTEGER NOT NULL, done BOOLEAN NOT NULL CHECK (done IN (0, 1)), PRIMARY KEY (server_id, name, channel_id))"
+INSERT_BACKFILL = "INSERT INTO counting_backfills (server_id, name, channel_id, user_id) VALUES (?, ?, ?, ?) ON CONFLICT(server_id, name) DO NOTHING"
+SELECT_BACKFILL = "SELECT channel_id, user_id FROM counting_backfills WHERE server_id = ? AND name = ?"
+SELECT_BACKFILLS = "SELECT server_id, name FROM counting_backfills"
+SELECT_BACKFILL_PROGRESS = "SELECT channel_id, last_id, matches, done FROM counting_backfill_progress WHERE server_id = ? AND name = ?"
+UPSERT_BACKFILL_PROGRESS = "INSERT INTO counting_backfill_progress (server_id, name, channel_id, last_id, matches, done) VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(server_id, name, channel_id) DO UPDATE SET last_id = excluded.last_id, matches = excluded.matches, done = excluded.done"
+SUM_BACKFILL = "SELECT COALESCE(SUM(matches), 0) FROM counting_backfill_progress WHERE server_id = ? AND name = ?"
+DELETE_BACKFILL = "DELETE FROM counting_backfills WHERE server_id = ? AND name = ?"
+DELETE_BACKFILL_PROGRESS = (
+    "DELETE FROM counting_backfill_progress WHERE server_id = ? AND name = ?"
+)
+
+# Databases from before named counters keyed everything on server_id alone.
+# Their tables are rebuilt with a name column, every row becoming the server's
+# default counter.
+MIGRATE_TABLES = {
+    "counting": "INSERT INTO counting (server_id, message_id, count, active, version) SELECT server_id, message_id, count, active, 1 FROM counting_old",
+    "counting_checkpoints": "INSERT INTO counting_checkpoints (server_id, ts, delta, events) SELECT server_id, ts, delta, events FROM counting_checkpoints_old",
+}
+ADD_EVENTS_NAME = (
+    "ALTER TABLE counting_events ADD COLUMN name TEXT NOT NULL DEFAULT 'default'"
+)
+DROP_OLD_EVENTS_INDEX = "DROP INDEX IF EXISTS counting_events_server_ts"
+ADD_COUNTING_CHANNEL = "ALTER TABLE counting ADD COLUMN channel_id INTEGER"
+# Existing rows get version 1, as if they had just been created.
+ADD_COUNTING_VERSION = (
+    "ALTER TABLE counting ADD COLUMN version INTEGER NOT NULL DEFAULT 1"
+)
+
+# (server_id, name)
+CounterKey = tuple[int, str]
+# (server_id, name, message_id, count, active, channel_id, version)
+CounterRow = tuple[int, str, int | None, int, bool, int | None, int]
+# (server_id, name, count)
+RankRow = tuple[int, str, int]
+# (server_id, name, user_id, delta, ts, source)
+Event = tuple[int, str, int | None, int, float, str]
+# (id, user_id, delta, ts, source)
+EventRow = tuple[int, int | None, int, float, str]
+# (channel_id, user_id, {pattern: live_since})
+BackfillJob = tuple[int | None, int | None, dict[str, float]]
+# channel_id -> (last_id, matches, done)
+BackfillProgress = dict[int, tuple[int | None, int, bool]]
+
+
+class CountingStorage:
+    """A single long-lived WAL connection driven by a dedicated thread.
+
+    Every query runs on the storage thread, so slow disk I/O never blocks the
+    event loop. The async methods are safe to call from any coroutine.
+    """
+
+    def __init__(self, path: str = "cache.db"):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage")
+        self._con: sqlite3.Connection
+        # Connecting is the storage thread's first job, so creating the storage
+        # never waits on the disk and every later query runs after it.
+        self._connected = self._executor.submit(self._connect)
+
+    def _connect(self):
+        # Sharded workers share the database file, so wait out their write locks.
+        con = sqlite3.connect(
+            self.path, timeout=30, check_same_thread=False, cached_statements=64
+        )
+        con.execute("PRAGMA journal_mode = WAL")
+        con.execute("PRAGMA synchronous = NORMAL")
+        self._con = con
+
+    async def _run(self, fn: Callable[..., T], *args: Any) -> T:
+        loop = asyncio.get_running_loop()
+        # Shielded so a cancelled caller cannot drop a write that is still queued.
+        return await asyncio.shield(
+            loop.run_in_executor(self._executor, self._timed, fn, *args)
+        )
+
+    @staticmethod
+    def _timed(fn: Callable[..., T], *args: Any) -> T:
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            DB_QUERY_DURATION.observe(
+                time.perf_counter() - started, query=fn.__name__.lstrip("_")
+            )
+
+    def _set_trace_callback(self, callback: Callable[[str], object] | None):
+        self._con.set_trace_callback(callback)
+
+    async def set_trace_callback(self, callback: Callable[[str], object] | None):
+        """Calls `callback` with every SQL statement the connection runs."""
+        await self._run(self._set_trace_callback, callback)
+
+    def _columns(self, table: str) -> set[str]:
+        return {row[1] for row in self._con.execute(f"PRAGMA table_info({table})")}
+
+    def _migrate(self):
+        # Raises here if connecting failed.
+        self._connected.result()
+        # Sharded workers may race to migrate, so take the write lock first and
+        # only then look at the schema.
+        self._con.execute("BEGIN IMMEDIATE")
+        try:
+            for table, copy in MIGRATE_TABLES.items():
+                columns = self._columns(table)
+                if columns and "name" not in columns:
+                    self._con.execute(f"ALTER TABLE {table} RENAME TO {table}_old")
+                    self._con.execute(
+                        CREATE_COUNTING if table == "counting" else CREATE_CHECKPOINTS
+                    )
+                    self._con.execute(copy)
+                    self._con.execute(f"DROP TABLE {table}_old")
+            columns = self._columns("counting")
+            if columns and "channel_id" not in columns:
+                self._con.execute(ADD_COUNTING_CHANNEL)
+            if columns and "version" not in columns:
+                self._con.execute(ADD_COUNTING_VERSION)
+            columns = self._columns("counting_events")
+            if columns and "name" not in columns:
+                self._con.execute(ADD_EVENTS_NAME)
+                self._con.execute(DROP_OLD_EVENTS_INDEX)
+            self._con.execute(CREATE_COUNTING)
+            self._con.execute(CREATE_RANK_INDEX)
+            self._con.execute(CREATE_SERVER_RANK_INDEX)
+            self._con.execute(CREATE_EVENTS)
+            self._con.execute(CREATE_EVENTS_INDEX)
+            self._con.execute(CREATE_CHECKPOINTS)
+            self._con.execute(CREATE_PATTERNS)
+            self._con.execute(CREATE_PATTERN_STARTS)
+            self._con.execute(CREATE_BACKFILLS)
+            self._con.execute(CREATE_BACKFILL_PROGRESS)
+        except BaseException:
+            self._con.rollback()
+            raise
+        self._con.commit()
+
+    async def migrate(self):
+        """Creates or migrates the schema."""
+        await self._run(self._migrate)
+
+    def _setup(self) -> list[CounterRow]:
+        self._migrate()
+        return self._con.execute(SELECT_COUNTERS).fetchall()
+
+    async def setup(self) -> list[CounterRow]:
+        """Creates or migrates the schema and returns every counter row."""
+        return await self._run(self._setup)
+
+    def _counter(self, key: CounterKey) -> CounterRow | None:
+        return self._con.execute(SELECT_COUNTER, key).fetchone()
+
+    async def counter(self, key: CounterKey) -> CounterRow | None:
+        """Returns a counter's row, or None if it does not exist."""
+        return await self._run(self._counter, key)
+
+    def _upsert_counter(
+        self,
+        key: CounterKey,
+        message_id: int,
+        count: int,
+        channel_id: int | None,
+        expected_version: int | None,
+    ) -> int | None:
+        with self._con:
+            if expected_version is None:
+                row = self._con.execute(
+                    UPSERT_COUNTER, (*key, message_id, count, channel_id)
+                ).fetchone()
+            else:
+                row = self._con.execute(
+                    UPSERT_COUNTER_IF_VERSION,
+                    (*key, message_id, count, channel_id, expected_version),
+                ).fetchone()
+        return row[0] if row is not None else None
+
+    async def upsert_counter(
+        self,
+        key: CounterKey,
+        message_id: int,
+        count: int,
+        channel_id: int | None = None,
+        *,
+        expected_version: int | None = None,
+    ) -> int | None:
+        """Creates or overwrites a counter and marks it active.
+
+        With `expected_version`, the counter is only written if it is still at
+        that version, 0 meaning that it must not exist yet. Returns the
+        counter's new version, or None if it was not written.
+        """
+        return await self._run(
+            self._upsert_counter, key, message_id, count, channel_id, expected_version
+        )
+
+    def _apply_deltas(
+        self, rows: Iterable[tuple[int, int, str]], events: Iterable[Event] = ()
+    ) -> dict[CounterKey, int]:
+        counts = {}
+        with self._con:
+            for delta, server_id, name in rows:
+                row = self._con.execute(
+                    INCREMENT_COUNTER, (delta, server_id, name)
+                ).fetchone()
+                if row is not None:
+                    counts[server_id, name] = row[0]
+            self._con.executemany(INSERT_EVENT, events)
+        return counts
+
+    async def apply_deltas(
+        self, rows: Iterable[tuple[int, int, str]], events: Iterable[Event] = ()
+    ) -> dict[CounterKey, int]:
+        """Applies (delta, server_id, name) rows and appends `events` in one transaction.
+
+        Returns the stored count of every counter that was updated.
+        """
+        return await self._run(self._apply_deltas, list(rows), list(events))
+
+    def _set_channels(self, rows: Iterable[tuple[int, int, str]]):
+        with self._con:
+            self._con.executemany(SET_COUNTER_CHANNEL, rows)
+
+    async def set_channels(self, rows: Iterable[tuple[int, int, str]]):
+        """Records the (channel_id, server_id, name) of counters without a channel."""
+        await self._run(self._set_channels, list(rows))
+
+    def _leaderboard(self, server_id: int | None, limit: int) -> list[RankRow]:
+        if server_id is None:
+            return self._con.execute(SELECT_TOP, (limit,)).fetchall()
+        return self._con.execute(SELECT_SERVER_TOP, (server_id, limit)).fetchall()
+
+    async def leaderboard(
+        self, server_id: int | None = None, limit: int = 10
+    ) -> list[RankRow]:
+        """Returns the highest active counters, of one server or of every server."""
+        return await self._run(self._leaderboard, server_id, limit)
+
+    def _history(
+        self,
+        key: CounterKey,
+        cursor: tuple[float, int] | None,
+        older: bool,
+        limit: int,
+    ) -> list[EventRow]:
+        if older:
+            ts, event_id = cursor if cursor is not None else (float("inf"), 0)
+            query = SELECT_EVENTS_BEFORE
+        else:
+            ts, event_id = cursor if cursor is not None else (float("-inf"), 0)
+            query = SELECT_EVENTS_AFTER
+        rows = self._con.execute(query, (*key, ts, event_id, limit)).fetchall()
+        return rows if older else rows[::-1]
+
+    async def history(
+        self,
+        key: CounterKey,
+        cursor: tuple[float, int] | None = None,
+        *,
+        older: bool = True,
+        limit: int = 10,
+    ) -> list[EventRow]:
+        """Returns a page of a counter's events, newest first.
+
+        Pages are keyed on the (ts, id) `cursor`: `older` pages come strictly
+        before it, newer pages strictly after it.
+        """
+        return await self._run(self._history, key, cursor, older, limit)
+
+    def _checkpoint(self, key: CounterKey) -> tuple[float, int, int] | None:
+        return self._con.execute(SELECT_CHECKPOINT, key).fetchone()
+
+    async def checkpoint(self, key: CounterKey) -> tuple[float, int, int] | None:
+        """Returns the (ts, delta, events) folded into a counter's checkpoint."""
+        return await self._run(self._checkpoint, key)
+
+    def _compact(self, before: float) -> int:
+        with self._con:
+            self._con.execute(FOLD_EVENTS, (before, before))
+            return self._con.execute(DELETE_EVENTS_BEFORE, (before,)).rowcount
+
+    async def compact(self, before: float) -> int:
+        """Folds events older than `before` into per-counter checkpoints.
+
+        Returns the number of events removed.
+        """
+        return await self._run(self._compact, before)
+
+    def _deactivate(self, key: CounterKey, delta: int):
+        with self._con:
+            self._con.execute(DEACTIVATE_COUNTER, (delta, *key))
+
+    async def deactivate(self, key: CounterKey, delta: int = 0):
+        """Marks a counter as inactive, applying a final `delta` with it."""
+        await self._run(self._deactivate, key, delta)
+
+    def _patterns(self) -> list[tuple[int, str, str]]:
+        return self._con.execute(SELECT_PATTERNS).fetchall()
+
+    async def patterns(self) -> list[tuple[int, str, str]]:
+        """Returns the (server_id, name, pattern) of every counted pattern."""
+        return await self._run(self._patterns)
+
+    def _add_pattern(self, server_id: int, name: str, pattern: str, added: float):
+        with self._con:
+            self._con.execute(UPSERT_PATTERN, (server_id, pattern, name))
+            self._con.execute(INSERT_PATTERN_START, (server_id, name, pattern, added))
+
+    async def add_pattern(self, server_id: int, name: str, pattern: str, added: float):
+        """Counts `pattern` towards the counter called `name` from `added` on.
+
+        Counting a pattern towards a counter again keeps when it first did.
+        """
+        await self._run(self._add_pattern, server_id, name, pattern, added)
+
+    def _remove_pattern(self, server_id: int, pattern: str) -> bool:
+        with self._con:
+            return self._con.execute(DELETE_PATTERN, (server_id, pattern)).rowcount > 0
+
+    async def remove_pattern(self, server_id: int, pattern: str) -> bool:
+        """Stops counting `pattern`. Returns whether it was being counted."""
+        return await self._run(self._remove_pattern, server_id, pattern)
+
+    def _start_backfill(
+        self, key: CounterKey, channel_id: int | None, user_id: int | None
+    ) -> BackfillJob | None:
+        with self._con:
+            if self._con.execute(INSERT_BACKFILL, (*key, channel_id, user_id)).rowcount:
+                self._con.execute(QUEUE_PATTERN_BACKFILLS, key)
+            patterns = dict(self._con.execute(SELECT_PATTERN_BACKFILLS, key).fetchall())
+            if not patterns:
+                self._con.execute(DELETE_BACKFILL, key)
+                return None
+            channel_id, user_id = self._con.execute(SELECT_BACKFILL, key).fetchone()
+        return channel_id, user_id, patterns
+
+    async def start_backfill(
+        self,
+        key: CounterKey,
+        channel_id: int | None = None,
+        user_id: int | None = None,
+    ) -> BackfillJob | None:
+        """Records a backfill of a counter, unless one is already unfinished.
+
+        Returns the (channel_id, user_id, patterns) of the backfill to run,
+        which is the unfinished one if there is one. `patterns` maps each
+        pattern it counts to when that pattern went live. Patterns are only
+        backfilled once, so returns None if all of them already were.
+        """
+        return await self._run(self._start_backfill, key, channel_id, user_id)
+
+    def _backfills(self) -> list[CounterKey]:
+        return self._con.execute(SELECT_BACKFILLS).fetchall()
+
+    async def backfills(self) -> list[CounterKey]:
+        """Returns the key of every unfinished backfill."""
+        return await self._run(self._backfills)
+
+    def _backfill_progress(self, key: CounterKey) -> BackfillProgress:
+        return {
+            channel_id: (last_id, matches, bool(done))
+            for channel_id, last_id, matches, done in self._con.execute(
+                SELECT_BACKFILL_PROGRESS, key
+            )
+        }
+
+    async def backfill_progress(self, key: CounterKey) -> BackfillProgress:
+        """Returns how far a backfill got in each channel."""
+        return await self._run(self._backfill_progress, key)
+
+    def _save_backfill_progress(
+        self,
+        key: CounterKey,
+        channel_id: int,
+        last_id: int | None,
+        matches: int,
+        done: bool,
+    ):
+        with self._con:
+            self._con.execute(
+                UPSERT_BACKFILL_PROGRESS, (*key, channel_id, last_id, matches, done)
+            )
+
+    async def save_backfill_progress(
+        self,
+        key: CounterKey,
+        channel_id: int,
+        last_id: int | None,
+        matches: int,
+        done: bool = False,
+    ):
+        """Records that a channel was scanned up to `last_id`, finding `matches`."""
+        await self._run(
+            self._save_backfill_progress, key, channel_id, last_id, matches, done
+        )
+
+    def _finish_backfill(
+        self, key: CounterKey, user_id: int | None, ts: float, increment: bool
+    ) -> int:
+        with self._con:
+            (total,) = self._con.execute(SUM_BACKFILL, key).fetchone()
+            if (
+                not increment
+                or self._con.execute(INCREMENT_COUNTER, (total, *key)).fetchone()
+            ):
+                self._con.execute(INSERT_EVENT, (*key, user_id, total, ts, "backfill"))
+            self._con.execute(FINISH_PATTERN_BACKFILLS, key)
+            self._con.execute(DELETE_BACKFILL, key)
+            self._con.execute(DELETE_BACKFILL_PROGRESS, key)
+        return total
+
+    async def finish_backfill(
+        self, key: CounterKey, user_id: int | None, ts: float, *, increment: bool = True
+    ) -> int:
+        """Adds a backfill's matches to its counter and marks its patterns done.
+
+        Both happen in one transaction, so the matches are added exactly once.
+        Without `increment`, for counters stored elsewhere, only the event is
+        recorded. Returns the number of matches added.
+        """
+        return await self._run(self._finish_backfill, key, user_id, ts, increment)
+
+    def _export(self, table: str, path: str, fmt: str | None) -> int:
+        return transfer.export_file(self._con, table, path, fmt)
+
+    async def export(self, table: str, path: str, fmt: str | None = None) -> int:
+        """Streams a table ("counters", "events" or "checkpoints") to a CSV or NDJSON file.
+
+        Returns the number of rows written.
+        """
+        return await self._run(self._export, table, path, fmt)
+
+    def _import_file(self, table: str, path: str, policy: str, fmt: str | None) -> int:
+        return transfer.import_file(self._con, table, path, policy, fmt)
+
+    async def import_file(
+        self, table: str, path: str, policy: str = "skip", fmt: str | None = None
+    ) -> int:
+        """Imports an exported file into a table in one transaction.
+
+        `policy` decides what happens to rows whose key is already stored, see
+        `transfer.POLICIES`. Returns the number of rows written.
+        """
+        return await self._run(self._import_file, table, path, policy, fmt)
+
+    def _close(self):
+        if self._connected.exception() is None:
+            self._con.close()
+
+    def close(
+        self,
+        rows: Iterable[tuple[int, int, str]] = (),
+        events: Iterable[Event] = (),
+        channels: Iterable[tuple[int, int, str]] = (),
+    ):
+        """Applies any final deltas, events and channels and closes the connection.
+
+        This blocks until the storage thread is done, for use at shutdown.
+        """
+        try:
+            try:
+                self._executor.submit(
+                    self._apply_deltas, list(rows), list(events)
+                ).result()
+            finally:
+                self._executor.submit(self._set_channels, list(channels)).result()
+        finally:
+            self._executor.submit(self._close).result()
+            self._executor.shutdown()
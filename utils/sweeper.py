@@ -0,0 +1,116 @@
+"""Background reconciliation of counters whose pinned message is gone."""
+
+import asyncio
+import logging
+
+import discord
+
+from utils.counters import CounterStore
+from utils.edits import EditCoalescer
+from utils.metrics import SWEPT_COUNTERS
+from utils.outbound import OutboundScheduler, Priority
+from utils.storage import CounterKey
+
+logger = logging.getLogger(__name__)
+
+
+class DeadMessageSweeper:
+    """Deactivates the counters whose message was deleted or became unreadable.
+
+    Active counters are checked `batch_size` at a time, at most `workers` at
+    once, pausing `batch_pause` seconds between batches. Their fetches are
+    queued on the outbound scheduler behind acknowledgements, edits and
+    messages, rate limited per channel. Counters of servers this process does
+    not see, such as those of other shards, are left alone. So are counters
+    from before channels were recorded until a click saves their channel;
+    they are logged and counted as `unknown_channel`.
+    """
+
+    def __init__(
+        self,
+        bot: discord.Client,
+        store: CounterStore,
+        edits: EditCoalescer,
+        outbound: OutboundScheduler,
+        *,
+        batch_size: int = 50,
+        workers: int = 3,
+        batch_pause: float = 1.0,
+    ):
+        self.bot = bot
+        self.store = store
+        self.edits = edits
+        self.outbound = outbound
+        self.batch_size = batch_size
+        self.workers = workers
+        self.batch_pause = batch_pause
+
+    def _candidates(self) -> list[tuple[CounterKey, int, int]]:
+        candidates = []
+        unknown = 0
+        for key, message_id in self.store.active_counters():
+            state = self.store.get(key)
+            if state is None or self.bot.get_guild(key[0]) is None:
+                continue
+            if state.channel_id is None:
+                unknown += 1
+                continue
+            candidates.append((key, state.channel_id, message_id))
+        if unknown:
+            SWEPT_COUNTERS.inc(unknown, result="unknown_channel")
+            logger.info(
+                "Skipped %d counters whose channel is not known until they are clicked.",
+                unknown,
+            )
+        return candidates
+
+    async def sweep(self) -> int:
+        """Checks every active counter once. Returns how many were deactivated."""
+        candidates = self._candidates()
+        workers = asyncio.Semaphore(self.workers)
+        dead = 0
+
+        async def check(key: CounterKey, channel_id: int, message_id: int):
+            nonlocal dead
+            async with workers:
+                if await self._is_gone(key, channel_id, message_id):
+                    dead += 1
+
+        for start in range(0, len(candidates), self.batch_size):
+            if start:
+                await asyncio.sleep(self.batch_pause)
+            batch = candidates[start : start + self.batch_size]
+            await asyncio.gather(*(check(*candidate) for candidate in batch))
+        logger.info("Swept %d counters, %d messages were gone.", len(candidates), dead)
+        return dead
+
+    async def _is_gone(self, key: CounterKey, channel_id: int, message_id: int) -> bool:
+        channel = self.bot.get_partial_messageable(channel_id)
+        try:
+            await self.outbound.send(
+                ("sweep", channel_id),
+                lambda: channel.fetch_message(message_id),
+                Priority.SWEEP,
+            )
+        except (discord.NotFound, discord.Forbidden) as e:
+            state = self.store.get(key)
+            if state is None or not state.active or state.message_id != message_id:
+                # The counter was set up again while its message was fetched.
+                SWEPT_COUNTERS.inc(result="alive")
+                return False
+            logger.warning(
+                "%s: message with id: %d of server %d's %s is gone.",
+                e,
+                message_id,
+                *key,
+            )
+            self.edits.forget(key)
+            await self.store.deactivate(key)
+            SWEPT_COUNTERS.inc(result="dead")
+            return True
+        except discord.HTTPException as e:
+            logger.error("%s: HTTP error %d.", e, e.status)
+            SWEPT_COUNTERS.inc(result="error")
+            return False
+        SWEPT_COUNTERS.inc(result="alive")
+        return False
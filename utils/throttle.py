@@ -0,0 +1,83 @@
+"""Token-bucket throttling of button clicks."""
+
+import time
+from collections import OrderedDict
+from collections.abc import Callable, Hashable
+
+from utils.metrics import THROTTLED_CLICKS
+
+
+class TokenBucketLimiter:
+    """One token bucket per key, refilling at `rate` tokens per second up to `burst`.
+
+    Only the `max_keys` most recently used buckets are kept. A forgotten
+    bucket comes back full, which is what an idle one would have refilled to.
+    """
+
+    def __init__(self, rate: float, burst: float, *, max_keys: int = 10_000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        # key -> [tokens, last refill time]
+        self._buckets: OrderedDict[Hashable, list[float]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def delay(self, key: Hashable, now: float) -> float:
+        """Refills the key's bucket and returns how long until it holds a token."""
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [self.burst, now]
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            return 0.0
+        return (1 - bucket[0]) / self.rate if self.rate > 0 else float("inf")
+
+    def take(self, key: Hashable):
+        """Spends a token of the key's bucket, which `delay` must have refilled."""
+        self._buckets[key][0] -= 1
+
+
+class ClickThrottle:
+    """Limits clicks per user and per guild.
+
+    A click spends a token from both the user's and the guild's bucket, or
+    from neither if either is empty, so clicks that were turned away do not
+    count against the other limit.
+    """
+
+    def __init__(
+        self,
+        user_rate: float = 2.0,
+        user_burst: float = 5,
+        guild_rate: float = 20.0,
+        guild_burst: float = 40,
+        *,
+        max_keys: int = 10_000,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.users = TokenBucketLimiter(user_rate, user_burst, max_keys=max_keys)
+        self.guilds = TokenBucketLimiter(guild_rate, guild_burst, max_keys=max_keys)
+        self.clock = clock
+
+    def acquire(self, user_id: int, guild_id: int | None) -> float:
+        """Returns 0 if the click may go ahead, else how many seconds to wait."""
+        now = self.clock()
+        wait = self.users.delay(user_id, now)
+        if wait:
+            THROTTLED_CLICKS.inc(scope="user")
+            return wait
+        if guild_id is not None:
+            wait = self.guilds.delay(guild_id, now)
+            if wait:
+                THROTTLED_CLICKS.inc(scope="guild")
+                return wait
+            self.guilds.take(guild_id)
+        self.users.take(user_id)
+        return 0.0
@@ -0,0 +1,338 @@
+"""Streaming export and import of counters and their history.
+
+Usage:
+    python -m utils.transfer export cache.db counters.csv [--table counters]
+    python -m utils.transfer import cache.db events.ndjson --table events [--on-conflict skip]
+
+Files are CSV with a header row, or NDJSON with one object per row, going by
+their extension. Rows are streamed in chunks both ways, so memory use does not
+grow with the table, and an import runs as a single transaction.
+"""
+
+import argparse
+import asyncio
+import csv
+import json
+import operator
+import os
+import sqlite3
+import sys
+from collections.abc import Callable, Iterable, Iterator
+from dataclasses import dataclass
+from typing import Any, TextIO
+
+CHUNK_SIZE = 10_000
+# Page cache used while importing, in KiB.
+IMPORT_CACHE_KIB = 65536
+FORMATS = ("csv", "ndjson")
+# What to do with rows whose key already exists: keep the stored row, overwrite
+# it, add the counts together, or roll the whole import back.
+POLICIES = ("skip", "replace", "add", "abort")
+
+
+class TransferError(ValueError):
+    """Raised for unknown tables and formats and for malformed rows."""
+
+
+def _required(convert: Callable[[Any], Any]) -> Callable[[Any], Any]:
+    def check(value: Any) -> Any:
+        if value is None or value == "":
+            raise ValueError("missing value")
+        return convert(value)
+
+    return check
+
+
+def _nullable(convert: Callable[[Any], Any]) -> Callable[[Any], Any]:
+    def check(value: Any) -> Any:
+        return None if value is None or value == "" else convert(value)
+
+    return check
+
+
+_INT = _required(int)
+_NULLABLE_INT = _nullable(int)
+_FLOAT = _required(float)
+_TEXT = _required(str)
+
+
+@dataclass(frozen=True)
+class Table:
+    """How one table is exported and imported."""
+
+    table: str
+    columns: tuple[str, ...]
+    converters: tuple[Callable[[Any], Any], ...]
+    # policy -> the statement inserting one row of `columns`.
+    inserts: dict[str, str]
+
+    @property
+    def select(self) -> str:
+        return f"SELECT {', '.join(self.columns)} FROM {self.table} ORDER BY rowid"
+
+
+def _inserts(
+    table: str,
+    columns: tuple[str, ...],
+    key: tuple[str, ...],
+    add: str = "",
+    touch: str = "",
+    initial: dict[str, str] | None = None,
+) -> dict[str, str]:
+    """Builds the insert of each policy.
+
+    `touch` is also set on updated rows, and `initial` maps columns that are
+    not imported to the SQL value of newly inserted rows.
+    """
+    initial = initial or {}
+    names = ", ".join((*columns, *initial))
+    values = ", ".join(("?",) * len(columns) + tuple(initial.values()))
+    insert = f"INSERT INTO {table} ({names}) VALUES ({values})"
+    conflict = f"{insert} ON CONFLICT({', '.join(key)})"
+    touch = f", {touch}" if touch else ""
+    replace = ", ".join(f"{c} = excluded.{c}" for c in columns if c not in key)
+    inserts = {
+        "skip": f"{conflict} DO NOTHING",
+        "replace": f"{conflict} DO UPDATE SET {replace}{touch}",
+        "abort": insert,
+    }
+    if add:
+        inserts["add"] = f"{conflict} DO UPDATE SET {add}{touch}"
+    return inserts
+
+
+_COUNTER_COLUMNS = ("server_id", "name", "message_id", "count", "active", "channel_id")
+_EVENT_COLUMNS = ("id", "server_id", "name", "user_id", "delta", "ts", "source")
+_CHECKPOINT_COLUMNS = ("server_id", "name", "ts", "delta", "events")
+
+TABLES = {
+    "counters": Table(
+        "counting",
+        _COUNTER_COLUMNS,
+        (_INT, _TEXT, _NULLABLE_INT, _INT, _INT, _NULLABLE_INT),
+        _inserts(
+            "counting",
+            _COUNTER_COLUMNS,
+            ("server_id", "name"),
+            "count = count + excluded.count",
+            # Lets commands that read a counter before the import see it changed.
+            "version = version + 1",
+            {"version": "1"},
+        ),
+    ),
+    "events": Table(
+        "counting_events",
+        _EVENT_COLUMNS,
+        (_NULLABLE_INT, _INT, _TEXT, _NULLABLE_INT, _INT, _FLOAT, _TEXT),
+        {
+            **_inserts("counting_events", _EVENT_COLUMNS, ("id",)),
+            # Events have no natural key, so adding them appends every row
+            # under a new id. The id parameter, ?1, is left unused.
+            "add": "INSERT INTO counting_events (server_id, name, user_id, delta, ts, source) VALUES (?2, ?3, ?4, ?5, ?6, ?7)",
+        },
+    ),
+    "checkpoints": Table(
+        "counting_checkpoints",
+        _CHECKPOINT_COLUMNS,
+        (_INT, _TEXT, _FLOAT, _INT, _INT),
+        _inserts(
+            "counting_checkpoints",
+            _CHECKPOINT_COLUMNS,
+            ("server_id", "name"),
+            "ts = max(ts, excluded.ts), delta = delta + excluded.delta, events = events + excluded.events",
+        ),
+    ),
+}
+
+
+def table_spec(name: str) -> Table:
+    try:
+        return TABLES[name]
+    except KeyError:
+        raise TransferError(
+            f"Unknown table {name!r}, expected one of {', '.join(TABLES)}."
+        ) from None
+
+
+def file_format(path: str, fmt: str | None = None) -> str:
+    """Returns `fmt`, or the format named by the extension of `path`."""
+    if fmt is None:
+        fmt = os.path.splitext(path)[1].lstrip(".").lower()
+    if fmt not in FORMATS:
+        raise TransferError(
+            f"Unknown format {fmt!r}, expected one of {', '.join(FORMATS)}."
+        )
+    return fmt
+
+
+def export_rows(
+    con: sqlite3.Connection,
+    name: str,
+    f: TextIO,
+    fmt: str,
+    chunk_size: int = CHUNK_SIZE,
+) -> int:
+    """Writes every row of the table `name` to `f`. Returns the number written."""
+    spec = table_spec(name)
+    cursor = con.execute(spec.select)
+    if fmt == "csv":
+        writer = csv.writer(f)
+        writer.writerow(spec.columns)
+        write = writer.writerows
+    else:
+        columns = spec.columns
+
+        def write(rows: list[tuple]):
+            f.writelines(
+                json.dumps(dict(zip(columns, row, strict=True)), separators=(",", ":"))
+                + "\n"
+                for row in rows
+            )
+
+    written = 0
+    while rows := cursor.fetchmany(chunk_size):
+        write(rows)
+        written += len(rows)
+    return written
+
+
+def read_rows(f: TextIO, name: str, fmt: str) -> Iterator[tuple]:
+    """Yields the rows of a file as tuples of the table's columns.
+
+    Columns missing from the file are read as empty, which nullable columns
+    such as an event's id accept.
+    """
+    spec = table_spec(name)
+    columns = spec.columns
+    if fmt == "csv":
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return
+        records: Iterable[tuple[int, Any]] = (
+            (reader.line_num, row) for row in reader if row
+        )
+        if tuple(header) == columns:
+            values: Callable[[Any], list[Any]] = list
+        else:
+            positions = [header.index(c) if c in header else None for c in columns]
+
+            def values(record: list[str]) -> list[Any]:
+                return [record[p] if p is not None else None for p in positions]
+
+    else:
+        records = (
+            (line_num, line) for line_num, line in enumerate(f, 1) if line.strip()
+        )
+
+        def values(record: str) -> list[Any]:
+            obj = json.loads(record)
+            return [obj.get(column) for column in columns]
+
+    converters = spec.converters
+    for line_num, record in records:
+        try:
+            row = values(record)
+            if len(row) != len(columns):
+                raise ValueError(f"expected {len(columns)} columns, got {len(row)}")
+            row = tuple(map(operator.call, converters, row))
+        except (ValueError, TypeError, IndexError, AttributeError) as e:
+            raise TransferError(f"Line {line_num}: {e}") from e
+        yield row
+
+
+def import_rows(
+    con: sqlite3.Connection, name: str, rows: Iterable[tuple], policy: str
+) -> int:
+    """Inserts `rows` into the table `name` in one transaction.
+
+    Returns the number of rows written, which leaves out rows that were
+    skipped. Nothing is written if any row fails.
+    """
+    spec = table_spec(name)
+    if policy not in POLICIES:
+        raise TransferError(
+            f"Unknown conflict policy {policy!r}, expected one of {', '.join(POLICIES)}."
+        )
+    (cache_size,) = con.execute("PRAGMA cache_size").fetchone()
+    # A larger page cache keeps the indexes being written in memory instead of
+    # spilling them to the write-ahead log part way through the transaction.
+    con.execute(f"PRAGMA cache_size = {-IMPORT_CACHE_KIB}")
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        # executemany pulls the rows as it goes, so they are never all in memory.
+        written = con.executemany(spec.inserts[policy], rows).rowcount
+    except sqlite3.IntegrityError as e:
+        con.rollback()
+        raise TransferError(f"Import rolled back: {e}") from e
+    except BaseException:
+        con.rollback()
+        raise
+    else:
+        con.commit()
+    finally:
+        con.execute(f"PRAGMA cache_size = {int(cache_size)}")
+    return written
+
+
+def export_file(
+    con: sqlite3.Connection, name: str, path: str, fmt: str | None = None
+) -> int:
+    """Exports the table `name` to the file at `path`."""
+    fmt = file_format(path, fmt)
+    table_spec(name)
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        return export_rows(con, name, f, fmt)
+
+
+def import_file(
+    con: sqlite3.Connection,
+    name: str,
+    path: str,
+    policy: str = "skip",
+    fmt: str | None = None,
+) -> int:
+    """Imports the file at `path` into the table `name`."""
+    fmt = file_format(path, fmt)
+    with open(path, newline="", encoding="utf-8") as f:
+        return import_rows(con, name, read_rows(f, name, fmt), policy)
+
+
+async def _run(args: argparse.Namespace) -> int:
+    from utils.storage import CountingStorage
+
+    storage = CountingStorage(args.database)
+    try:
+        await storage.migrate()
+        if args.command == "export":
+            return await storage.export(args.table, args.path, args.format)
+        return await storage.import_file(
+            args.table, args.path, args.on_conflict, args.format
+        )
+    finally:
+        storage.close()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=("export", "import"))
+    parser.add_argument("database")
+    parser.add_argument("path")
+    parser.add_argument("--table", choices=tuple(TABLES), default="counters")
+    parser.add_argument("--format", choices=FORMATS)
+    parser.add_argument("--on-conflict", choices=POLICIES, default="skip")
+    args = parser.parse_args()
+
+    try:
+        rows = asyncio.run(_run(args))
+    except (OSError, ValueError) as e:
+        # Run as a script, this module is not the `utils.transfer` the storage
+        # raises TransferError from, so catch its base class.
+        print(e, file=sys.stderr)
+        return 1
+    print(f"{args.command.capitalize()}ed {rows} rows of {args.table}.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())